@@ -1,6 +1,10 @@
 import os
+import time
+_BOOT_STARTED = time.perf_counter()  # 起動時間の内訳用（import 開始の時点）
+_IMPORT_TIMINGS = {}  # import 名 -> 秒（python -X importtime の要約のように、重いものだけ記録する）
 import discord
 from discord.ext import commands
+_IMPORT_TIMINGS["discord"] = time.perf_counter() - _BOOT_STARTED
 
 try:
     from dotenv import load_dotenv
@@ -11,9 +15,9 @@ except ImportError:
 from discord import ui
 import subprocess
 import json
+import math
 import sys
 import tempfile
-import time
 try:
     import fcntl
 except ImportError:
@@ -23,38 +27,38 @@ import webbrowser
 import urllib.request
 import urllib.parse
 import asyncio
-import uuid
 import importlib.util
-from datetime import datetime
-
-try:
-    from duckduckgo_search import DDGS
-    HAS_WEB_SEARCH = True
-except ImportError:
-    HAS_WEB_SEARCH = False
-
-try:
-    from selenium import webdriver
-    from selenium.webdriver.chrome.options import Options as ChromeOptions
-    from selenium.webdriver.chrome.service import Service as ChromeService
-    from selenium.webdriver.common.by import By
-    from selenium.webdriver.support.ui import WebDriverWait
-    from selenium.webdriver.support import expected_conditions as EC
-    HAS_SELENIUM = True
-except ImportError:
-    HAS_SELENIUM = False
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+
+_t = time.perf_counter()
+from custom_tools import CustomToolRegistry
+from llm_cache import ResponseCache
+from llm_gateway import LLMGateway
+from llm_metrics import MetricsLog, RunMetrics, cached_stats, eval_stats, format_totals
+from context_sizing import ContextSizer
+from model_residency import ModelResidency, OLLAMA_KEEP_ALIVE, SWAP_WINDOW_SEC
+from ollama_pool import OllamaPool
+from tool_worker import ToolWorkerPool, ToolWorkerError
+from tracing import Tracer
+_IMPORT_TIMINGS["ollama_pool ほか (ollama)"] = time.perf_counter() - _t  # ollama は model_residency・ollama_pool が import する
+
+# ウェブ検索（DuckDuckGo）・Selenium は import が重いので、起動時は有無だけ調べて初回使用時に import する
+HAS_WEB_SEARCH = importlib.util.find_spec("duckduckgo_search") is not None
+HAS_SELENIUM = importlib.util.find_spec("selenium") is not None
 
 # LLM バックエンド: Ollama 単体。思考・解答とも qwen3-swallow:8b。
 # 未登録のときはプロジェクト直下で: ollama create qwen3-swallow:8b -f Modelfile
 # （Modelfile は Hugging Face の GGUF を参照。初回はダウンロードで数分かかります）
-try:
-    import ollama
+# 呼び出しはすべて ollama_pool 経由なので、ここでは有無だけ調べる
+if importlib.util.find_spec("ollama") is not None:
     OLLAMA_MODEL_THINKING = os.environ.get("OLLAMA_MODEL_THINKING", "qwen3-swallow:8b")
     OLLAMA_MODEL_OUTPUT = os.environ.get("OLLAMA_MODEL_OUTPUT", "qwen3-swallow:8b")
     # 思考ステップをスキップすると応答が約2倍速く（1回のLLM呼び出しのみ）。.env で OLLAMA_SKIP_THINKING=1
     OLLAMA_SKIP_THINKING = os.environ.get("OLLAMA_SKIP_THINKING", "").strip().lower() in ("1", "true", "yes")
     HAS_OLLAMA = True
-except ImportError:
+else:
     HAS_OLLAMA = False
     OLLAMA_MODEL_THINKING = ""
     OLLAMA_MODEL_OUTPUT = ""
@@ -90,9 +94,25 @@ MONITOR_CHANNEL_ID = None  # モニターチャンネル（None でタスク開
 # --- LLM 応答待ち ---
 LLM_RESPONSE_TIMEOUT_SEC = int(os.environ.get("LLM_RESPONSE_TIMEOUT_SEC", "600"))  # 1回の応答の最大待ち時間（秒）。既定10分。Ollama が遅い場合は .env で増やす
 
+# --- トレース ---
+# run_agent ごとに、ステップ・LLM 呼び出し・ツール実行・Discord への送信・Webhook 投稿をスパンとして JSONL に書く（TRACE_ENABLED=0 で無効）
+TRACE_PATH = os.path.join(WORKING_DIR, "traces", "trace.jsonl")
+_tracer = Tracer(TRACE_PATH)
+
 # --- 自律実行（タスクキュー）---
 AUTONOMOUS_QUEUE_INTERVAL_SEC = 30 * 60  # 30分ごとにキューをチェック
+AUTONOMOUS_RESUME_DELAY_SEC = 60  # 対話で中断された自律タスクを再開するまでの待ち（秒）
 AUTONOMOUS_TASKS_PATH = os.path.join(WORKING_DIR, "autonomous_tasks.json")
+RUN_CHECKPOINT_DIR = os.path.join(WORKING_DIR, "run_checkpoints")  # 中断した実行の途中経過（messages・ステップ数）の保存先
+# running のタスクはリース付き。実行中は RUN_HEARTBEAT_SEC ごとに延長し、期限切れ（再起動などで放置）は pending に戻して再開する
+RUN_LEASE_SEC = 5 * 60
+RUN_HEARTBEAT_SEC = 60
+
+# --- LLM ゲートウェイ ---
+# 同時に LLM を呼ぶ数。0 なら Ollama のホスト数 × OLLAMA_NUM_PARALLEL（Ollama 側の設定と同じ値を .env にも書く）
+# 待ちは呼び出し元（対話・自律実行・プロアクティブ）とチャンネルごとの公平キューで、重みは LLM_FLOW_WEIGHTS
+LLM_MAX_CONCURRENCY = max(0, int(os.environ.get("LLM_MAX_CONCURRENCY", "0") or 0))
+OLLAMA_NUM_PARALLEL = max(1, int(os.environ.get("OLLAMA_NUM_PARALLEL", "1") or 1))
 
 # --- Bot からチャンネルへの不定期投稿（レポート＋次を作成）---
 PROACTIVE_CHANNEL_ID = MONITOR_CHANNEL_ID  # 投稿先チャンネル（None で無効）
@@ -110,7 +130,7 @@ PROACTIVE_INSTRUCTION = (
 # タスク完了時やキューが空のときに追加する指示（Bot がユーザー支援のために進化し続ける）
 CONTINUOUS_CREATION_INSTRUCTION = (
     "ユーザーの支援のため、新しい便利ツール・スクリプト・自動化を1つ作成してください。"
-    "web_search でトレンドやニーズを調べ、list_skills で既存と被らないものを選び、"
+    "web_search でトレンドやニーズを調べ、search_skills で既存と被らないものを選び、"
     "write_file → run_script で検証 → save_skill で登録。完了したら簡潔に報告してください。"
 )
 
@@ -118,6 +138,7 @@ if not os.path.exists(WORKING_DIR):
     os.makedirs(WORKING_DIR)
 os.makedirs(KNOWLEDGE_DIR, exist_ok=True)
 os.makedirs(CUSTOM_TOOLS_DIR, exist_ok=True)
+os.makedirs(RUN_CHECKPOINT_DIR, exist_ok=True)
 DAILY_LOG_DIR = os.path.join(WORKING_DIR, "daily_log")
 os.makedirs(DAILY_LOG_DIR, exist_ok=True)
 
@@ -195,7 +216,10 @@ def post_to_channel_webhook(channel_key, content, username=None):
     content = (content or "").strip()[:2000]
     if not content:
         return
-    result = send_webhook(url, content, username=username)
+    with _tracer.span("webhook", channel=channel_key, chars=len(content)) as span:
+        result = send_webhook(url, content, username=username)
+        if result and ("エラー" in result or "HTTP" in result):
+            span.set(error=result[:200]).end("error")
     if result and ("エラー" in result or "HTTP" in result):
         try:
             sys.stderr.write(f"[Webhook {channel_key}] {result}\n")
@@ -204,23 +228,59 @@ def post_to_channel_webhook(channel_key, content, username=None):
             pass
 
 
+class _ClockService:
+    """日付はメモリ上の時計から返す。システム時計のずれは WorldTimeAPI で確認し、バックグラウンドで定期的に更新する。
+    確認できるまで・失敗したときはシステム時計をそのまま使う（ずれ 0 秒扱い）。"""
+
+    def __init__(self):
+        self.offset_sec = 0.0  # 正しい時刻 - システム時計
+        self.synced_at = None
+
+    def now(self):
+        return datetime.now() + timedelta(seconds=self.offset_sec)
+
+    def sync(self):
+        """WorldTimeAPI に問い合わせてずれを更新する（ブロックするのでスレッドで呼ぶ）。戻り値: 成功したか。"""
+        try:
+            req = urllib.request.Request(
+                "https://worldtimeapi.org/api/ip",
+                headers={"User-Agent": "DiscordBot/1.0"},
+            )
+            sent = time.time()
+            with urllib.request.urlopen(req, timeout=5) as res:
+                data = json.loads(res.read().decode("utf-8"))
+            received = time.time()
+            unixtime = data.get("unixtime")
+            if unixtime is None:
+                return False
+            # 往復時間の半分を通信の遅れとみなす。数秒程度のずれは無視（日付の判定にしか使わない）
+            offset = float(unixtime) - (sent + received) / 2
+            self.offset_sec = offset if abs(offset) >= 5 else 0.0
+            self.synced_at = received
+            return True
+        except Exception:
+            return False
+
+    async def run(self, interval_sec):
+        """起動時に1回、その後 interval_sec ごとにずれを確認する。"""
+        while True:
+            ok = await asyncio.to_thread(self.sync)
+            if ok and abs(self.offset_sec) >= 60:
+                try:
+                    sys.stderr.write(f"[時計] システム時計が {self.offset_sec:+.0f} 秒ずれています。補正して使います。\n")
+                    sys.stderr.flush()
+                except Exception:
+                    pass
+            await asyncio.sleep(interval_sec)
+
+
+CLOCK_SYNC_INTERVAL_SEC = 6 * 60 * 60  # 時計のずれを確認し直す間隔（秒）
+_clock = _ClockService()
+
+
 def get_current_date_str():
-    """正しい日付を取得。WorldTimeAPI に問い合わせ、失敗時はシステム日時。戻り値は「2026年03月02日」形式。"""
-    try:
-        req = urllib.request.Request(
-            "https://worldtimeapi.org/api/ip",
-            headers={"User-Agent": "DiscordBot/1.0"},
-        )
-        with urllib.request.urlopen(req, timeout=5) as res:
-            data = json.loads(res.read().decode("utf-8"))
-        dt_str = data.get("datetime") or ""
-        if dt_str and len(dt_str) >= 10:
-            # "2026-03-02T12:00:00..." -> 2026年03月02日
-            y, m, d = dt_str[:10].split("-")
-            return f"{y}年{m}月{d}日"
-    except Exception:
-        pass
-    return datetime.now().strftime("%Y年%m月%d日")
+    """正しい日付（メモリ上の時計）。ネットワークには出ない。戻り値は「2026年03月02日」形式。"""
+    return _clock.now().strftime("%Y年%m月%d日")
 
 
 def safe_remove(path):
@@ -247,14 +307,31 @@ def _load_queue():
 
 
 def _save_queue(tasks):
-    """タスクリストをキューJSONに書き込む。"""
+    """タスクリストをキューJSONに書き込む。書き込み途中で落ちても壊れないよう一時ファイル経由で置き換える。"""
+    tmp = AUTONOMOUS_TASKS_PATH + ".tmp"
     try:
-        with open(AUTONOMOUS_TASKS_PATH, "w", encoding="utf-8") as f:
+        with open(tmp, "w", encoding="utf-8") as f:
             json.dump(tasks, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, AUTONOMOUS_TASKS_PATH)
     except Exception:
         pass
 
 
+def _lease_deadline():
+    return (datetime.now() + timedelta(seconds=RUN_LEASE_SEC)).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def _lease_expired(task, now=None):
+    """running タスクのリースが切れているか。リースの無い古いエントリは切れている扱い。"""
+    lease = task.get("lease_until")
+    if not lease:
+        return True
+    try:
+        return datetime.strptime(lease, "%Y-%m-%dT%H:%M:%S") < (now or datetime.now())
+    except ValueError:
+        return True
+
+
 def queue_add(instruction):
     """キューに1件追加。戻り値: (追加したタスク, 待ち件数)。"""
     tasks = _load_queue()
@@ -316,11 +393,64 @@ def queue_get_next():
     for t in tasks:
         if t.get("status") == "pending":
             t["status"] = "running"
+            t["heartbeat_at"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+            t["lease_until"] = _lease_deadline()
             _save_queue(tasks)
             return t
     return None
 
 
+def queue_heartbeat(task_id):
+    """running タスクのリースを延長する（実行中であることの印）。"""
+    tasks = _load_queue()
+    for t in tasks:
+        if t.get("id") == task_id and t.get("status") == "running":
+            t["heartbeat_at"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+            t["lease_until"] = _lease_deadline()
+            _save_queue(tasks)
+            return True
+    return False
+
+
+def queue_reclaim_stale(include_orphans=False, all_running=False):
+    """リースが切れた running タスクを pending に戻す（途中経過があれば続きから再開される）。
+    all_running=True のときはリースの期限に関係なく running をすべて戻す（起動時にプロセスロックを持っている間だけ使う。
+    このプロセスはまだ何も実行していないので、running は前回のプロセスの残り。すぐ再起動するとリースが切れていない）。
+    include_orphans=True のときは、キューに無い途中経過（対話・プロアクティブの実行中に落ちたもの）もタスクとして積み直す。
+    戻り値: 戻した件数。"""
+    tasks = _load_queue()
+    now = datetime.now()
+    reclaimed = 0
+    for t in tasks:
+        if t.get("status") == "running" and (all_running or _lease_expired(t, now)):
+            t["status"] = "pending"
+            t["reclaimed_at"] = now.strftime("%Y-%m-%dT%H:%M:%S")
+            t.pop("lease_until", None)
+            reclaimed += 1
+    if reclaimed:
+        _save_queue(tasks)
+    if not include_orphans:
+        return reclaimed
+    known_ids = {t.get("id") for t in tasks}
+    try:
+        names = sorted(os.listdir(RUN_CHECKPOINT_DIR))
+    except OSError:
+        names = []
+    for fname in names:
+        if not fname.endswith(".json"):
+            continue
+        run_id = fname[:-5]
+        if run_id in known_ids:
+            continue
+        checkpoint = _load_run_checkpoint(run_id)
+        if checkpoint and (checkpoint.get("instruction") or "").strip():
+            task, _ = queue_add(checkpoint["instruction"])
+            _save_run_checkpoint(task["id"], checkpoint)
+            reclaimed += 1
+        _clear_run_checkpoint(run_id)
+    return reclaimed
+
+
 def queue_mark_done(task_id, failed=False, result_summary=None):
     """指定IDのタスクを done または failed に更新。日次ログにも追記。"""
     tasks = _load_queue()
@@ -329,6 +459,7 @@ def queue_mark_done(task_id, failed=False, result_summary=None):
         if t.get("id") == task_id:
             t["status"] = "failed" if failed else "done"
             t["done_at"] = now
+            t.pop("lease_until", None)
             if result_summary is not None:
                 t["result_summary"] = result_summary[:500] if result_summary else None
             _save_queue(tasks)
@@ -340,6 +471,62 @@ def queue_mark_done(task_id, failed=False, result_summary=None):
     pass
 
 
+def queue_suspend(task_id):
+    """running のタスクを pending に戻す（対話に譲って中断したとき）。途中経過は run_checkpoints に保存済みであること。"""
+    tasks = _load_queue()
+    for t in tasks:
+        if t.get("id") == task_id:
+            t["status"] = "pending"
+            t["suspended_at"] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+            t.pop("lease_until", None)
+            _save_queue(tasks)
+            return True
+    return False
+
+
+def _run_checkpoint_path(task_id):
+    return os.path.join(RUN_CHECKPOINT_DIR, f"{task_id}.json")
+
+
+def _save_run_checkpoint(task_id, checkpoint):
+    """実行の途中経過を保存する。書き込み途中で落ちても壊れないよう一時ファイル経由で置き換える。"""
+    if not task_id or not checkpoint:
+        return
+    path = _run_checkpoint_path(task_id)
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except Exception:
+        pass
+
+
+def _load_run_checkpoint(task_id):
+    """保存済みの途中経過を返す。無ければ None。"""
+    path = _run_checkpoint_path(task_id)
+    if not task_id or not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict) and isinstance(data.get("messages"), list):
+            return data
+    except Exception:
+        pass
+    return None
+
+
+def _clear_run_checkpoint(task_id):
+    """途中経過ファイルを片付ける（完了・失敗したタスクはもう再開しない）。"""
+    if not task_id:
+        return
+    try:
+        os.remove(_run_checkpoint_path(task_id))
+    except OSError:
+        pass
+
+
 # 自律ループの二重実行防止
 _autonomous_busy = False
 
@@ -384,14 +571,19 @@ async def proactive_channel_loop(bot):
     while True:
         try:
             delay = random.randint(PROACTIVE_INTERVAL_MIN_SEC, PROACTIVE_INTERVAL_MAX_SEC)
-            await asyncio.sleep(delay)
+            await _sleep_with_prewarm(delay)
         except asyncio.CancelledError:
             break
         try:
             channel = bot.get_channel(PROACTIVE_CHANNEL_ID)
             if not channel:
                 continue
-            await run_agent(channel, MY_USER_ID, PROACTIVE_INSTRUCTION)
+            await run_agent(channel, MY_USER_ID, PROACTIVE_INSTRUCTION, background=True, source="proactive")
+        except AgentRunSuspended as e:
+            # 対話に譲って中断した分はキューに戻し、自律ループで続きから再開する
+            task, _ = queue_add(PROACTIVE_INSTRUCTION)
+            if e.checkpoint:
+                _save_run_checkpoint(task["id"], e.checkpoint)
         except (discord.Forbidden, discord.HTTPException, AttributeError):
             pass
         except Exception:
@@ -477,43 +669,75 @@ async def channel_scheduler_loop(bot):
             pass
 
 
-async def autonomous_loop(bot):
-    """N分ごとにキューを1件消化。キューが空なら「次の便利機能を作成」を追加。完了後も次を追加して24時間作り続ける。"""
+async def _keep_task_lease(task_id):
+    """実行中のタスクのリースを定期的に延長する。プロセスが落ちると延長が止まり、次回起動時に回収される。"""
+    try:
+        while True:
+            await asyncio.sleep(RUN_HEARTBEAT_SEC)
+            queue_heartbeat(task_id)
+    except asyncio.CancelledError:
+        pass
+
+
+async def autonomous_loop(bot, initial_delay=None):
+    """N分ごとにキューを1件消化。キューが空なら「次の便利機能を作成」を追加。完了後も次を追加して24時間作り続ける。
+    対話が来たら実行中のタスクはステップ境界で中断し、途中経過を保存して pending に戻す（対話が終わったら再開）。"""
     global _autonomous_busy
+    delay = AUTONOMOUS_QUEUE_INTERVAL_SEC if initial_delay is None else initial_delay
     while True:
         try:
-            await asyncio.sleep(AUTONOMOUS_QUEUE_INTERVAL_SEC)
+            await _sleep_with_prewarm(delay)
         except asyncio.CancelledError:
             break
+        delay = AUTONOMOUS_QUEUE_INTERVAL_SEC
 
         try:
             if _autonomous_busy:
                 continue
+            if _interactive_runs > 0:
+                delay = AUTONOMOUS_RESUME_DELAY_SEC  # 対話中は始めない。少し待って再確認
+                continue
+            queue_reclaim_stale()
             task = queue_get_next()
             if not task:
                 queue_add(CONTINUOUS_CREATION_INSTRUCTION)
                 continue
 
             _autonomous_busy = True
-            channel = await get_autonomous_channel_async(bot)
+            checkpoint = _load_run_checkpoint(task["id"])
+            channel = None
+            if checkpoint and checkpoint.get("channel_id"):
+                channel = bot.get_channel(checkpoint["channel_id"])  # 中断したときのチャンネルで続ける
+            if channel is None:
+                channel = await get_autonomous_channel_async(bot)
             if not channel:
                 queue_mark_done(task["id"], failed=True, result_summary="モニターチャンネルが取得できません")
+                _clear_run_checkpoint(task["id"])
                 _autonomous_busy = False
                 continue
 
+            lease_task = asyncio.create_task(_keep_task_lease(task["id"]))
             try:
-                await post_monitor(bot, "自律実行開始", task["instruction"][:150])
-                await run_agent(channel, MY_USER_ID, task["instruction"])
+                await post_monitor(bot, "自律実行再開" if checkpoint else "自律実行開始", task["instruction"][:150])
+                await run_agent(channel, MY_USER_ID, task["instruction"], background=True, checkpoint=checkpoint, task_id=task["id"])
                 queue_mark_done(task["id"], failed=False)
+                _clear_run_checkpoint(task["id"])
                 queue_add(CONTINUOUS_CREATION_INSTRUCTION)
+            except AgentRunSuspended as e:
+                if e.checkpoint:
+                    _save_run_checkpoint(task["id"], e.checkpoint)
+                queue_suspend(task["id"])
+                delay = AUTONOMOUS_RESUME_DELAY_SEC
             except Exception as e:
                 queue_mark_done(task["id"], failed=True, result_summary=str(e)[:500])
+                _clear_run_checkpoint(task["id"])
                 try:
                     await channel.send(f"🤖 **自律実行エラー:** {str(e)[:500]}")
                 except Exception:
                     pass
                 queue_add(CONTINUOUS_CREATION_INSTRUCTION)
             finally:
+                lease_task.cancel()
                 _autonomous_busy = False
         except Exception:
             _autonomous_busy = False
@@ -717,28 +941,157 @@ def take_screen_video(seconds=5):
     except Exception:
         return None
 
-def list_skills():
-    """ナレッジフォルダ内のスキル一覧を返す。各スキルの名前と概要。"""
-    if not os.path.isdir(KNOWLEDGE_DIR):
-        return "ナレッジフォルダはまだありません。"
-    lines = []
-    for f in sorted(os.listdir(KNOWLEDGE_DIR)):
-        if not f.endswith(".md"):
-            continue
-        name = f[:-3]
-        path = os.path.join(KNOWLEDGE_DIR, f)
+# スキル一覧を返すときの最大件数（多いときは新しい順にここまで。残りは search_skills で探す）
+SKILLS_LIST_MAX_ITEMS = int(os.environ.get("SKILLS_LIST_MAX_ITEMS", "30"))
+_SKILL_ASCII_RE = re.compile(r"[a-z0-9_]{2,}")
+_SKILL_CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uff66-\uff9f]+")
+
+
+def _skill_tokens(text):
+    """検索用のトークン列。英数字は単語、日本語（かな・漢字）は連続部分を2文字ずつ（bi-gram）に区切る。"""
+    low = (text or "").lower()
+    tokens = _SKILL_ASCII_RE.findall(low)
+    for run in _SKILL_CJK_RE.findall(low):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class _SkillCatalog:
+    """ナレッジフォルダのスキル（.md）のメモリ上の一覧と全文検索インデックス。
+    refresh() はファイルの mtime・サイズだけを見て、変わったファイルだけ読み直す。"""
+
+    def __init__(self, directory):
+        self._dir = directory
+        self._entries = {}  # name -> {"sig", "summary", "mtime", "terms", "length"}
+        self._postings = {}  # token -> {name: 出現回数}
+        self._total_length = 0
+
+    def refresh(self):
+        if not os.path.isdir(self._dir):
+            for name in list(self._entries):
+                self._drop(name)
+            return
+        seen = set()
+        try:
+            with os.scandir(self._dir) as it:
+                for e in it:
+                    if not e.name.endswith(".md") or not e.is_file():
+                        continue
+                    name = e.name[:-3]
+                    seen.add(name)
+                    st = e.stat()
+                    sig = (st.st_mtime_ns, st.st_size)
+                    old = self._entries.get(name)
+                    if old is None or old["sig"] != sig:
+                        self._load(name, e.path, sig, st.st_mtime)
+        except OSError:
+            return
+        for name in list(self._entries):
+            if name not in seen:
+                self._drop(name)
+
+    def _load(self, name, path, sig, mtime):
         try:
             with open(path, "r", encoding="utf-8") as fp:
-                first = fp.readline().strip()
-                if first.startswith("script:"):
-                    second = fp.readline().strip()
-                    summary = second or first
-                else:
-                    summary = first[:80] if first else "(説明なし)"
+                text = fp.read()
+            lines = text.splitlines()
+            first = lines[0].strip() if lines else ""
+            if first.startswith("script:"):
+                # save_skill の形式（script 行・空行・説明）では説明の最初の行を概要にする
+                rest = [ln.strip() for ln in lines[1:] if ln.strip()]
+                summary = (rest[0][:80] if rest else "") or first
+            else:
+                summary = first[:80] if first else "(説明なし)"
         except Exception:
+            text = ""
             summary = "(読めませんでした)"
-        lines.append(f"・{name}: {summary}")
-    return "登録スキル:\n" + "\n".join(lines) if lines else "登録されているスキルはまだありません。"
+        self._drop(name)
+        # スキル名は本文より重く数える
+        terms = {}
+        for tok in _skill_tokens(name.replace("_", " ")) * 3 + _skill_tokens(text):
+            terms[tok] = terms.get(tok, 0) + 1
+        length = sum(terms.values())
+        self._entries[name] = {"sig": sig, "summary": summary, "mtime": mtime, "terms": terms, "length": length}
+        self._total_length += length
+        for tok, tf in terms.items():
+            self._postings.setdefault(tok, {})[name] = tf
+
+    def _drop(self, name):
+        old = self._entries.pop(name, None)
+        if old is None:
+            return
+        self._total_length -= old["length"]
+        for tok in old["terms"]:
+            docs = self._postings.get(tok)
+            if docs is not None:
+                docs.pop(name, None)
+                if not docs:
+                    del self._postings[tok]
+
+    def items(self, newest_first=False):
+        """[(name, summary), ...]。既定は名前順。"""
+        self.refresh()
+        names = sorted(self._entries)
+        if newest_first:
+            names.sort(key=lambda n: self._entries[n]["mtime"], reverse=True)
+        return [(n, self._entries[n]["summary"]) for n in names]
+
+    def search(self, query, limit=5):
+        """BM25 でスコアの高い順に [(name, summary, score), ...] を返す。"""
+        self.refresh()
+        q_terms = set(_skill_tokens(query))
+        n_docs = len(self._entries)
+        if not q_terms or not n_docs:
+            return []
+        avg_len = (self._total_length / n_docs) or 1.0
+        k1, b = 1.2, 0.75
+        scores = {}
+        for tok in q_terms:
+            docs = self._postings.get(tok)
+            if not docs:
+                continue
+            idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for name, tf in docs.items():
+                dl = self._entries[name]["length"]
+                scores[name] = scores.get(name, 0.0) + idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avg_len))
+        ranked = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:max(1, limit)]
+        return [(name, self._entries[name]["summary"], score) for name, score in ranked]
+
+
+_skill_catalog = _SkillCatalog(KNOWLEDGE_DIR)
+
+
+def list_skills(max_items=None):
+    """ナレッジフォルダ内のスキル一覧を返す。各スキルの名前と概要。max_items 指定時は新しい順にその件数まで。"""
+    if not os.path.isdir(KNOWLEDGE_DIR):
+        return "ナレッジフォルダはまだありません。"
+    items = _skill_catalog.items()
+    total = len(items)
+    note = ""
+    if max_items and total > max_items:
+        items = _skill_catalog.items(newest_first=True)[:max_items]
+        note = f"\n（全 {total} 件中、新しい {max_items} 件を表示。目的のスキルは search_skills でキーワード検索してください）"
+    lines = [f"・{name}: {summary}" for name, summary in items]
+    return ("登録スキル:\n" + "\n".join(lines) + note) if lines else "登録されているスキルはまだありません。"
+
+
+def search_skills(query, max_results=5):
+    """登録スキルをキーワードで全文検索し、関連の高いものだけを返す。"""
+    q = (query or "").strip()
+    if not q:
+        return "エラー: 検索キーワードを指定してください。"
+    try:
+        limit = max(1, min(int(max_results or 5), 20))
+    except (TypeError, ValueError):
+        limit = 5
+    hits = _skill_catalog.search(q, limit=limit)
+    if not hits:
+        return f"「{q}」に一致するスキルはありませんでした。新しく作成してよいです。"
+    lines = [f"・{name}: {summary}" for name, summary, _ in hits]
+    return f"「{q}」に近いスキル（上位 {len(lines)} 件）:\n" + "\n".join(lines) + "\n詳細は read_skill で確認してください。"
 
 def read_skill(skill_name):
     """ナレッジからスキル説明を読む。script: で始まる行に実行する .py が書いてある。"""
@@ -747,7 +1100,7 @@ def read_skill(skill_name):
         return "エラー: スキル名を指定してください。"
     path = os.path.join(KNOWLEDGE_DIR, safe + ".md")
     if not os.path.isfile(path):
-        return f"エラー: スキル '{skill_name}' は見つかりません。list_skills で一覧を確認してください。"
+        return f"エラー: スキル '{skill_name}' は見つかりません。search_skills で検索するか list_skills で一覧を確認してください。"
     with open(path, "r", encoding="utf-8") as f:
         return f.read()
 
@@ -855,12 +1208,18 @@ def save_to_github(commit_message=""):
     except Exception as e:
         return f"エラー: {e}"
 
+def _ddgs():
+    """DuckDuckGo 検索のクライアント。duckduckgo_search は初回使用時に import する。"""
+    from duckduckgo_search import DDGS
+    return DDGS()
+
+
 def web_search(query, max_results=10):
     """ウェブ検索（DuckDuckGo）。最新情報を得るため多めに取得。"""
     if not HAS_WEB_SEARCH:
         return "エラー: ウェブ検索には pip install duckduckgo-search が必要です。"
     try:
-        results = list(DDGS().text(query, max_results=max_results))
+        results = list(_ddgs().text(query, max_results=max_results))
     except Exception as e:
         return f"検索エラー: {e}"
     if not results:
@@ -1053,7 +1412,7 @@ def _fetch_news_one_query(query, max_items=5):
         return None
     try:
         # 多めに取得して国内優先でソートしたあと max_items に絞る
-        results = list(DDGS().text(query, max_results=max_items + 10))
+        results = list(_ddgs().text(query, max_results=max_items + 10))
     except Exception:
         return None
     if not results:
@@ -1101,7 +1460,7 @@ def _fetch_news_via_news_search(keywords, max_items=5):
     if not HAS_WEB_SEARCH:
         return None
     try:
-        results = list(DDGS().news(keywords, max_results=max_items))
+        results = list(_ddgs().news(keywords, max_results=max_items))
     except Exception:
         return None
     if not results:
@@ -1344,11 +1703,26 @@ def pip_install(packages):
         return f"エラー: {e}"
 
 
+_selenium_modules = None
+
+
+def _selenium():
+    """selenium を初回使用時に import し、(webdriver, ChromeOptions, By) を返す。"""
+    global _selenium_modules
+    if _selenium_modules is None:
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options as ChromeOptions
+        from selenium.webdriver.common.by import By
+        _selenium_modules = (webdriver, ChromeOptions, By)
+    return _selenium_modules
+
+
 def _selenium_driver(headless=True):
     """ヘッドレスChromeのWebDriverを返す。未インストール時はNone。"""
     if not HAS_SELENIUM:
         return None
     try:
+        webdriver, ChromeOptions, _ = _selenium()
         opts = ChromeOptions()
         if headless:
             opts.add_argument("--headless=new")
@@ -1371,6 +1745,7 @@ def selenium_navigate(url, max_chars=6000):
     try:
         driver.get(url.strip())
         driver.implicitly_wait(5)
+        By = _selenium()[2]
         body = driver.find_element(By.TAG_NAME, "body")
         text = body.text or ""
         title = driver.title or ""
@@ -1396,6 +1771,7 @@ def selenium_click(url, selector):
     try:
         driver.get(url.strip())
         driver.implicitly_wait(5)
+        By = _selenium()[2]
         el = driver.find_element(By.CSS_SELECTOR, selector.strip())
         el.click()
         time.sleep(1)
@@ -1420,6 +1796,7 @@ def selenium_input(url, selector, text):
     try:
         driver.get(url.strip())
         driver.implicitly_wait(5)
+        By = _selenium()[2]
         el = driver.find_element(By.CSS_SELECTOR, selector.strip())
         el.clear()
         el.send_keys(str(text))
@@ -1462,40 +1839,35 @@ def parse_tool_args(args):
     return {}
 
 
-def _load_custom_tools():
-    """project/tools 内の .py をツールとして読み込む。各ファイルは TOOL_NAME, TOOL_DESCRIPTION, run(args) を定義すること。"""
-    schemas = []
-    runners = {}
-    if not os.path.isdir(CUSTOM_TOOLS_DIR):
-        return schemas, runners
-    for fname in sorted(os.listdir(CUSTOM_TOOLS_DIR)):
-        if not fname.endswith('.py') or fname.startswith('_'):
-            continue
-        path = os.path.join(CUSTOM_TOOLS_DIR, fname)
-        if not os.path.isfile(path):
-            continue
-        try:
-            spec = importlib.util.spec_from_file_location(f"custom_tool_{fname[:-3]}", path)
-            mod = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(mod)
-            name = getattr(mod, 'TOOL_NAME', None) or fname[:-3]
-            desc = getattr(mod, 'TOOL_DESCRIPTION', '') or f'カスタムツール: {name}'
-            params = getattr(mod, 'TOOL_PARAMS', None) or {'type': 'object', 'properties': {}, 'required': []}
-            run_fn = getattr(mod, 'run', None)
-            if not callable(run_fn):
-                continue
-            schemas.append({
-                'type': 'function',
-                'function': {
-                    'name': name,
-                    'description': desc,
-                    'parameters': params,
-                },
-            })
-            runners[name] = run_fn
-        except Exception:
-            pass
-    return schemas, runners
+# カスタムツール: project/tools/*.py。メタ情報は実行せずに読み、本体は初回呼び出し時に import。変更は CUSTOM_TOOLS_POLL_SEC ごとに反映
+CUSTOM_TOOLS_POLL_SEC = 5
+_custom_tools = CustomToolRegistry(CUSTOM_TOOLS_DIR)
+# カスタムツールは別プロセスのワーカーで実行する（ハング・クラッシュ・メモリ肥大が Bot 本体に波及しないように）
+CUSTOM_TOOL_ISOLATION = os.environ.get("CUSTOM_TOOL_ISOLATION", "1").strip().lower() in ("1", "true", "yes")
+CUSTOM_TOOL_WORKERS = int(os.environ.get("CUSTOM_TOOL_WORKERS", "2"))  # 常駐させておくワーカー数
+CUSTOM_TOOL_TIMEOUT_SEC = int(os.environ.get("CUSTOM_TOOL_TIMEOUT_SEC", "60"))  # 1回の呼び出しの上限。超えたらワーカーを作り直す
+CUSTOM_TOOL_MEMORY_MB = int(os.environ.get("CUSTOM_TOOL_MEMORY_MB", "1024"))  # ワーカー1つあたりのメモリ上限（0 で無制限）
+CUSTOM_TOOL_CONCURRENCY = int(os.environ.get("CUSTOM_TOOL_CONCURRENCY", "8"))  # ワーカー1つが同時に受ける呼び出し数（async のツールはこれだけ並行に動く）
+_tool_workers = ToolWorkerPool(
+    size=CUSTOM_TOOL_WORKERS,
+    timeout_sec=CUSTOM_TOOL_TIMEOUT_SEC,
+    memory_mb=CUSTOM_TOOL_MEMORY_MB,
+    concurrency=CUSTOM_TOOL_CONCURRENCY,
+) if CUSTOM_TOOL_ISOLATION else None
+
+
+async def _call_custom_tool(name, args):
+    """カスタムツールを実行して結果の文字列を返す。ワーカーが使えないときは従来どおりこのプロセスで実行する。"""
+    if _tool_workers is None:
+        return await _custom_tools.call(name, args)
+    resolved = _custom_tools.resolve(name)
+    if resolved is None:
+        return f"不明なカスタムツールです: {name}"
+    path, sig, is_async = resolved
+    try:
+        return await _tool_workers.call(path, sig, args, is_async=is_async)
+    except ToolWorkerError as e:
+        return f"カスタムツール実行エラー: {e}"
 
 
 # --- メインロジック（コマンドなし・すべて自然言語）---
@@ -1516,7 +1888,8 @@ TOOLS = [
     {'type': 'function', 'function': {'name': 'selenium_click', 'description': 'SeleniumでURLを開き、CSSセレクタで指定した要素をクリックする。例: button.submit, #btn', 'parameters': {'type': 'object', 'properties': {'url': {'type': 'string'}, 'selector': {'type': 'string'}}, 'required': ['url', 'selector']}}},
     {'type': 'function', 'function': {'name': 'selenium_input', 'description': 'SeleniumでURLを開き、CSSセレクタで指定した入力欄にテキストを入力する。', 'parameters': {'type': 'object', 'properties': {'url': {'type': 'string'}, 'selector': {'type': 'string'}, 'text': {'type': 'string'}}, 'required': ['url', 'selector', 'text']}}},
     {'type': 'function', 'function': {'name': 'selenium_screenshot', 'description': 'SeleniumでURLを開き、ページのスクリーンショットを撮る。見た目を確認したいときに使う。', 'parameters': {'type': 'object', 'properties': {'url': {'type': 'string'}}, 'required': ['url']}}},
-    {'type': 'function', 'function': {'name': 'list_skills', 'description': 'ナレッジフォルダに登録済みのスキル一覧を表示する。タスクに使えそうな既存スキルがないか最初に確認する。'}},
+    {'type': 'function', 'function': {'name': 'list_skills', 'description': 'ナレッジフォルダに登録済みのスキル一覧を表示する（多いときは新しい順に一部のみ）。特定の用途のスキルを探すときは search_skills を使う。'}},
+    {'type': 'function', 'function': {'name': 'search_skills', 'description': '登録済みスキルをキーワードで全文検索し、関連の高いものだけを返す。タスクに使えそうな既存スキルがないか、作ろうとしているものと被らないかを最初にこれで確認する。', 'parameters': {'type': 'object', 'properties': {'query': {'type': 'string'}, 'max_results': {'type': 'integer'}}, 'required': ['query']}}},
     {'type': 'function', 'function': {'name': 'read_file', 'description': 'ファイルの内容を読む', 'parameters': {'type': 'object', 'properties': {'filename': {'type': 'string'}}, 'required': ['filename']}}},
     {'type': 'function', 'function': {'name': 'read_skill', 'description': 'ナレッジからスキル説明を読む。script: の行に実行する .py が書いてある。', 'parameters': {'type': 'object', 'properties': {'skill_name': {'type': 'string'}}, 'required': ['skill_name']}}},
     {'type': 'function', 'function': {'name': 'write_file', 'description': 'プログラム・スクリプトを新規作成する。依頼されたコードは必ずこのツールで保存する。filename=プロジェクト内の相対パス（例: main.py）、content=Pythonコード全体。コードは返答本文に書かず、必ずこのツールの content に渡す。作成後は run_script で実行して確認する。', 'parameters': {'type': 'object', 'properties': {'filename': {'type': 'string'}, 'content': {'type': 'string'}}, 'required': ['filename', 'content']}}},
@@ -1529,8 +1902,25 @@ TOOLS = [
     {'type': 'function', 'function': {'name': 'create_webhook', 'description': 'このチャンネルにウェブフックを1つ作成する。戻り値のURLを保存すれば send_webhook でメッセージを送れる。自律的に実行してよい。', 'parameters': {'type': 'object', 'properties': {'name': {'type': 'string'}}, 'required': []}}},
     {'type': 'function', 'function': {'name': 'send_webhook', 'description': 'DiscordウェブフックURLにメッセージを送信する。外部連携・通知用。webhook_url は https://discord.com/api/webhooks/... 形式。content は送信する本文。自律的に実行してよい。', 'parameters': {'type': 'object', 'properties': {'webhook_url': {'type': 'string'}, 'content': {'type': 'string'}, 'username': {'type': 'string'}}, 'required': ['webhook_url', 'content']}}}
 ]
-_custom_schemas, CUSTOM_TOOL_RUNNERS = _load_custom_tools()
-TOOLS = TOOLS + _custom_schemas
+_custom_tools.refresh()
+_custom_schemas_in_tools = list(_custom_tools.schemas)
+TOOLS = TOOLS + _custom_schemas_in_tools
+
+
+def _sync_custom_tools():
+    """カスタムツールの最新の一覧を TOOLS に反映する。TOOLS は MCP と共有しているので中身を一度に差し替える。"""
+    global _custom_schemas_in_tools
+    new_schemas = list(_custom_tools.schemas)
+    if len(new_schemas) == len(_custom_schemas_in_tools) and all(a is b for a, b in zip(new_schemas, _custom_schemas_in_tools)):
+        return
+    kept = [t for t in TOOLS if not any(t is old for old in _custom_schemas_in_tools)]
+    TOOLS[:] = kept + new_schemas
+    _custom_schemas_in_tools = new_schemas
+    try:
+        sys.stderr.write(f"[カスタムツール] 一覧を更新しました: {', '.join(sorted(_custom_tools.names)) or '(なし)'}\n")
+        sys.stderr.flush()
+    except Exception:
+        pass
 
 
 def get_full_skills_list_content(tools_list):
@@ -1606,13 +1996,23 @@ async def update_skills_list_in_channel(bot, tools_list):
         post_to_channel_webhook("skills_list", content, "スキルリスト")
 
 
+# ナレッジ検索（RAG）: タスクごとに knowledge の関連チャンクだけをシステムプロンプトに入れる。使えないときはプロフィール全文
+_t = time.perf_counter()
+from knowledge_rag import KnowledgeIndex
+
+RAG_INDEX_DIR = os.path.join(WORKING_DIR, "rag_index")
+_knowledge_index = KnowledgeIndex(KNOWLEDGE_DIR, RAG_INDEX_DIR)
+_IMPORT_TIMINGS["knowledge_rag (numpy)"] = time.perf_counter() - _t
+
 # MCP は on_ready で接続し、ツールを TOOLS に追加する
+_t = time.perf_counter()
 try:
     from mcp_client import start_mcp_background, mcp_call_tool, MCP_TOOL_NAMES
 except ImportError:
     start_mcp_background = None
     mcp_call_tool = None
     MCP_TOOL_NAMES = set()
+_IMPORT_TIMINGS["mcp_client (mcp)"] = time.perf_counter() - _t
 
 SYSTEM_PROMPT = (
     "【言語】\n"
@@ -1641,12 +2041,12 @@ SYSTEM_PROMPT = (
     "・完成時の最終報告では、必ずそのプログラムの機能説明を行う。何ができるか、どう使うか、入力・出力の例を簡潔に説明する。\n"
     "・返答の本文にコードを貼り付けず、必ず write_file の content にコード全体を入れて呼び出す。\n"
     "・手順: (1) write_file で .py を作成 (2) run_script で実行して確認 (3) ModuleNotFoundError など不足パッケージがあれば pip_install でインストールしてから再実行 (4) エラーなら content を修正して write_file し直し、再度 run_script (5) 動いたら save_skill で登録。すべて完了するまでツールを続ける。\n"
-    "・タスク前に list_skills で既存スキルを確認。使えそうなら read_skill → run_script で再利用。新規で必要なら必ず write_file で自作する。\n"
+    "・タスク前に search_skills でキーワード検索して既存スキルを確認（全体を見たいときだけ list_skills）。使えそうなら read_skill → run_script で再利用。新規で必要なら必ず write_file で自作する。\n"
     "・プログラムはプロジェクトフォルダ内にのみ作成（filename は main.py や hello.py などの相対パス）。作成後は必ず run_script で試験する。\n\n"
     "【ツールの配置と自作】\n"
     "・作成したツール関係はすべて project に保存する。ツール .py は project/tools/、スキル登録は project/knowledge/。\n"
-    "・ツールはプロジェクトフォルダ（project）に格納されている。list_skills / read_skill で既存スキルを確認し、タスクに使えるツールがあれば適宜使用する。\n"
-    "・指示を遂行するために必要だと思われるツールが既存にない場合は、必ず自作する。project/tools に TOOL_NAME, TOOL_DESCRIPTION, run(args) を定義した .py を write_file で作成する（filename は tools/〇〇.py）。save_skill の script_filename も project 内の相対パス（例: tools/〇〇.py）で指定する。作成したツールは Bot 再起動後にツール一覧に載る。今回のタスクで即使う場合は run_script で tools/〇〇.py を実行してもよい。\n"
+    "・ツールはプロジェクトフォルダ（project）に格納されている。search_skills / read_skill で既存スキルを確認し、タスクに使えるツールがあれば適宜使用する。\n"
+    "・指示を遂行するために必要だと思われるツールが既存にない場合は、必ず自作する。project/tools に TOOL_NAME, TOOL_DESCRIPTION, run(args) を定義した .py を write_file で作成する（filename は tools/〇〇.py）。save_skill の script_filename も project 内の相対パス（例: tools/〇〇.py）で指定する。作成したツールは保存すると自動で読み込まれ、次のステップからツールとして呼び出せる（再起動は不要）。\n"
     "・ツールの自作・使用は自律的に判断してよい。ユーザーに確認せず、必要と判断したら作成し実行する。\n\n"
     "【常時進化・ユーザー支援】\n"
     "・24時間、ユーザーの支援能力を高めるために、便利ツール・スクリプト・自動化を自ら作り続ける。キューから「次の便利機能を作成」というタスクが与えられたら、既存スキルと被らないものを選び、作成・検証・save_skill で登録する。\n"
@@ -1732,30 +2132,222 @@ def _messages_to_ollama(messages):
     return out
 
 
-def _call_thinking(messages, system_instruction=None):
-    """Qwen3 Swallow で思考・推論のみ出力。ツールなし。"""
-    if not HAS_OLLAMA or not OLLAMA_MODEL_THINKING:
+# モデルの常駐管理: 起動時に読み込み、keep_alive（OLLAMA_KEEP_ALIVE）を付けて呼ぶ。自律実行の前には先に読み込んでおく
+OLLAMA_PREWARM_LEAD_SEC = 60  # 自律実行・プロアクティブ投稿の何秒前にモデルを読み込んでおくか
+# 思考用と解答用のモデルが違い、両方がメモリに載らないとき: auto=解答用モデルで思考も行う（入れ替えをなくす）, off=そのまま
+OLLAMA_SWAP_POLICY = os.environ.get("OLLAMA_SWAP_POLICY", "auto").strip().lower()
+OLLAMA_SWAP_FALLBACK_COUNT = 3  # 実行中に SWAP_WINDOW_SEC（10分）以内にこの回数入れ替えが起きたら、起動時の判定にかかわらず1モデルに切り替える
+# Ollama のホスト（OLLAMA_HOSTS で複数指定すると、実行中の少ないホストへ振り分け・落ちたホストは外す）
+_ollama = OllamaPool() if HAS_OLLAMA else None
+_models = ModelResidency(OLLAMA_KEEP_ALIVE, client=_ollama)
+_single_model_reason = None  # 1モデル運用に切り替えた理由（None なら思考用・解答用を別々に使う）
+
+# 小さいモデルへの振り分け: 短い会話・簡単な依頼は小さいモデル（思考なし・小さい num_ctx）で答え、
+# プログラム作成・ツールを使い始めた実行・自律実行は解答用モデルのまま
+OLLAMA_MODEL_SMALL = os.environ.get("OLLAMA_MODEL_SMALL", "").strip()  # 例: qwen3:1.7b（空なら振り分けなし）
+OLLAMA_SMALL_NUM_CTX = int(os.environ.get("OLLAMA_SMALL_NUM_CTX", "4096"))
+OLLAMA_SMALL_NUM_PREDICT = int(os.environ.get("OLLAMA_SMALL_NUM_PREDICT", "768"))
+ROUTER_SHORT_CHARS = int(os.environ.get("ROUTER_SHORT_CHARS", "80"))  # ループモードでもこの文字数以下の指示は小さいモデルへ
+# route -> 解答ステップの num_ctx・num_predict
+_LLM_ROUTES = {
+    "main": {"num_ctx": 8192, "num_predict": 1536},
+    "small": {"num_ctx": OLLAMA_SMALL_NUM_CTX, "num_predict": OLLAMA_SMALL_NUM_PREDICT},
+}
+_PROG_KEYWORDS = ("作って", "プログラム", "スクリプト", "書いて", "作成して", "コード")
+
+
+def _route_model(route):
+    """route の解答に使うモデル。"""
+    return OLLAMA_MODEL_SMALL if route == "small" and OLLAMA_MODEL_SMALL else OLLAMA_MODEL_OUTPUT
+
+
+def _choose_route(instruction, use_loop, background, is_prog_request, used_tools):
+    """LLM 呼び出しの振り分け先（"small" / "main"）。
+    簡潔モード・短い指示は small。プログラム作成・自律実行・この実行でツールを使ったあとは main。"""
+    if not OLLAMA_MODEL_SMALL or background or is_prog_request or used_tools:
+        return "main"
+    if not use_loop or len((instruction or "").strip()) <= ROUTER_SHORT_CHARS:
+        return "small"
+    return "main"
+
+
+class _LLMRouteStats:
+    """route ごとの LLM 応答時間（レーンの待ちは含まない）。p50/p90 は直近 window 件から出す。"""
+
+    def __init__(self, window=200):
+        self._window = window
+        self._samples = {}  # route -> deque（秒）
+        self._totals = {}  # route -> [回数, 合計秒]
+
+    def note(self, route, sec):
+        self._samples.setdefault(route, deque(maxlen=self._window)).append(sec)
+        total = self._totals.setdefault(route, [0, 0.0])
+        total[0] += 1
+        total[1] += sec
+
+    def summary(self):
+        out = {}
+        for route, samples in self._samples.items():
+            ordered = sorted(samples)
+            count, total = self._totals[route]
+
+            def pct(q):
+                return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+            out[route] = {
+                "model": _route_model(route),
+                "count": count,
+                "mean_sec": round(total / count, 3),
+                "p50_sec": round(pct(0.5), 3),
+                "p90_sec": round(pct(0.9), 3),
+                "max_sec": round(ordered[-1], 3),
+            }
+        return out
+
+
+_route_stats = _LLMRouteStats()
+# num_ctx・num_predict は呼び出しごとにプロンプトの大きさから決める（route の値が上限。候補は OLLAMA_NUM_CTX_BUCKETS）
+_context_sizer = ContextSizer()
+# 同じ入力には同じ応答でよい呼び出し（temperature 0・最初のステップの思考）の応答キャッシュ。LLM_CACHE=on / all で有効
+LLM_CACHE_DIR = os.path.join(WORKING_DIR, "llm_cache")
+_llm_cache = ResponseCache(LLM_CACHE_DIR)
+# 呼び出しごとの評価の統計（トークン数・プロンプト評価・生成・読み込みの時間）を実行・タスクごとに集計して追記する
+LLM_METRICS_PATH = os.path.join(WORKING_DIR, "llm_metrics.jsonl")
+_llm_metrics = MetricsLog(LLM_METRICS_PATH)
+
+
+def _chat(cacheable=False, **kwargs):
+    """_ollama.chat を呼ぶ。キャッシュを使ってよい呼び出しなら先にディスクを見る。戻り値: (応答, キャッシュから読んだか)"""
+    key = None
+    if _llm_cache.use_for(cacheable, kwargs.get("options")):
+        key = _llm_cache.key(kwargs.get("model"), kwargs.get("options"), kwargs.get("messages"), kwargs.get("tools"))
+        cached = _llm_cache.get(key)
+        if cached is not None:
+            return cached, True
+    response = _ollama.chat(**kwargs)
+    if key is not None:
+        _llm_cache.put(key, response)
+    return response, False
+
+
+def _thinking_model():
+    """思考ステップで使うモデル。1モデル運用中は解答用モデル。"""
+    return OLLAMA_MODEL_OUTPUT if _single_model_reason else OLLAMA_MODEL_THINKING
+
+
+def _models_in_use():
+    """実行で使うモデル（思考をスキップするときは解答用のみ）。"""
+    return [OLLAMA_MODEL_OUTPUT] if OLLAMA_SKIP_THINKING else [_thinking_model(), OLLAMA_MODEL_OUTPUT]
+
+
+def _use_single_model(reason):
+    """思考も解答用モデルで行うように切り替え、警告を出す。"""
+    global _single_model_reason
+    if _single_model_reason or OLLAMA_SWAP_POLICY == "off":
+        return
+    _single_model_reason = reason
+    note = (
+        f"⚠️ 思考用モデル（{OLLAMA_MODEL_THINKING}）と解答用モデル（{OLLAMA_MODEL_OUTPUT}）が同時にメモリに載らないため、"
+        f"思考も {OLLAMA_MODEL_OUTPUT} で行います（{reason}）。別々に使うには OLLAMA_SWAP_POLICY=off。"
+    )
+    try:
+        sys.stderr.write(f"[Ollama] {note}\n")
+        sys.stderr.flush()
+    except Exception:
+        pass
+    post_to_channel_webhook("terminal", note, username="ターミナル")
+
+
+def _warm_models_at_startup():
+    """起動時に Ollama ホストを確認してから、モデルを持つホストごとにモデルを読み込む。
+    思考用と解答用が違えば、各ホストの /api/ps で両方が同時に載っているかを確認する。"""
+    _ollama.check_all()
+    for client in _ollama.host_clients():
+        models = [m for m in _models_in_use() if client.has_model(m)]
+        if len(set(models)) < 2:
+            _models.warm_all(models, client=client)
+        elif _models.check_coresidency(models, client=client) is False:
+            _use_single_model(f"起動時の {client.url} の /api/ps で確認")
+        if OLLAMA_MODEL_SMALL and client.has_model(OLLAMA_MODEL_SMALL):
+            _models.warm(OLLAMA_MODEL_SMALL, label="ウォームアップ（小さいモデル）", client=client)
+
+
+def _warm_on_all_hosts(models, label):
+    """models をそれぞれ持っているホストごとに読み込む（振り分けに任せると1台にしか届かない）。"""
+    for client in _ollama.host_clients():
+        _models.warm_all([m for m in models if client.has_model(m)], label=label, client=client)
+
+
+def _check_model_swaps():
+    """実行中の入れ替え回数を見て、多ければ1モデル運用に切り替える。"""
+    if _single_model_reason or OLLAMA_SKIP_THINKING:
+        return
+    recent = _models.recent_swaps()
+    if recent >= OLLAMA_SWAP_FALLBACK_COUNT:
+        _use_single_model(f"{SWAP_WINDOW_SEC // 60} 分間に入れ替え {recent} 回・読み込み計 {_models.swap_load_sec:.0f} 秒")
+
+
+async def _sleep_with_prewarm(delay):
+    """delay 秒待つ。終わる OLLAMA_PREWARM_LEAD_SEC 秒前にモデルの読み込みを始め、待ちの間に読み込みを済ませる。"""
+    lead = min(OLLAMA_PREWARM_LEAD_SEC, delay)
+    await asyncio.sleep(delay - lead)
+    if HAS_OLLAMA:
+        asyncio.create_task(asyncio.to_thread(_warm_on_all_hosts, _models_in_use(), "自律実行の前"))
+    await asyncio.sleep(lead)
+
+
+def _trace_eval(span, response, from_cache):
+    """LLM 呼び出しのスパンにトークン数・読み込み時間を付ける。"""
+    if from_cache:
+        span.set(cached=True)
+        return
+    stats = eval_stats(response, None, None)
+    span.set(prompt_tokens=stats["prompt_eval_count"], gen_tokens=stats["eval_count"], load_sec=stats["load_sec"])
+
+
+def _call_thinking(messages, system_instruction=None, cacheable=False, calls=None):
+    """Qwen3 Swallow で思考・推論のみ出力。ツールなし。cacheable なら応答キャッシュ（LLM_CACHE=on）を使う。
+    思考は temperature 0 ではない（サンプリングした）応答なので、LLM_CACHE=on では最初のステップの思考は
+    以前に一度サンプリングした答えをそのまま再生する（同じ指示でも毎回違う思考にはならない）。
+    calls（list）を渡すと、この呼び出しの評価の統計を追加する。"""
+    model = _thinking_model()
+    if not HAS_OLLAMA or not model:
         return ""
     system = (system_instruction or THINKING_SYSTEM_PROMPT).strip()
     ollama_messages = _messages_to_ollama(messages)
     if not any(m.get("role") == "system" for m in ollama_messages):
         ollama_messages.insert(0, {"role": "system", "content": system})
-    try:
-        response = ollama.chat(
-            model=OLLAMA_MODEL_THINKING,
-            messages=ollama_messages,
-            options={"num_ctx": 4096, "num_predict": 512},
-        )
-    except Exception:
-        return ""
+    # 同じモデルを解答にも使うときに num_ctx が変わって読み込み直しにならないよう、思考ではバケットを小さくしない
+    num_ctx, num_predict, estimate = _context_sizer.choose(model, ollama_messages, 512, 4096, shrink=False)
+    with _tracer.span("llm.thinking", model=model, num_ctx=num_ctx, num_predict=num_predict) as span:
+        try:
+            response, from_cache = _chat(
+                cacheable,
+                model=model,
+                messages=ollama_messages,
+                options={"num_ctx": num_ctx, "num_predict": num_predict},
+                keep_alive=_models.keep_alive,
+            )
+        except Exception as e:
+            span.set(error=str(e)[:300]).end("error")
+            return ""
+        _trace_eval(span, response, from_cache)
+    if not from_cache:
+        _models.note_response(model, response, label="思考", host=_ollama.last_host(), role="thinking")
+        _context_sizer.note_response(model, response, num_ctx, num_predict, estimate, label="思考")
+    if calls is not None:
+        calls.append(cached_stats(model, "思考") if from_cache else eval_stats(response, model, "思考"))
     msg_obj = getattr(response, "message", None) or response.get("message", {})
     content = (msg_obj.get("content") if isinstance(msg_obj, dict) else getattr(msg_obj, "content", None)) or ""
     return (content or "").strip()
 
 
-def _call_output(messages, system_instruction=None, thinking=""):
-    """Qwen で解答・出力（ツール呼び出し含む）。"""
-    if not HAS_OLLAMA or not OLLAMA_MODEL_OUTPUT:
+def _call_output(messages, system_instruction=None, thinking="", route="main", calls=None):
+    """Qwen で解答・出力（ツール呼び出し含む）。route="small" なら小さいモデル・小さい num_ctx で答える。
+    calls（list）を渡すと、この呼び出しの評価の統計を追加する。"""
+    model = _route_model(route)
+    sizes = _LLM_ROUTES.get(route) or _LLM_ROUTES["main"]
+    if not HAS_OLLAMA or not model:
         return {"role": "assistant", "content": "Ollama が利用できません。", "tool_calls": []}
     system = (system_instruction or SYSTEM_PROMPT).strip()
     if thinking:
@@ -1763,26 +2355,41 @@ def _call_output(messages, system_instruction=None, thinking=""):
     ollama_messages = _messages_to_ollama(messages)
     if not any(m.get("role") == "system" for m in ollama_messages):
         ollama_messages.insert(0, {"role": "system", "content": system})
-    try:
-        response = ollama.chat(
-            model=OLLAMA_MODEL_OUTPUT,
-            messages=ollama_messages,
-            tools=TOOLS,
-            options={
-                "num_ctx": 8192,
-                "num_predict": 1536,
-                "temperature": 0.2,
-                "top_p": 0.8,
-                "min_p": 0.1,
-                "repeat_penalty": 1.05,
-            },
-        )
-    except Exception as e:
-        return {"role": "assistant", "content": f"Ollama エラー: {e}", "tool_calls": []}
+    tools = list(TOOLS)
+    num_ctx, num_predict, estimate = _context_sizer.choose(model, ollama_messages, sizes["num_predict"], sizes["num_ctx"], tools=tools)
+    with _tracer.span("llm.output", model=model, num_ctx=num_ctx, num_predict=num_predict) as span:
+        try:
+            response, from_cache = _chat(
+                False,  # temperature 0.2 なので LLM_CACHE=all のときだけ使う
+                model=model,
+                messages=ollama_messages,
+                tools=tools,
+                options={
+                    "num_ctx": num_ctx,
+                    "num_predict": num_predict,
+                    "temperature": 0.2,
+                    "top_p": 0.8,
+                    "min_p": 0.1,
+                    "repeat_penalty": 1.05,
+                },
+                keep_alive=_models.keep_alive,
+            )
+        except Exception as e:
+            span.set(error=str(e)[:300]).end("error")
+            return {"role": "assistant", "content": f"Ollama エラー: {e}", "tool_calls": []}
+        _trace_eval(span, response, from_cache)
+    label = "解答" if route == "main" else "解答（小さいモデル）"
+    if not from_cache:
+        _models.note_response(model, response, label=label, host=_ollama.last_host(), role="output" if route == "main" else None)
+        _context_sizer.note_response(model, response, num_ctx, num_predict, estimate, label=label)
+        if route == "main":
+            _check_model_swaps()
+    if calls is not None:
+        calls.append(cached_stats(model, label) if from_cache else eval_stats(response, model, label))
     msg_obj = getattr(response, "message", None) or response.get("message", {})
     content = (msg_obj.get("content") if isinstance(msg_obj, dict) else getattr(msg_obj, "content", None)) or ""
     content = (content or "").strip()
-    tool_calls_raw = msg_obj.get("tool_calls") if isinstance(msg_obj, dict) else getattr(msg_obj, "tool_calls", None) or []
+    tool_calls_raw = (msg_obj.get("tool_calls") if isinstance(msg_obj, dict) else getattr(msg_obj, "tool_calls", None)) or []
     tool_calls_list = []
     for tc in tool_calls_raw:
         if isinstance(tc, dict):
@@ -1811,67 +2418,250 @@ def _call_output(messages, system_instruction=None, thinking=""):
     return msg
 
 
-def _call_llm(messages, system_instruction=None):
-    """Ollama で解答（必要なら思考のあと解答）。(msg, thinking) を返す。OLLAMA_SKIP_THINKING=1 で思考をスキップして応答を速く。"""
+def _call_llm(messages, system_instruction=None, route="main", first_step=False, calls=None):
+    """Ollama で解答（必要なら思考のあと解答）。(msg, thinking, 呼び出しごとの評価の統計) を返す。OLLAMA_SKIP_THINKING=1 で思考をスキップして応答を速く。
+    route="small" は思考なしで小さいモデルに答えさせる。first_step の思考は応答キャッシュの対象（同じ指示の繰り返しが多い）。
+    calls（list）を渡すと、評価の統計を呼び出しが終わるごとにそこへ追加する（タイムアウトしてもそこまでの分が残る）。"""
+    calls = [] if calls is None else calls
     if not HAS_OLLAMA:
-        return {"role": "assistant", "content": "利用できるモデルがありません。ollama list でモデルを確認し、ollama run qwen3-swallow:8b などで起動してください。", "tool_calls": []}, ""
-    thinking = "" if OLLAMA_SKIP_THINKING else _call_thinking(messages, THINKING_SYSTEM_PROMPT)
-    msg = _call_output(messages, system_instruction, thinking)
-    return msg, thinking
+        return {"role": "assistant", "content": "利用できるモデルがありません。ollama list でモデルを確認し、ollama run qwen3-swallow:8b などで起動してください。", "tool_calls": []}, "", calls
+    thinking = "" if (OLLAMA_SKIP_THINKING or route == "small") else _call_thinking(messages, THINKING_SYSTEM_PROMPT, cacheable=first_step, calls=calls)
+    msg = _call_output(messages, system_instruction, thinking, route=route, calls=calls)
+    return msg, thinking, calls
 
 
 # 同一チャンネルで同時に1件だけ run_agent を実行（「処理中です」が2回出るのを防ぐ）
 _channel_busy = set()  # channel_id
-# チャンネルごとの会話履歴（直前のやりとりを保持して文脈を継続）
-_channel_history: dict[int, list] = {}
+# 実行中に届いたメッセージの受け皿（チャンネルごと・上限付き）。次のステップ境界で注入、残りは終了後にまとめて1回実行
+_channel_inbox: dict[int, deque] = {}
+MAX_INBOX_MESSAGES = int(os.environ.get("MAX_INBOX_MESSAGES", "10"))  # 1チャンネルで溜める最大件数（超えたら古いものから捨てる）
+# 自律実行（キュー・プロアクティブ）中のチャンネル。対話が来たらステップ境界で中断して譲る
+_channel_background = set()  # channel_id
+_interactive_runs = 0  # 実行中・待機中の対話 run_agent の数（>0 の間は自律実行を止める）
+
+
+class AgentRunSuspended(Exception):
+    """自律実行が対話に譲って中断したことを示す。checkpoint に再開用の途中経過を持つ。"""
+
+    def __init__(self, checkpoint):
+        super().__init__("対話を優先するため自律実行を中断しました")
+        self.checkpoint = checkpoint
+
+
+# LLM の同時実行数と待ちの順番（呼び出し元・チャンネルごとの重み付き公平キュー）
+_llm_gateway = LLMGateway(LLM_MAX_CONCURRENCY or (len(_ollama.hosts) if _ollama else 1) * OLLAMA_NUM_PARALLEL)
+
+
+async def _call_llm_in_lane(source, channel_id, messages, system_content, route="main", first_step=False, calls=None):
+    """ゲートウェイで順番を待ってから _call_llm をスレッドで実行する。source は interactive / autonomous / proactive。
+    応答時間（待ちを除く）は route ごとに記録する。"""
+    with _tracer.span("llm", source=source, route=route) as span:
+        started = time.perf_counter()
+        # 呼び出し側の wait_for でタイムアウトしても、枠は Ollama への要求（スレッド）が終わるまで返さない
+        result, waited = await _llm_gateway.run_in_thread(source, channel_id, _call_llm, messages, system_content, route, first_step, calls)
+        span.set(wait_sec=round(waited, 3))
+        _route_stats.note(route, time.perf_counter() - started - waited)
+        return result
+
+
+def _should_yield_to_interactive(channel_id):
+    """自律実行をステップ境界で中断すべきか（対話が実行中・待機中、またはこのチャンネルに指示が届いている）。"""
+    return _interactive_runs > 0 or bool(_channel_inbox.get(channel_id))
+
+
+# チャンネル別状態のメモリ上限。超えたら最後に使ったのが古いチャンネルから捨て、次に使うときにファイルから読み直す
+CHANNEL_CACHE_MAX_CHANNELS = int(os.environ.get("CHANNEL_CACHE_MAX_CHANNELS", "64"))
+CHANNEL_CACHE_MAX_BYTES = int(os.environ.get("CHANNEL_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))  # 既定 8MB
+
+
+def _estimate_state_bytes(value):
+    """キャッシュ1件のおおよそのバイト数（JSON にしたときの UTF-8 サイズ）。"""
+    try:
+        return len(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+    except Exception:
+        return 0
+
+
+class _ChannelStateLRU:
+    """チャンネルID → 状態 の LRU キャッシュ。件数とバイト数の両方で上限を持ち、見つからなければ loader で読み直す。
+    cache_missing=False なら loader が None を返したチャンネル（未設定）はキャッシュしない。"""
+
+    def __init__(self, loader, max_items, max_bytes, cache_missing=True):
+        self._loader = loader
+        self._cache_missing = cache_missing
+        self._max_items = max(1, max_items)
+        self._max_bytes = max_bytes
+        self._data = OrderedDict()  # channel_id -> (value, bytes)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, channel_id):
+        return channel_id in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, channel_id, default=None):
+        """状態を返す。メモリに無ければ loader で読み込んでキャッシュする。"""
+        entry = self._data.get(channel_id)
+        if entry is not None:
+            self._data.move_to_end(channel_id)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        try:
+            value = self._loader(channel_id)
+        except Exception:
+            value = None
+        if value is None:
+            if not self._cache_missing:
+                return default
+            value = default
+        self[channel_id] = value
+        return value
+
+    def __setitem__(self, channel_id, value):
+        old = self._data.pop(channel_id, None)
+        if old is not None:
+            self._bytes -= old[1]
+        size = _estimate_state_bytes(value)
+        self._data[channel_id] = (value, size)
+        self._bytes += size
+        # 今入れた1件は残し、古いものから上限内に収まるまで捨てる
+        while len(self._data) > 1 and (len(self._data) > self._max_items or self._bytes > self._max_bytes):
+            _, (_, evicted_size) = self._data.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "channels": len(self._data),
+            "resident_bytes": self._bytes,
+            "max_channels": self._max_items,
+            "max_bytes": self._max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# チャンネルごとの会話履歴（直前のやりとりを保持して文脈を継続）。上限付きで、捨てた分は会話履歴ファイルから読み直す
+_channel_history = _ChannelStateLRU(lambda cid: load_channel_history(cid), CHANNEL_CACHE_MAX_CHANNELS, CHANNEL_CACHE_MAX_BYTES)
 MAX_HISTORY_MESSAGES = 20  # コンテキスト用に保持する直近メッセージ数
 # 会話履歴のテキスト保存（再起動後も保持、容量制限で古い分を削る）
 CONVERSATION_HISTORY_DIR = os.path.join(WORKING_DIR, "conversation_history")
 MAX_PERSISTED_MESSAGES = 50  # ファイルに保存する最大メッセージ数（user/assistant のみ）
 MAX_HISTORY_FILE_BYTES = 400000  # 1チャンネルあたりのファイル最大サイズ（約400KB）
+HISTORY_COMPACT_TARGET_BYTES = MAX_HISTORY_FILE_BYTES // 2  # 上限を超えたらこのサイズまで一度に詰める（毎回の書き直しを避ける）
 os.makedirs(CONVERSATION_HISTORY_DIR, exist_ok=True)
 
 
 def _conversation_history_path(channel_id):
-    return os.path.join(CONVERSATION_HISTORY_DIR, f"{channel_id}.json")
+    return os.path.join(CONVERSATION_HISTORY_DIR, f"{channel_id}.jsonl")
 
 
-def load_channel_history(channel_id):
-    """保存済みの会話履歴を読み込む。"""
+def _history_records(messages):
+    """保存対象（user/assistant で本文あり）だけを JSONL の1行ずつに変換する。"""
+    lines = []
+    for m in messages or []:
+        role = m.get("role")
+        if role not in ("user", "assistant"):
+            continue
+        content = (m.get("content") or "").strip()
+        if not content:
+            continue
+        lines.append(json.dumps({"role": role, "content": content[:3000]}, ensure_ascii=False) + "\n")
+    return lines
+
+
+def _read_tail_lines(path, max_lines, max_bytes=None):
+    """ファイル末尾から最大 max_lines 行（max_bytes 指定時はその合計バイト以内）を読む。先頭から全体を読まない。"""
+    block = 8192
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        buf = b""
+        while pos > 0 and buf.count(b"\n") <= max_lines and (max_bytes is None or len(buf) <= max_bytes):
+            step = min(block, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+    lines = buf.split(b"\n")
+    if pos > 0:
+        lines = lines[1:]  # 途中から読んだ先頭行は欠けているので捨てる
+    out = []
+    total = 0
+    for raw in reversed([ln for ln in lines if ln.strip()]):
+        if len(out) >= max_lines or (max_bytes is not None and total + len(raw) + 1 > max_bytes):
+            break
+        out.append(raw)
+        total += len(raw) + 1
+    out.reverse()
+    return out
+
+
+def _migrate_legacy_history(channel_id):
+    """旧形式（{channel_id}.json の配列）があれば JSONL に変換する。"""
+    legacy = os.path.join(CONVERSATION_HISTORY_DIR, f"{channel_id}.json")
     path = _conversation_history_path(channel_id)
-    if not os.path.isfile(path):
-        return []
+    if not os.path.isfile(legacy) or os.path.isfile(path):
+        return
     try:
-        with open(path, "r", encoding="utf-8") as f:
+        with open(legacy, "r", encoding="utf-8") as f:
             data = json.load(f)
         if isinstance(data, list):
-            return data[-MAX_HISTORY_MESSAGES:]
+            with open(path, "w", encoding="utf-8") as f:
+                f.writelines(_history_records(data[-MAX_PERSISTED_MESSAGES:]))
+        os.replace(legacy, legacy + ".migrated")
     except Exception:
         pass
-    return []
 
 
-def save_channel_history(channel_id, messages):
-    """会話履歴をテキスト（JSON）で保存。件数・サイズ制限で古い分を削り上書き。"""
-    if not messages:
+def load_channel_history(channel_id):
+    """保存済みの会話履歴を読み込む。ファイル末尾から直近 MAX_HISTORY_MESSAGES 件だけを読む。"""
+    _migrate_legacy_history(channel_id)
+    path = _conversation_history_path(channel_id)
+    if not os.path.isfile(path):
+        return []
+    try:
+        raw_lines = _read_tail_lines(path, MAX_HISTORY_MESSAGES)
+    except Exception:
+        return []
+    out = []
+    for raw in raw_lines:
+        try:
+            m = json.loads(raw.decode("utf-8"))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            continue  # 書き込み途中で落ちた行などは読み飛ばす
+        if isinstance(m, dict) and m.get("role") in ("user", "assistant"):
+            out.append({"role": m["role"], "content": m.get("content") or ""})
+    return out
+
+
+def _compact_channel_history(path):
+    """末尾の HISTORY_COMPACT_TARGET_BYTES・MAX_PERSISTED_MESSAGES 以内だけを残して1回で書き直す。"""
+    keep = _read_tail_lines(path, MAX_PERSISTED_MESSAGES, max_bytes=HISTORY_COMPACT_TARGET_BYTES)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(b"".join(ln + b"\n" for ln in keep))
+    os.replace(tmp, path)
+
+
+def append_channel_history(channel_id, messages):
+    """1ターン分の会話を JSONL に追記（user/assistant のみ、tool は省略して容量節約）。
+    ファイルが MAX_HISTORY_FILE_BYTES を超えたときだけ古い分を削って詰め直す。"""
+    lines = _history_records(messages)
+    if not lines:
         return
-    # user/assistant のみ保存（tool は省略して容量節約）
-    to_save = []
-    for m in messages:
-        role = m.get("role")
-        if role not in ("user", "assistant"):
-            continue
-        content = (m.get("content") or "").strip()
-        if not content:
-            continue
-        to_save.append({"role": role, "content": content[:3000]})
-    to_save = to_save[-MAX_PERSISTED_MESSAGES:]
     path = _conversation_history_path(channel_id)
     try:
-        while to_save and len(json.dumps(to_save, ensure_ascii=False).encode("utf-8")) > MAX_HISTORY_FILE_BYTES:
-            to_save.pop(0)
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(to_save, f, ensure_ascii=False, indent=0)
+        _migrate_legacy_history(channel_id)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("".join(lines))
+        if os.path.getsize(path) > MAX_HISTORY_FILE_BYTES:
+            _compact_channel_history(path)
     except Exception:
         pass
 # 自立型エージェント: テキスト返答後に「続けて」を注入して思考・実行をループする最大回数
@@ -1889,8 +2679,57 @@ def _is_completion_phrase(content):
         return False
     return "完了" in s or "以上です" in s or s == "以上" or s == "完了"
 
-# チャンネルごとの応答モード: True=自律ループ, False=ループせず簡潔に。未設定時は発言内容で都度判定
-_channel_use_autonomous_loop: dict[int, bool] = {}
+# チャンネルごとの応答モード: True=自律ループ, False=ループせず簡潔に。未設定（None）時は発言内容で都度判定
+# 永続設定はファイルに保存し、メモリには上限付きでキャッシュする
+CHANNEL_MODES_PATH = os.path.join(CONVERSATION_HISTORY_DIR, "channel_modes.json")
+
+
+def _load_channel_modes():
+    try:
+        if os.path.isfile(CHANNEL_MODES_PATH):
+            with open(CHANNEL_MODES_PATH, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                return data
+    except Exception:
+        pass
+    return {}
+
+
+_channel_modes = _load_channel_modes()  # 永続設定の本体。ファイルは起動時に一度だけ読み、LRU の読み直しはここから引く
+
+
+def _load_channel_mode(channel_id):
+    """保存済みの応答モードを返す。未設定なら None。"""
+    mode = _channel_modes.get(str(channel_id))
+    return mode if isinstance(mode, bool) else None
+
+
+def _save_channel_mode(channel_id, mode):
+    _channel_modes[str(channel_id)] = bool(mode)
+    tmp = CHANNEL_MODES_PATH + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(_channel_modes, f, ensure_ascii=False)
+        os.replace(tmp, CHANNEL_MODES_PATH)
+    except Exception:
+        pass
+
+
+# 未設定のチャンネルはキャッシュしない（件数・バイト数の上限を未設定の分で埋めない）
+_channel_use_autonomous_loop = _ChannelStateLRU(_load_channel_mode, CHANNEL_CACHE_MAX_CHANNELS, CHANNEL_CACHE_MAX_BYTES, cache_missing=False)
+
+
+def channel_state_stats():
+    """チャンネル別状態のメモリ使用状況（件数・推定バイト数など）。"""
+    history = _channel_history.stats()
+    modes = _channel_use_autonomous_loop.stats()
+    return {
+        "history": history,
+        "modes": modes,
+        "inbox_channels": len(_channel_inbox),
+        "resident_bytes": history["resident_bytes"] + modes["resident_bytes"],
+    }
 
 # モード設定フレーズ（永続）: (含まれたら設定する文言, 設定する値)
 _MODE_SET_PHRASES = [
@@ -1910,12 +2749,11 @@ _LOOP_PHRASES = ("ループして", "自律で", "じっくり考えて", "続
 def _parse_instruction_mode(channel_id, instruction):
     """指示からモード設定を検出し、永続設定・今回の use_autonomous_loop を決める。戻り値: (strip 後の指示, 今回ループするか)"""
     s = (instruction or "").strip()
-    use_loop = None  # None = 永続未設定なので今回の文言で決める
-    if channel_id in _channel_use_autonomous_loop:
-        use_loop = _channel_use_autonomous_loop[channel_id]
+    use_loop = _channel_use_autonomous_loop.get(channel_id)  # None = 永続未設定なので今回の文言で決める
     for phrase, mode in _MODE_SET_PHRASES:
         if phrase in s:
             _channel_use_autonomous_loop[channel_id] = mode
+            _save_channel_mode(channel_id, mode)
             use_loop = mode
             s = s.replace(phrase, "").strip().strip("。、").strip()
             break
@@ -1934,15 +2772,24 @@ def _parse_instruction_mode(channel_id, instruction):
 # 複数プロセスで1つだけ実行（ファイルロック・macOS/Linux）
 # 実行ディレクトリに依存しないようホーム直下の固定パス（launchd と Cursor など複数起動時も1つだけ動く）
 _agent_lock_path = os.path.expanduser("~/.agent_bot.lock")
+# 同一プロセス内ではロックを共有する（チャンネル間の並行実行は許し、LLM の順番はゲートウェイで制御）
+_agent_lock_fd = None
+_agent_lock_refs = 0
 
 def _acquire_process_lock():
-    """プロセス間で1つだけ取れるロック。取れなければ None、取れたら fd。"""
+    """プロセス間で1つだけ取れるロック。取れなければ None、取れたら fd。同一プロセス内の2件目以降は参照カウントを増やすだけ。"""
+    global _agent_lock_fd, _agent_lock_refs
     if not fcntl:
         return 0  # Windows ではスキップ（常に通過）
+    if _agent_lock_fd is not None:
+        _agent_lock_refs += 1
+        return _agent_lock_fd
     fd = None
     try:
         fd = os.open(_agent_lock_path, os.O_CREAT | os.O_RDWR)
         fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        _agent_lock_fd = fd
+        _agent_lock_refs = 1
         return fd
     except (BlockingIOError, OSError):
         if fd is not None:
@@ -1960,16 +2807,108 @@ def _acquire_process_lock():
         return None
 
 def _release_process_lock(fd):
+    global _agent_lock_fd, _agent_lock_refs
     if not fcntl or fd is None:
         return
+    _agent_lock_refs -= 1
+    if _agent_lock_refs > 0:
+        return
+    _agent_lock_fd = None
+    _agent_lock_refs = 0
     try:
         fcntl.flock(fd, fcntl.LOCK_UN)
         os.close(fd)
     except Exception:
         pass
 
-async def run_agent(channel, author_id, instruction):
-    """自然言語の指示を1つの入口で処理。会話もコードも文脈で判断。"""
+
+def _inbox_put(channel_id, instruction):
+    """実行中のチャンネルに届いた指示を受け皿に溜める。戻り値は溜まっている件数。"""
+    box = _channel_inbox.get(channel_id)
+    if box is None:
+        box = deque(maxlen=max(1, MAX_INBOX_MESSAGES))
+        _channel_inbox[channel_id] = box
+    box.append(instruction.strip())
+    return len(box)
+
+
+def _inbox_drain(channel_id):
+    """受け皿の指示をすべて取り出し、1つの指示にまとめて返す。空なら ""。"""
+    box = _channel_inbox.pop(channel_id, None)
+    if not box:
+        return ""
+    items = [s for s in box if s]
+    if len(items) == 1:
+        return items[0]
+    return "\n".join(f"({i}) {s}" for i, s in enumerate(items, 1))
+
+_system_content_cache = {}  # ("base", 日付) / ("profile", 日付, mtime, サイズ) -> 組み立て済みの system_content
+
+
+def _system_content_for(knowledge=None):
+    """実行ごとの system_content。日付入りの共通部分とプロフィール入りの全文は、日付・プロフィールの更新日時が同じ間は使い回す。
+    knowledge（今回の指示に関係するナレッジ抜粋）があればプロフィール全文の代わりに入れる。"""
+    today_str = get_current_date_str()
+    base_key = ("base", today_str)
+    base = _system_content_cache.get(base_key)
+    if base is None:
+        date_note = f"\n\n【参考】今日の日付（正しい西暦）: {today_str}。検索結果がこの日付より古い場合は古い情報とみなし、複数検索や fetch_webpage で最新を確認する。\n\n"
+        base = SYSTEM_PROMPT + date_note
+        _system_content_cache.clear()  # 日付が変わったら古いものは要らない
+        _system_content_cache[base_key] = base
+    if knowledge:
+        # プロフィール・スキル・メモのうち今回の指示に関係するチャンクだけ（詳細は read_agent_profile / read_skill で読める）
+        return base + "【関連ナレッジ（自分のプロフィール・スキル・メモから抜粋）】\n" + knowledge
+    try:
+        st = os.stat(AGENT_PROFILE_PATH)
+        profile_key = ("profile", today_str, st.st_mtime_ns, st.st_size)
+    except OSError:
+        return base
+    content = _system_content_cache.get(profile_key)
+    if content is None:
+        profile = read_agent_profile()
+        content = (base + "【現在の自分について】\n" + profile) if profile and profile.strip() and "(まだ記録されていません)" not in profile else base
+        for k in [k for k in _system_content_cache if k[0] == "profile"]:
+            del _system_content_cache[k]
+        _system_content_cache[profile_key] = content
+    return content
+
+
+class _TracedMessage:
+    """Discord のメッセージ。edit をトレースのスパンに残し、それ以外は元のメッセージに任せる。"""
+
+    def __init__(self, message):
+        self._message = message
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+    async def edit(self, **kwargs):
+        with _tracer.span("discord.edit", chars=len(kwargs.get("content") or "")):
+            return await self._message.edit(**kwargs)
+
+
+class _TracedChannel:
+    """Discord のチャンネル。send をトレースのスパンに残し、それ以外は元のチャンネルに任せる。"""
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+    async def send(self, content=None, **kwargs):
+        with _tracer.span("discord.send", chars=len(content or ""), file="file" in kwargs):
+            message = await self._channel.send(content, **kwargs)
+        return _TracedMessage(message) if message is not None else None
+
+
+async def run_agent(channel, author_id, instruction, background=False, checkpoint=None, task_id=None, source=None):
+    """自然言語の指示を1つの入口で処理。会話もコードも文脈で判断。
+    background=True は自律実行（キュー・プロアクティブ）。対話が来るとステップ境界で AgentRunSuspended を送出して譲る。
+    source は LLM ゲートウェイでの呼び出し元の種類（既定は対話なら interactive、自律実行なら autonomous）。
+    checkpoint を渡すと、中断時の途中経過から再開する。途中経過はツール実行ごとに task_id（無ければチャンネル単位）で保存する。"""
+    global _interactive_runs
     if author_id != MY_USER_ID:
         await channel.send("アクセス権限がありません。")
         return
@@ -1983,25 +2922,81 @@ async def run_agent(channel, author_id, instruction):
         )
         return
 
+    # このチャンネルで既に処理中なら受け皿に溜める（実行中のステップ境界で注入、または終了後にまとめて実行）
+    cid = channel.id
+    if cid in _channel_busy:
+        if background:
+            raise AgentRunSuspended(checkpoint)  # 対話で使用中のチャンネルには割り込まず、キューに戻す
+        pending = _inbox_put(cid, instruction)
+        if cid in _channel_background:
+            note = "📥 受け付けました。自律タスクを区切りで中断して対応します。"
+        else:
+            note = f"📥 実行中のため受け付けました（待ち {pending} 件）。区切りで続けて対応します。"
+        try:
+            await channel.send(note)
+        except Exception:
+            pass
+        return
+    if background and _interactive_runs > 0:
+        raise AgentRunSuspended(checkpoint)
+    if not background:
+        _interactive_runs += 1
     # 他プロセスが既に処理中なら何もせず抜ける（複数起動時の二重防止）
     lock_fd = _acquire_process_lock()
     if lock_fd is None:
-        return
-    # このチャンネルで既に処理中なら何もせず抜ける（同一プロセス内の二重防止）
-    cid = channel.id
-    if cid in _channel_busy:
-        _release_process_lock(lock_fd)
+        if not background:
+            _interactive_runs -= 1
         return
     _channel_busy.add(cid)
+    if background:
+        _channel_background.add(cid)
+    suspended = None
+    # キューのタスクはタスクIDで、それ以外（対話・プロアクティブ）はチャンネル単位で途中経過を保存する
+    channel_run_id = f"channel-{cid}"
+    run_span = _tracer.start(
+        "run", channel_id=cid, source=source or ("autonomous" if background else "interactive"),
+        task_id=task_id, resumed=bool(checkpoint), instruction=instruction.strip()[:200],
+    )
     try:
-        await _run_agent_impl(channel, author_id, instruction)
+        try:
+            await _run_agent_impl(channel, author_id, instruction, background=background, checkpoint=checkpoint,
+                                  checkpoint_id=task_id or channel_run_id, source=source)
+        except AgentRunSuspended as e:
+            suspended = e
+        finally:
+            if not task_id:
+                _clear_run_checkpoint(channel_run_id)
+        _channel_background.discard(cid)
+        # 実行中に届いて注入しきれなかった指示は、まとめて1回の追加実行にする（対話として実行）
+        while True:
+            follow_up = _inbox_drain(cid)
+            if not follow_up:
+                break
+            if background:
+                _interactive_runs += 1  # 自律実行から引き継いだ追加実行も対話なので、その間は他チャンネルの自律実行を止める
+            try:
+                await _run_agent_impl(channel, author_id, follow_up, checkpoint_id=channel_run_id)
+            finally:
+                if background:
+                    _interactive_runs -= 1
+                _clear_run_checkpoint(channel_run_id)
+    except BaseException:
+        run_span.end("error")
+        raise
     finally:
+        run_span.end("suspended" if suspended else None)
+        _channel_inbox.pop(cid, None)
+        _channel_background.discard(cid)
         _channel_busy.discard(cid)
         _release_process_lock(lock_fd)
+        if not background:
+            _interactive_runs -= 1
+    if suspended is not None:
+        raise suspended
 
 
-async def _run_agent_impl(channel, author_id, instruction):
-    """run_agent の実処理。チャンネル busy ガードの内側から呼ばれる。"""
+async def _run_agent_impl(channel, author_id, instruction, background=False, checkpoint=None, checkpoint_id=None, source=None):
+    """run_agent の実処理。チャンネル busy ガードの内側から呼ばれる。checkpoint_id があればツール実行ごとに途中経過を保存する。"""
     # モード切り替え: 「簡単に」「ループせず」等で今回ループするか決める。永続設定の場合はストリップ
     stripped_instruction, use_autonomous_loop = _parse_instruction_mode(channel.id, instruction)
     if not stripped_instruction.strip():
@@ -2017,21 +3012,55 @@ async def _run_agent_impl(channel, author_id, instruction):
                 pass
         return
     instruction = stripped_instruction
-    await post_monitor(bot, "タスク開始", instruction.strip()[:150])
-    profile = read_agent_profile()
-    today_str = get_current_date_str()
-    date_note = f"\n\n【参考】今日の日付（正しい西暦）: {today_str}。検索結果がこの日付より古い場合は古い情報とみなし、複数検索や fetch_webpage で最新を確認する。\n\n"
-    system_content = (SYSTEM_PROMPT + date_note + "【現在の自分について】\n" + profile) if profile and profile.strip() and "(まだ記録されていません)" not in profile else (SYSTEM_PROMPT + date_note)
-    # このチャンネルの直近会話を読み込み、今回のユーザーメッセージの前に挟む（未読み込みならファイルから復元）
-    if channel.id not in _channel_history:
-        _channel_history[channel.id] = load_channel_history(channel.id)
-    history = _channel_history.get(channel.id, [])[-MAX_HISTORY_MESSAGES:]
-    history_len = len(history)
-    messages = [
-        {"role": "system", "content": system_content},
-        *history,
-        {"role": "user", "content": instruction.strip()}
-    ]
+    channel = _TracedChannel(channel)  # Discord への送信・編集をトレースに残す
+    source = source or ("autonomous" if background else "interactive")
+    run_metrics = RunMetrics(checkpoint_id or f"channel-{channel.id}", channel.id, source, instruction)
+    await post_monitor(bot, "タスク再開" if checkpoint else "タスク開始", instruction.strip()[:150])
+    knowledge = await asyncio.to_thread(_knowledge_index.context_for, instruction)
+    system_content = _system_content_for(knowledge)
+    start_step = 0
+    autonomous_continuation_count = 0  # 自立型: 「続けて」注入の回数
+    if checkpoint:
+        # 中断時の途中経過から再開（system は今回のものに差し替える）
+        saved = checkpoint.get("messages") or []
+        history_len = min(int(checkpoint.get("history_len") or 0), len(saved))
+        history = saved[:history_len]
+        messages = [{"role": "system", "content": system_content}, *saved]
+        start_step = int(checkpoint.get("step") or 0)
+        autonomous_continuation_count = int(checkpoint.get("continuations") or 0)
+        if "use_autonomous_loop" in checkpoint:
+            use_autonomous_loop = bool(checkpoint["use_autonomous_loop"])
+    else:
+        # このチャンネルの直近会話を読み込み、今回のユーザーメッセージの前に挟む（未読み込みならファイルから復元）
+        history = (_channel_history.get(channel.id) or [])[-MAX_HISTORY_MESSAGES:]
+        history_len = len(history)
+        messages = [
+            {"role": "system", "content": system_content},
+            *history,
+            {"role": "user", "content": instruction.strip()}
+        ]
+
+    def _remember_turn():
+        """ターン終了時: メモリ上の直近履歴を更新し、今回の分をファイルに追記する。"""
+        try:
+            new_part = messages[1 + history_len:]
+            _channel_history[channel.id] = (history + new_part)[-MAX_HISTORY_MESSAGES:]
+            append_channel_history(channel.id, new_part)
+        except Exception:
+            pass
+
+    def _make_checkpoint(step):
+        """再開用の途中経過（system を除く messages とステップ数）。"""
+        return {
+            "instruction": stripped_instruction,
+            "channel_id": channel.id,
+            "messages": messages[1:],
+            "history_len": history_len,
+            "step": step,
+            "continuations": autonomous_continuation_count,
+            "use_autonomous_loop": use_autonomous_loop,
+            "saved_at": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        }
 
     typing_task = None
     async def keep_typing():
@@ -2044,7 +3073,7 @@ async def _run_agent_impl(channel, author_id, instruction):
     typing_task = asyncio.create_task(keep_typing())
     processing_msg = None
     inst = instruction.strip().lower()
-    is_prog_request = any(k in inst for k in ("作って", "プログラム", "スクリプト", "書いて", "作成して", "コード"))
+    is_prog_request = any(k in inst for k in _PROG_KEYWORDS)
     if is_prog_request:
         init_status = "🤖 プログラム作成中…"
     else:
@@ -2081,16 +3110,45 @@ async def _run_agent_impl(channel, author_id, instruction):
         except asyncio.CancelledError:
             pass
 
+    run_outcome = "done"
+    step_span = None
+    tool_span = None
     try:
         timeout_sec = None if is_prog_request else LLM_RESPONSE_TIMEOUT_SEC
-        autonomous_continuation_count = 0  # 自立型: 「続けて」注入の回数
-        for step in range(80):  # 自律的にツールを続けられるよう多めに
+        for step in range(start_step, 80):  # 自律的にツールを続けられるよう多めに
+            if step_span is not None:
+                step_span.end()
+            step_span = _tracer.start("step", step=step)
+            # ステップ境界: 自律実行中に対話が来ていれば、途中経過を持たせて中断し対話に譲る
+            if background and _should_yield_to_interactive(channel.id):
+                await post_monitor(bot, "自律実行を中断", f"step {step}: 対話を優先します")
+                if processing_msg:
+                    try:
+                        await processing_msg.edit(content="⏸️ 対話を優先するため、自律タスクを一時中断しました（あとで再開します）。")
+                    except Exception:
+                        pass
+                raise AgentRunSuspended(_make_checkpoint(step))
+            # ステップ境界: 実行中に届いた追加の指示があれば、まとめて1件のユーザーメッセージとして注入
+            injected = _inbox_drain(channel.id) if step > start_step else ""
+            if injected:
+                messages.append({"role": "user", "content": "【実行中に届いた追加の指示】\n" + injected})
+                autonomous_continuation_count = 0
+                await post_monitor(bot, "追加の指示を注入", injected[:300])
+            # 振り分け: この実行でツールを使ったら以降は解答用モデル（ツールの多い作業は大きいモデルで続ける）
+            used_tools = any(m.get("tool_calls") for m in messages[1 + history_len:])
+            route = _choose_route(instruction, use_autonomous_loop, background, is_prog_request, used_tools)
+            step_span.set(route=route)
             progress_task = asyncio.create_task(_progress_updater(25))
+            step_calls = []  # スレッドが呼び出しごとに追加する
             try:
-                msg, thinking = await asyncio.wait_for(
-                    asyncio.to_thread(_call_llm, messages, system_content),
+                msg, thinking, calls = await asyncio.wait_for(
+                    _call_llm_in_lane(source, channel.id, messages, system_content, route, first_step=step == 0, calls=step_calls),
                     timeout=timeout_sec,
                 )
+                run_metrics.add_step(step, calls)
+            except asyncio.TimeoutError:
+                run_metrics.add_step(step, list(step_calls), timeout=True)  # 終わっていた呼び出しの分とタイムアウトを残す
+                raise
             finally:
                 progress_task.cancel()
                 try:
@@ -2098,7 +3156,7 @@ async def _run_agent_impl(channel, author_id, instruction):
                 except asyncio.CancelledError:
                     pass
             try:
-                pass  # msg, thinking は上で取得済み
+                pass  # msg, thinking, calls は上で取得済み
             except asyncio.TimeoutError:
                 if typing_task:
                     typing_task.cancel()
@@ -2181,20 +3239,12 @@ async def _run_agent_impl(channel, author_id, instruction):
                     # 自立型エージェント: ループモードでない場合はここで終了（簡潔応答）
                     if not use_autonomous_loop:
                         append_daily_log(f"依頼対応: {stripped_instruction[:80]}")
-                        try:
-                            new_part = messages[1 + history_len:]
-                            _channel_history[channel.id] = (history + new_part)[-MAX_HISTORY_MESSAGES:]
-                        except Exception:
-                            pass
+                        _remember_turn()
                         return
                     # 完了フレーズなら終了、そうでなければ「続けて」を注入してループ継続
                     if _is_completion_phrase(content):
                         append_daily_log(f"依頼対応: {stripped_instruction[:80]}")
-                        try:
-                            new_part = messages[1 + history_len:]
-                            _channel_history[channel.id] = (history + new_part)[-MAX_HISTORY_MESSAGES:]
-                        except Exception:
-                            pass
+                        _remember_turn()
                         return
                     if autonomous_continuation_count < MAX_AUTONOMOUS_CONTINUATIONS:
                         messages.append({"role": "user", "content": CONTINUATION_PROMPT})
@@ -2202,17 +3252,14 @@ async def _run_agent_impl(channel, author_id, instruction):
                         continue  # 次の step で LLM を再度呼ぶ
                     # 継続回数上限に達したら終了
                     append_daily_log(f"依頼対応: {stripped_instruction[:80]}")
-                    try:
-                        new_part = messages[1 + history_len:]
-                        _channel_history[channel.id] = (history + new_part)[-MAX_HISTORY_MESSAGES:]
-                    except Exception:
-                        pass
+                    _remember_turn()
                     return
 
             for tool in tool_calls_list:
                 name = tool['function']['name']
                 args = parse_tool_args(tool['function'].get('arguments'))
                 await post_monitor(bot, f"実行: {name}", str(args)[:300])
+                tool_span = _tracer.start("tool", tool=name)
                 if name == 'list_files':
                     result = list_files()
                 elif name == 'web_search':
@@ -2241,7 +3288,9 @@ async def _run_agent_impl(channel, author_id, instruction):
                         finally:
                             safe_remove(shot_path)
                 elif name == 'list_skills':
-                    result = list_skills()
+                    result = list_skills(max_items=SKILLS_LIST_MAX_ITEMS)
+                elif name == 'search_skills':
+                    result = search_skills(args.get('query', ''), args.get('max_results', 5))
                 elif name == 'read_skill':
                     result = read_skill(args.get('skill_name', ''))
                 elif name == 'save_skill':
@@ -2270,6 +3319,9 @@ async def _run_agent_impl(channel, author_id, instruction):
                     fn_w = args.get('filename', '')
                     content_w = args.get('content', '') or ''
                     result = write_file(fn_w, content_w)
+                    if fn_w.replace("\\", "/").startswith("tools/"):
+                        _custom_tools.refresh()
+                        _sync_custom_tools()  # 自作ツールを次のステップから呼べるようにする
                 elif name == 'run_script':
                     fn = args.get('filename', '')
                     try:
@@ -2291,9 +3343,9 @@ async def _run_agent_impl(channel, author_id, instruction):
                             await channel.send("🤖 **実行時の画面**", file=discord.File(shot_path, filename="execution_screenshot.png"))
                         finally:
                             safe_remove(shot_path)
-                elif name in CUSTOM_TOOL_RUNNERS:
+                elif name in _custom_tools:
                     try:
-                        result = CUSTOM_TOOL_RUNNERS[name](args)
+                        result = await _call_custom_tool(name, args)
                     except Exception as e:
                         result = f"カスタムツール実行エラー: {e}"
                 elif name in MCP_TOOL_NAMES and mcp_call_tool is not None:
@@ -2303,32 +3355,142 @@ async def _run_agent_impl(channel, author_id, instruction):
                 if is_prog_request and name in ("write_file", "run_script", "save_skill"):
                     completed_prog_steps.add(name)
                 messages.append({"role": "tool", "tool_name": name, "content": result})
+                tool_span.set(result_chars=len(result or "")).end()
+            # ツール実行ごとに途中経過を保存（再起動・クラッシュ後はここから再開できる）。
+            # 途中経過はループ上で作り、JSON 化と書き込みはイベントループを止めないようスレッドで行う
+            if checkpoint_id:
+                await asyncio.to_thread(_save_run_checkpoint, checkpoint_id, _make_checkpoint(step + 1))
+    except AgentRunSuspended:
+        run_outcome = "suspended"
+        raise
+    except BaseException:
+        run_outcome = "error"
+        raise
     finally:
+        for span in (tool_span, step_span):
+            if span is not None:
+                span.end(None if run_outcome == "done" else run_outcome)
         if typing_task and not typing_task.done():
             typing_task.cancel()
             try:
                 await typing_task
             except asyncio.CancelledError:
                 pass
+        await _finish_run_metrics(run_metrics, run_outcome)
 
-@bot.event
-async def on_ready():
-    """起動時に自律ループと不定期レポートループを開始。キューが空なら1件追加。MCP があればバックグラウンドで接続。チャンネル別Webhookスケジューラを開始。"""
+
+async def _finish_run_metrics(run_metrics, outcome):
+    """実行の評価の統計をメトリクスファイルに書き、ターミナル Webhook（モニター）に要約を送る。"""
+    if not run_metrics.steps:
+        return
+    try:
+        task_totals = await asyncio.to_thread(_llm_metrics.finish, run_metrics, outcome)
+        if outcome != "suspended":
+            _llm_metrics.forget_task(run_metrics.task_id)
+        text = f"{len(run_metrics.steps)} ステップ: {format_totals(run_metrics.totals)}"
+        if task_totals["calls"] > run_metrics.totals["calls"]:
+            text += f"\n（タスク合計 {format_totals(task_totals)}）"
+        await post_monitor(bot, "LLM 統計", text)
+    except Exception:
+        pass
+
+_startup_done = False  # on_ready は再接続のたびに来るので、1回だけの初期化はこのフラグで守る
+STARTUP_TIMING_PATH = os.path.join(WORKING_DIR, "startup_timing.json")  # 起動時間の内訳（毎回上書き）
+_startup_timing = {"imports_sec": {}, "steps_sec": {}}
+
+
+def _write_startup_report():
+    """起動時間の内訳を STARTUP_TIMING_PATH に書き、stderr にも要約を出す。"""
+    report = dict(_startup_timing)
+    report["imports_sec"] = {k: round(v, 3) for k, v in sorted(_IMPORT_TIMINGS.items(), key=lambda kv: -kv[1])}
+    report["written_at"] = datetime.now().isoformat(timespec="seconds")
+    try:
+        with open(STARTUP_TIMING_PATH, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    except OSError:
+        pass
+    try:
+        steps = ", ".join(f"{k} {v:.2f}s" for k, v in report["steps_sec"].items())
+        sys.stderr.write(
+            f"[起動] import {report.get('module_loaded_sec', 0):.2f}s → Discord 接続 {report.get('ready_sec', 0):.2f}s"
+            f" → 初期化完了 {report.get('startup_done_sec', 0):.2f}s（{steps}）\n"
+        )
+        sys.stderr.flush()
+    except Exception:
+        pass
+
+
+def _note_first_reply():
+    """起動後、最初にユーザーのメッセージへ応答し終えた時点を記録する。"""
+    if _startup_timing.get("first_reply_sec") is None:
+        _startup_timing["first_reply_sec"] = round(time.perf_counter() - _BOOT_STARTED, 3)
+        _write_startup_report()
+
+
+async def _startup_step(name, aw):
+    """起動時の初期化ステップを1つ実行して所要時間を記録する。失敗しても他のステップは止めない。"""
+    t = time.perf_counter()
+    try:
+        return await aw
+    except Exception as e:
+        try:
+            sys.stderr.write(f"[起動] {name} に失敗しました: {e}\n")
+            sys.stderr.flush()
+        except Exception:
+            pass
+        return None
+    finally:
+        _startup_timing["steps_sec"][name] = round(time.perf_counter() - t, 3)
+
+
+async def _start_queue_and_loops():
+    # 前回のプロセスで実行中のまま止まったタスク・途中経過を回収し、あれば待たずに再開する。
+    # プロセスロックが取れれば他に動いているプロセスはないので、リースが残っていても running はすべて回収する
+    lock_fd = _acquire_process_lock()
+    try:
+        reclaimed = await asyncio.to_thread(queue_reclaim_stale, include_orphans=True, all_running=lock_fd is not None)
+    finally:
+        _release_process_lock(lock_fd)
     if not _load_queue():
         queue_add(CONTINUOUS_CREATION_INSTRUCTION)
-    asyncio.create_task(autonomous_loop(bot))
+    asyncio.create_task(autonomous_loop(bot, initial_delay=0 if reclaimed else None))
     asyncio.create_task(proactive_channel_loop(bot))
     asyncio.create_task(channel_scheduler_loop(bot))
+
+
+@bot.event
+async def on_ready():
+    """起動時に自律ループと不定期レポートループを開始。キューが空なら1件追加。MCP があればバックグラウンドで接続。チャンネル別Webhookスケジューラを開始。
+    互いに依存しない初期化（ワーカー起動・起動通知・RAG 索引・スキル一覧の更新など）は並行に実行し、所要時間を記録する。"""
+    global _startup_done
+    if _startup_done:
+        return  # 再接続で on_ready が再度来ても、ループ・初期化は二重に起動しない
+    _startup_done = True
+    _startup_timing["ready_sec"] = round(time.perf_counter() - _BOOT_STARTED, 3)
+    asyncio.create_task(_clock.run(CLOCK_SYNC_INTERVAL_SEC))
+    asyncio.create_task(_custom_tools.watch(_sync_custom_tools, CUSTOM_TOOLS_POLL_SEC))
+    if start_mcp_background is not None:
+        start_mcp_background(bot, TOOLS)  # キャッシュ済みのツール一覧はここで TOOLS に載る（接続は各サーバーで並行）
+    steps = [("タスク回収・ループ開始", _start_queue_and_loops())]
+    if HAS_OLLAMA:
+        asyncio.create_task(_ollama.run())
+        steps.append(("モデルの読み込み", asyncio.to_thread(_warm_models_at_startup)))  # 最初のメッセージで読み込みを待たないように
+    if _tool_workers is not None:
+        steps.append(("ツールワーカー起動", _tool_workers.start()))  # 初回のツール呼び出しでプロセス起動を待たないように
     if get_webhook_url("terminal"):
-        post_to_channel_webhook(
+        steps.append(("起動通知", asyncio.to_thread(
+            post_to_channel_webhook,
             "terminal",
             "🖥️ Bot起動しました。タスク開始・思考・ツール実行などのログはここに流れます。",
             username="ターミナル",
-        )
-    if start_mcp_background is not None:
-        start_mcp_background(bot, TOOLS)
+        )))
+    if _knowledge_index.available():
+        steps.append(("RAG 索引", asyncio.to_thread(_knowledge_index.context_for, "agent_profile")))  # 索引を先に作っておく
     if get_webhook_url("skills_list") or SKILLS_LIST_CHANNEL_ID:
-        await update_skills_list_in_channel(bot, TOOLS)
+        steps.append(("スキル一覧の更新", update_skills_list_in_channel(bot, TOOLS)))
+    await asyncio.gather(*[_startup_step(name, aw) for name, aw in steps])
+    _startup_timing["startup_done_sec"] = round(time.perf_counter() - _BOOT_STARTED, 3)
+    _write_startup_report()
 
 
 # 同一メッセージの二重処理防止（1タスクで同じ返事が複数来るのを防ぐ）
@@ -2435,6 +3597,75 @@ async def on_message(message):
             pass
         return
 
+    # メモリ状況（チャンネル別の会話履歴・モードのキャッシュ）
+    if content in ("メモリ状況", "キャッシュ状況") or content_lower == "memory stats":
+        try:
+            st = channel_state_stats()
+            h = st["history"]
+            await message.reply(
+                "**メモリ状況（チャンネル別状態）:**\n"
+                f"・常駐: {st['resident_bytes'] / 1024:.1f} KB（上限 {h['max_bytes'] / 1024:.0f} KB / {h['max_channels']} チャンネル）\n"
+                f"・会話履歴: {h['channels']} チャンネル、ヒット {h['hits']} / ミス {h['misses']} / 破棄 {h['evictions']}\n"
+                f"・モード設定: {st['modes']['channels']} チャンネル、受け皿: {st['inbox_channels']} チャンネル"
+            )
+        except Exception:
+            pass
+        return
+
+    # Ollama ホストの状況（OLLAMA_HOSTS のヘルスチェック・実行中の数）と LLM ゲートウェイの待ち時間
+    if content in ("Ollama状況", "ホスト状況") or content_lower == "ollama status":
+        try:
+            if _ollama is None:
+                await message.reply("Ollama が利用できません。")
+                return
+            lines = ["**Ollama ホスト:**"]
+            for h in _ollama.stats():
+                state = "✅" if h["healthy"] else "❌"
+                models = f"モデル {h['models']} 個" if h["models"] is not None else "モデル未確認"
+                line = f"{state} {h['url']}: 実行中 {h['active']}・呼び出し {h['requests']} 回・失敗 {h['failures']} 回・{models}"
+                if not h["healthy"] and h["last_error"]:
+                    line += f"（{h['last_error'][:100]}）"
+                lines.append(line)
+            c = _llm_cache.stats()
+            if c["mode"] != "off":
+                lines.append(f"**応答キャッシュ（{c['mode']}）:** ヒット {c['hits']} / ミス {c['misses']}・{c['entries'] or 0} 件・{c['bytes'] / 1024:.0f} KB")
+            g = _llm_gateway.stats()
+            lines.append(f"**LLM の待ち:** 同時実行 {g['active']}/{g['slots']}・待ち {g['queued']} 件")
+            for kind, st in g["sources"].items():
+                lines.append(f"・{kind}: {st['count']} 回・平均 {st['mean_wait_sec']:.1f} 秒・p50 {st['p50_wait_sec']:.1f} 秒・p90 {st['p90_wait_sec']:.1f} 秒・最大 {st['max_wait_sec']:.1f} 秒")
+            await message.reply("\n".join(lines))
+        except Exception:
+            pass
+        return
+
+    # 起動時間の内訳
+    if content in ("起動時間", "起動レポート") or content_lower == "startup report":
+        try:
+            t = _startup_timing
+            lines = [
+                "**起動時間の内訳:**",
+                f"・import・初期化: {t.get('module_loaded_sec', 0):.2f} 秒（" + "、".join(f"{k} {v:.2f}s" for k, v in sorted(_IMPORT_TIMINGS.items(), key=lambda kv: -kv[1])) + "）",
+                f"・Discord 接続完了: {t.get('ready_sec', 0):.2f} 秒",
+                f"・初期化完了: {t.get('startup_done_sec', 0):.2f} 秒（" + "、".join(f"{k} {v:.2f}s" for k, v in t["steps_sec"].items()) + "）",
+            ]
+            if t.get("first_reply_sec") is not None:
+                lines.append(f"・最初の応答完了: {t['first_reply_sec']:.2f} 秒")
+            if _single_model_reason:
+                lines.append(f"・1モデル運用中（思考も {OLLAMA_MODEL_OUTPUT}）: {_single_model_reason}")
+            elif _models.swaps:
+                lines.append(f"・モデルの入れ替え: {_models.swaps} 回（読み込み計 {_models.swap_load_sec:.1f} 秒）")
+            for model, st in _models.stats().items():
+                lines.append(f"・{model}: 読み込み {st['cold_loads']} 回（直近 {st['last_load_sec']:.1f} 秒・合計 {st['total_load_sec']:.1f} 秒）/ 呼び出し {st['requests']} 回")
+            for model, st in _context_sizer.stats().items():
+                last = st["last"] or {}
+                lines.append(f"・{model}: num_ctx {st['bucket']}（直近 推定 {last.get('estimate', '?')} / 実際 {last.get('prompt_eval_count', '?')} トークン・補正 {st['ratio']:.2f} 倍）")
+            for route, st in _route_stats.summary().items():
+                lines.append(f"・応答時間 {route}（{st['model']}）: {st['count']} 回・平均 {st['mean_sec']:.1f} 秒・p50 {st['p50_sec']:.1f} 秒・p90 {st['p90_sec']:.1f} 秒・最大 {st['max_sec']:.1f} 秒")
+            await message.reply("\n".join(lines))
+        except Exception:
+            pass
+        return
+
     # キューキャンセル（番号またはID）
     if content.startswith("キューキャンセル ") or content.lower().startswith("queue cancel "):
         rest = content.split(maxsplit=2)[-1].strip()
@@ -2455,6 +3686,7 @@ async def on_message(message):
         await run_agent(message.channel, message.author.id, message.content)
     except Exception:
         pass
+    _note_first_reply()
 
 # 起動時に利用可能なバックエンドをログ出力（stderr で即出るように）
 skip_thinking_note = "（応答を速くするには .env に OLLAMA_SKIP_THINKING=1）" if (HAS_OLLAMA and not OLLAMA_SKIP_THINKING) else ""
@@ -2463,4 +3695,6 @@ print(msg, flush=True)
 sys.stderr.write(msg + "\n")
 sys.stderr.flush()
 
-bot.run(TOKEN)
\ No newline at end of file
+_startup_timing["module_loaded_sec"] = round(time.perf_counter() - _BOOT_STARTED, 3)
+if __name__ == "__main__":
+    bot.run(TOKEN)
@@ -3,14 +3,29 @@
 # 用法: python check_mcp.py
 # - mcp が import できるか、project/mcp_servers.json または MCP_SERVER_CMD が設定されているか、
 #   設定されていれば実際に接続してツール一覧を取得できるかを表示する。
+#
+# ベンチマーク: python check_mcp.py --bench [--config project/mcp_bench.json] [--concurrency 1,4,8] [--iterations 20] [--report mcp_bench_report.json]
+# - サーバーごとに起動（プロセス生成から最初の応答まで）・ping・list_tools の時間と、設定ファイルで指定したツールの call_tool の
+#   レイテンシ（p50/p90/p99）を同時実行数ごとに測り、JSON レポートを書き出す。
+# - 設定ファイル（JSON）の形式:
+#     {"calls": {"ツール名": {サンプル引数}, ...}, "servers": [{"command": ..., "args": [...]}]}
+#   "servers" を省略すると mcp_servers.json / MCP_SERVER_CMD のサーバーを使う。
+# - python check_mcp.py --bench-stub で、同梱のスタブ MCP サーバー（python check_mcp.py --stub-server）を相手に動作確認できる。
 
+import argparse
 import asyncio
+import importlib.util
 import json
+import math
 import os
+import platform
 import sys
+import time
+from datetime import datetime
 
 _PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "project")
 _MCP_SERVERS_JSON = os.path.join(_PROJECT_DIR, "mcp_servers.json")
+_MCP_BENCH_JSON = os.path.join(_PROJECT_DIR, "mcp_bench.json")
 
 
 def _load_config():
@@ -41,7 +56,7 @@ def _load_config():
     return [(parts[0], parts[1:])] if parts else []
 
 
-def main():
+def check():
     print("=== MCP 接続チェック ===\n")
     print(f"Python: {sys.version.split()[0]}")
     if sys.version_info < (3, 10):
@@ -108,5 +123,232 @@ def main():
     print("=== チェック終了 ===")
 
 
+
+# --- ベンチマーク ---
+
+def _percentile(sorted_values, pct):
+    """nearest-rank 方式のパーセンタイル。"""
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def _stats(values_ms):
+    """ミリ秒のリストから count / mean / p50 / p90 / p99 / max を作る。"""
+    v = sorted(values_ms)
+    if not v:
+        return {"count": 0}
+    return {
+        "count": len(v),
+        "mean": round(sum(v) / len(v), 3),
+        "p50": round(_percentile(v, 50), 3),
+        "p90": round(_percentile(v, 90), 3),
+        "p99": round(_percentile(v, 99), 3),
+        "max": round(v[-1], 3),
+    }
+
+
+def _load_bench_config(path):
+    """ベンチマーク設定を読む。戻り値: (calls dict, [(command, args), ...] または None)。"""
+    if not path or not os.path.isfile(path):
+        return {}, None
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    calls = data.get("calls") or {}
+    servers = None
+    if isinstance(data.get("servers"), list):
+        servers = []
+        for item in data["servers"]:
+            if isinstance(item, dict) and item.get("command"):
+                args = item.get("args") or []
+                if not isinstance(args, list):
+                    args = [str(args)]
+                servers.append((str(item["command"]).strip(), [str(a) for a in args]))
+    return calls, servers
+
+
+async def _bench_call_tool(session, tool, args, iterations, concurrency):
+    """call_tool を iterations 回、concurrency 並列で実行してレイテンシを測る。"""
+    latencies = []
+    errors = 0
+    counter = iter(range(iterations))
+
+    async def worker():
+        nonlocal errors
+        for _ in counter:
+            t0 = time.perf_counter()
+            try:
+                result = await session.call_tool(tool, args)
+                if getattr(result, "isError", False):
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(max(1, concurrency))])
+    elapsed = time.perf_counter() - started
+    return {
+        "tool": tool,
+        "concurrency": concurrency,
+        "iterations": iterations,
+        "errors": errors,
+        "latency_ms": _stats(latencies),
+        "throughput_per_sec": round(iterations / elapsed, 2) if elapsed > 0 else None,
+    }
+
+
+async def _bench_server(command, args, calls, iterations, concurrency_levels, spawn_runs):
+    from mcp import ClientSession
+    from mcp.client.stdio import stdio_client, StdioServerParameters
+
+    label = " ".join([command] + list(args))
+    report = {"server": label, "startup_ms": None, "ping_ms": None, "list_tools_ms": None, "tool_count": 0, "calls": []}
+    startup, ping, listing = [], [], []
+    with open(os.devnull, "w") as devnull:
+        try:
+            for run in range(max(1, spawn_runs)):
+                # 起動・ping・list_tools は毎回プロセスを立ち上げ直して測る。call_tool は最後の接続で測る
+                # 起動はプロセスの生成から initialize の応答（サーバーの最初の応答）まで。インタプリタ・サーバーの起動を含む
+                t0 = time.perf_counter()
+                async with stdio_client(StdioServerParameters(command=command, args=args), errlog=devnull) as (read_stream, write_stream):
+                    async with ClientSession(read_stream, write_stream) as session:
+                        await session.initialize()
+                        t1 = time.perf_counter()
+                        await session.send_ping()  # 起動後の1往復（プロトコルだけの時間）
+                        t2 = time.perf_counter()
+                        result = await session.list_tools()
+                        t3 = time.perf_counter()
+                        startup.append((t1 - t0) * 1000)
+                        ping.append((t2 - t1) * 1000)
+                        listing.append((t3 - t2) * 1000)
+                        tools = getattr(result, "tools", None) or []
+                        names = {getattr(t, "name", None) for t in tools}
+                        report["tool_count"] = len(tools)
+                        if run < max(1, spawn_runs) - 1:
+                            continue
+                        for tool, sample_args in calls.items():
+                            if tool not in names:
+                                continue
+                            await session.call_tool(tool, sample_args or {})  # 1回目（ウォームアップ）は除外
+                            for c in concurrency_levels:
+                                report["calls"].append(await _bench_call_tool(session, tool, sample_args or {}, iterations, c))
+        except Exception as e:
+            report["error"] = f"{type(e).__name__}: {e}"
+    report["startup_ms"] = _stats(startup)
+    report["ping_ms"] = _stats(ping)
+    report["list_tools_ms"] = _stats(listing)
+    return report
+
+
+def _print_bench_report(report):
+    for srv in report["servers"]:
+        print(f"■ {srv['server']}")
+        if srv.get("error"):
+            print(f"   ❌ エラー: {srv['error']}")
+        for key, title in (("startup_ms", "起動〜初応答"), ("ping_ms", "ping"), ("list_tools_ms", "list_tools")):
+            st = srv.get(key) or {}
+            if st.get("count"):
+                print(f"   {title:<12} p50 {st['p50']:>9.1f} ms   max {st['max']:>9.1f} ms   (n={st['count']})")
+        for c in srv["calls"]:
+            st = c["latency_ms"]
+            if not st.get("count"):
+                continue
+            print(
+                f"   call {c['tool']} x{c['concurrency']:<3} p50 {st['p50']:>8.1f}  p90 {st['p90']:>8.1f}  p99 {st['p99']:>8.1f} ms"
+                f"   {c['throughput_per_sec']}/s   エラー {c['errors']}/{c['iterations']}"
+            )
+        print()
+
+
+def bench(config_path, concurrency_levels, iterations, spawn_runs, report_path, servers=None, calls=None):
+    print("=== MCP ベンチマーク ===\n")
+    if importlib.util.find_spec("mcp") is None:
+        print("❌ mcp パッケージ: 利用できません（pip install mcp）")
+        return 1
+    config_calls, bench_servers = _load_bench_config(config_path)
+    # calls を渡されたとき（--bench-stub）は設定ファイルの calls ではなくそちらを測る
+    calls = (config_calls if calls is None else calls) or {}
+    servers = servers or bench_servers or _load_config()
+    if not servers:
+        print("⚠️  ベンチマークするサーバーがありません（mcp_servers.json / MCP_SERVER_CMD / 設定ファイルの servers）。")
+        return 1
+    if not calls:
+        print("ℹ️  calls が未指定のため、起動・ping・list_tools のみ測ります。\n")
+
+    async def run_all():
+        # サーバー同士が干渉しないよう1つずつ測る
+        return [await _bench_server(cmd, args, calls, iterations, concurrency_levels, spawn_runs) for cmd, args in servers]
+
+    report = {
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "iterations": iterations,
+        "concurrency": concurrency_levels,
+        "spawn_runs": spawn_runs,
+        "servers": asyncio.run(run_all()),
+    }
+    _print_bench_report(report)
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📝 レポート: {report_path}")
+    return 0
+
+
+def stub_server():
+    """ベンチマークの動作確認用のスタブ MCP サーバー（stdio）。echo と sleep の2つのツールを持つ。"""
+    try:
+        from mcp.server.fastmcp import FastMCP as _Server
+    except ImportError:
+        from mcp.server.mcpserver import MCPServer as _Server  # mcp 2.x で FastMCP から改名
+
+    server = _Server("check-mcp-stub")
+
+    @server.tool()
+    def echo(text: str = "") -> str:
+        """受け取った text をそのまま返す。"""
+        return text
+
+    @server.tool()
+    async def sleep(ms: int = 10) -> str:
+        """ms ミリ秒待ってから返す。"""
+        await asyncio.sleep(ms / 1000.0)
+        return f"slept {ms}ms"
+
+    server.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MCP 接続の確認・ベンチマーク")
+    parser.add_argument("--bench", action="store_true", help="起動・ping・list_tools・call_tool の時間を測る")
+    parser.add_argument("--bench-stub", action="store_true", help="同梱のスタブ MCP サーバーを相手にベンチマークする")
+    parser.add_argument("--stub-server", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--config", default=_MCP_BENCH_JSON, help="ベンチマーク設定（JSON）。既定: project/mcp_bench.json")
+    parser.add_argument("--concurrency", default="1,4", help="call_tool の同時実行数（カンマ区切り）")
+    parser.add_argument("--iterations", type=int, default=20, help="同時実行数ごとの call_tool の回数")
+    parser.add_argument("--spawn-runs", type=int, default=3, help="起動・ping・list_tools を測る回数")
+    parser.add_argument("--report", default="mcp_bench_report.json", help="JSON レポートの出力先（空文字で出力しない）")
+    opts = parser.parse_args()
+
+    if opts.stub_server:
+        stub_server()
+        return
+    if not (opts.bench or opts.bench_stub):
+        check()
+        return
+    levels = sorted({max(1, int(x)) for x in opts.concurrency.split(",") if x.strip()}) or [1]
+    servers = None
+    calls = None
+    if opts.bench_stub:
+        servers = [(sys.executable, [os.path.abspath(__file__), "--stub-server"])]
+        calls = {"echo": {"text": "ping"}, "sleep": {"ms": 10}}  # スタブ自身のツール
+    code = bench(opts.config, levels, max(1, opts.iterations), max(1, opts.spawn_runs), opts.report or None,
+                 servers=servers, calls=calls)
+    sys.exit(code)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,134 @@
+# Ollama に渡す num_ctx・num_predict を呼び出しごとに決める。
+# プロンプトのトークン数を文字数から見積もり、余裕を足して収まる最小のバケット（2048/4096/8192 など少数の固定値）を選ぶ。
+# num_ctx が変わると Ollama はモデルを読み込み直すので、モデルごとに今のバケットを覚えておき、
+# 大きくするときはすぐ、小さくするのは小さいバケットで足りる呼び出しが続いたときだけにする。
+# 応答の prompt_eval_count（実際のトークン数）と見積もりを比べてログに出し、見積もりの倍率を補正する。
+
+import json
+import os
+import sys
+import threading
+
+from model_residency import _field
+
+# num_ctx の候補（カンマ区切り）。1つだけ書けば固定になる
+OLLAMA_NUM_CTX_BUCKETS = os.environ.get("OLLAMA_NUM_CTX_BUCKETS", "2048,4096,8192")
+NUM_CTX_HEADROOM = 0.15  # 見積もりのずれに備えて足す割合
+NUM_CTX_SHRINK_AFTER = 5  # 小さいバケットで足りる呼び出しがこの回数続いたら小さくする
+MIN_NUM_PREDICT = 256  # プロンプトが大きくても、解答用にこれだけは残す
+_MESSAGE_OVERHEAD = 4  # メッセージ1件ごとのテンプレート分（role など）
+
+
+def parse_buckets(value=OLLAMA_NUM_CTX_BUCKETS):
+    """"2048,4096,8192" を昇順の int のリストにする。読めなければ [8192]。"""
+    out = []
+    for part in (value or "").split(","):
+        try:
+            n = int(part.strip())
+        except ValueError:
+            continue
+        if n > 0 and n not in out:
+            out.append(n)
+    return sorted(out) or [8192]
+
+
+def estimate_tokens(messages, tools=None):
+    """messages（と tools のスキーマ）のおおよそのトークン数。ASCII は約3.5文字で1トークン、日本語などは1文字ほぼ1トークンとみなす。"""
+    ascii_chars = 0
+    other_chars = 0
+    count = 0
+    parts = []
+    for m in messages or []:
+        count += 1
+        parts.append(m.get("content") or "")
+        if m.get("tool_calls"):
+            parts.append(json.dumps(m["tool_calls"], ensure_ascii=False, default=str))
+    if tools:
+        parts.append(json.dumps(tools, ensure_ascii=False, default=str))
+    for text in parts:
+        if not isinstance(text, str):
+            text = str(text)
+        n_ascii = sum(1 for ch in text if ch < "\x80")
+        ascii_chars += n_ascii
+        other_chars += len(text) - n_ascii
+    return int(ascii_chars / 3.5 + other_chars * 0.9) + count * _MESSAGE_OVERHEAD
+
+
+class ContextSizer:
+    """モデルごとに今の num_ctx バケットと見積もりの補正倍率を持ち、呼び出しごとのサイズを決める。"""
+
+    def __init__(self, buckets=None, headroom=NUM_CTX_HEADROOM, shrink_after=NUM_CTX_SHRINK_AFTER):
+        self.buckets = parse_buckets() if buckets is None else sorted(buckets)
+        self._headroom = headroom
+        self._shrink_after = shrink_after
+        self._lock = threading.Lock()
+        self._state = {}  # モデル名 -> {"bucket", "streak", "ratio", "last"}
+
+    def _fit(self, need, max_ctx):
+        allowed = [b for b in self.buckets if b <= max_ctx] or [min(self.buckets[0], max_ctx)]
+        for b in allowed:
+            if b >= need:
+                return b
+        return allowed[-1]
+
+    def choose(self, model, messages, num_predict, max_ctx, tools=None, shrink=True):
+        """(num_ctx, num_predict, 見積もりトークン数) を返す。max_ctx を超えるバケットは新しく選ばない。
+        shrink=False の呼び出し（思考ステップなど）はバケットを小さくする判断に加わらず、今のバケットをそのまま使う。"""
+        raw = estimate_tokens(messages, tools)
+        with self._lock:
+            st = self._state.setdefault(model, {"bucket": None, "streak": 0, "ratio": 1.0, "last": None})
+            estimate = int(raw * st["ratio"])
+            need = int(estimate * (1 + self._headroom)) + num_predict
+            fit = self._fit(need, max_ctx)
+            if st["bucket"] is None or fit > st["bucket"]:
+                st["bucket"] = fit
+                st["streak"] = 0
+            elif fit < st["bucket"] and shrink:
+                st["streak"] += 1
+                if st["streak"] >= self._shrink_after:
+                    st["bucket"] = fit
+                    st["streak"] = 0
+            elif shrink:
+                st["streak"] = 0
+            num_ctx = st["bucket"]
+        room = num_ctx - int(estimate * (1 + self._headroom))
+        return num_ctx, max(MIN_NUM_PREDICT, min(num_predict, room)), estimate
+
+    def note_response(self, model, response, num_ctx, num_predict, estimate, label=""):
+        """応答の prompt_eval_count と見積もりを比べてログに出し、補正倍率を更新する。
+        キャッシュが効いた応答は prompt_eval_count が小さく出るので、大きく下回った分は補正に使わない。"""
+        actual = _field(response, "prompt_eval_count") or 0
+        try:
+            actual = int(actual)
+        except (TypeError, ValueError):
+            actual = 0
+        with self._lock:
+            st = self._state.setdefault(model, {"bucket": num_ctx, "streak": 0, "ratio": 1.0, "last": None})
+            if actual > 0 and estimate > 0:
+                raw = estimate / st["ratio"]
+                r = actual / raw
+                if r > st["ratio"]:
+                    st["ratio"] = round(0.5 * st["ratio"] + 0.5 * r, 3)
+                elif r > 0.7 * st["ratio"]:
+                    st["ratio"] = round(0.9 * st["ratio"] + 0.1 * r, 3)
+            st["last"] = {"num_ctx": num_ctx, "num_predict": num_predict, "estimate": estimate, "prompt_eval_count": actual}
+        try:
+            generated = int(_field(response, "eval_count") or 0)
+        except (TypeError, ValueError):
+            generated = 0
+        over = " ⚠️ num_ctx を超えました" if actual + generated >= num_ctx else ""
+        try:
+            sys.stderr.write(
+                f"[Ollama] {model}{'・' + label if label else ''}: num_ctx {num_ctx}・num_predict {num_predict}"
+                f"（推定 {estimate} / 実際 {actual or '?'} トークン）{over}\n"
+            )
+            sys.stderr.flush()
+        except Exception:
+            pass
+        return actual
+
+    def stats(self):
+        with self._lock:
+            return {m: {"bucket": st["bucket"], "ratio": st["ratio"], "last": dict(st["last"]) if st["last"] else None}
+                    for m, st in self._state.items()}
+
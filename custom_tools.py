@@ -0,0 +1,214 @@
+# カスタムツール（project/tools/*.py）の読み込み。
+# TOOL_NAME / TOOL_DESCRIPTION / TOOL_PARAMS はモジュール本体を実行せずに静的解析（ast）で読み、
+# run(args) を持つモジュールは初回呼び出し時に import する。ファイルの mtime・サイズが変わったら読み直す。
+# async def run(args) も使える（読み込み時に判別し、そのまま await する。同期の run はスレッドで動かす）。
+
+import ast
+import asyncio
+import importlib.util
+import inspect
+import os
+import sys
+
+_DEFAULT_PARAMS = {"type": "object", "properties": {}, "required": []}
+_META_NAMES = ("TOOL_NAME", "TOOL_DESCRIPTION", "TOOL_PARAMS")
+
+
+def _file_sig(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _parse_tool_file(path):
+    """ツールファイルを実行せずに解析し、(メタ情報 dict, run の有無, run が async def か) を返す。
+    リテラルで書かれていない値は dict に入らない（呼び出し側で import して補う）。"""
+    with open(path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=path)
+    meta = {}
+    has_run = False
+    is_async = False
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == "run":
+            has_run = True
+            is_async = isinstance(node, ast.AsyncFunctionDef)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id in _META_NAMES:
+                    try:
+                        meta[target.id] = ast.literal_eval(node.value)
+                    except ValueError:
+                        meta.pop(target.id, None)
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name) and node.target.id in _META_NAMES and node.value is not None:
+            try:
+                meta[node.target.id] = ast.literal_eval(node.value)
+            except ValueError:
+                pass
+    return meta, has_run, is_async
+
+
+class _ToolEntry:
+    __slots__ = ("fname", "path", "sig", "name", "schema", "module", "run_fn", "is_async")
+
+    def __init__(self, fname, path, sig, name, schema):
+        self.fname = fname
+        self.path = path
+        self.sig = sig
+        self.name = name
+        self.schema = schema
+        self.module = None  # 初回呼び出しまで import しない
+        self.run_fn = None
+        self.is_async = False
+
+
+class CustomToolRegistry:
+    """project/tools のツール一覧。schemas（Ollama の function 形式）と names は refresh のたびに丸ごと差し替える。"""
+
+    def __init__(self, directory):
+        self._dir = directory
+        self._entries = {}  # ファイル名 -> _ToolEntry
+        self._by_name = {}  # ツール名 -> _ToolEntry
+        self.schemas = []
+        self.version = 0  # 一覧が変わるたびに増える（呼び出し時の読み直しで変わった分も含む）
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    @property
+    def names(self):
+        return set(self._by_name)
+
+    def refresh(self):
+        """ファイルの追加・変更・削除を反映する。戻り値: 一覧が変わったか。"""
+        found = {}
+        if os.path.isdir(self._dir):
+            for fname in sorted(os.listdir(self._dir)):
+                if not fname.endswith(".py") or fname.startswith("_"):
+                    continue
+                path = os.path.join(self._dir, fname)
+                if os.path.isfile(path):
+                    try:
+                        found[fname] = (path, _file_sig(path))
+                    except OSError:
+                        continue
+        changed = set(found) != set(self._entries)
+        entries = {}
+        for fname, (path, sig) in found.items():
+            old = self._entries.get(fname)
+            if old is not None and old.sig == sig:
+                entries[fname] = old
+                continue
+            changed = True
+            entry = self._build_entry(fname, path, sig)
+            if entry is not None:
+                entries[fname] = entry
+        if not changed:
+            return False
+        by_name = {}
+        for entry in entries.values():
+            by_name.setdefault(entry.name, entry)
+        # 参照の差し替えだけで切り替える（呼び出し中のスレッドは古い一覧をそのまま使える）
+        self._entries = entries
+        self._by_name = by_name
+        self.schemas = [e.schema for e in by_name.values()]
+        self.version += 1
+        return True
+
+    def _build_entry(self, fname, path, sig):
+        try:
+            meta, has_run, is_async = _parse_tool_file(path)
+        except (OSError, SyntaxError, ValueError) as e:
+            sys.stderr.write(f"[カスタムツール] {fname} を解析できません: {e}\n")
+            return None
+        entry = _ToolEntry(fname, path, sig, None, None)
+        if not has_run or any(k not in meta for k in _META_NAMES):
+            # run が別名で代入されている・TOOL_PARAMS を計算で作っているなどは静的に読めないので import する
+            if not self._import(entry):
+                return None
+            mod = entry.module
+            for k in _META_NAMES:
+                if k not in meta and hasattr(mod, k):
+                    meta[k] = getattr(mod, k)
+            if not callable(entry.run_fn):
+                return None
+            is_async = inspect.iscoroutinefunction(entry.run_fn)
+        entry.is_async = is_async
+        name = meta.get("TOOL_NAME") or fname[:-3]
+        desc = meta.get("TOOL_DESCRIPTION") or f"カスタムツール: {name}"
+        params = meta.get("TOOL_PARAMS") or dict(_DEFAULT_PARAMS)
+        entry.name = name
+        entry.schema = {
+            "type": "function",
+            "function": {"name": name, "description": desc, "parameters": params},
+        }
+        return entry
+
+    def _import(self, entry):
+        try:
+            spec = importlib.util.spec_from_file_location(f"custom_tool_{entry.fname[:-3]}", entry.path)
+            mod = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(mod)
+        except Exception as e:
+            sys.stderr.write(f"[カスタムツール] {entry.fname} の読み込みエラー: {e}\n")
+            entry.module = None
+            entry.run_fn = None
+            return False
+        entry.module = mod
+        entry.run_fn = getattr(mod, "run", None)
+        return True
+
+    def resolve(self, name):
+        """ツール名の (ファイルパス, sig, async か) を返す。ファイルが変わっていれば一覧を読み直してから返す。"""
+        entry = self._resolve_entry(name)
+        return (entry.path, entry.sig, entry.is_async) if entry is not None else None
+
+    def _resolve_entry(self, name):
+        entry = self._by_name.get(name)
+        if entry is None:
+            return None
+        try:
+            stale = _file_sig(entry.path) != entry.sig
+        except OSError:
+            stale = False
+        if stale:
+            self.refresh()
+            entry = self._by_name.get(name)
+        return entry
+
+    def get_runner(self, name):
+        """ツール名の run 関数を返す。未 import なら import し、ファイルが変わっていれば読み直す。"""
+        entry = self._resolve_entry(name)
+        if entry is None:
+            return None
+        if entry.module is None and not self._import(entry):
+            raise RuntimeError(f"{entry.fname} を読み込めませんでした")
+        if not callable(entry.run_fn):
+            raise RuntimeError(f"{entry.fname} に run(args) がありません")
+        return entry.run_fn
+
+    async def call(self, name, args):
+        """ツールをこのプロセスで実行して結果（文字列）を返す。async の run は await し、同期の run はスレッドで動かす。"""
+        run_fn = self.get_runner(name)
+        if run_fn is None:
+            return f"不明なカスタムツールです: {name}"
+        if inspect.iscoroutinefunction(run_fn):
+            return await run_fn(args)
+        result = await asyncio.to_thread(run_fn, args)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def watch(self, on_change, interval_sec=5):
+        """interval_sec ごとにフォルダを確認し、一覧が変わっていれば on_change() を呼ぶ。"""
+        seen = self.version
+        while True:
+            try:
+                await asyncio.sleep(interval_sec)
+            except asyncio.CancelledError:
+                break
+            try:
+                self.refresh()
+                if self.version != seen:
+                    seen = self.version
+                    on_change()
+            except Exception as e:
+                sys.stderr.write(f"[カスタムツール] 再読み込みエラー: {e}\n")
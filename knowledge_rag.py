@@ -0,0 +1,185 @@
+# ナレッジ検索（RAG）。project/knowledge の .md（agent_profile.md・スキル・agent_memo.md を含む）を
+# Ollama の埋め込みモデルでベクトル化し、NumPy 配列としてディスクに保存する。
+# ファイルの mtime・サイズが変わった分だけ埋め込み直し、タスクごとに関連の高いチャンクだけをプロンプトに入れる。
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    np = None
+    HAS_NUMPY = False
+
+try:
+    import ollama
+    HAS_OLLAMA = True
+except ImportError:
+    ollama = None
+    HAS_OLLAMA = False
+
+OLLAMA_EMBED_MODEL = os.environ.get("OLLAMA_EMBED_MODEL", "nomic-embed-text")
+RAG_ENABLED = os.environ.get("RAG_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+RAG_TOP_K = int(os.environ.get("RAG_TOP_K", "4"))
+RAG_MIN_SCORE = float(os.environ.get("RAG_MIN_SCORE", "0.3"))  # コサイン類似度がこれ未満のチャンクは入れない
+RAG_CHUNK_CHARS = 600  # 1チャンクの目安の文字数
+RAG_RETRY_SEC = 10 * 60  # 埋め込みに失敗したら（モデル未導入など）この間は使わずに全文プロフィールへフォールバック
+
+
+def _file_sig(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _chunk_markdown(text, max_chars=RAG_CHUNK_CHARS):
+    """見出し・空行で段落に分け、max_chars 前後にまとめる。見出しは続く段落の先頭に残す。"""
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n|\n(?=#)", text or "") if p.strip()]
+    chunks = []
+    buf = ""
+    for p in paragraphs:
+        while len(p) > max_chars:
+            if buf:
+                chunks.append(buf)
+                buf = ""
+            chunks.append(p[:max_chars])
+            p = p[max_chars:]
+        if buf and len(buf) + len(p) + 1 > max_chars:
+            chunks.append(buf)
+            buf = ""
+        buf = (buf + "\n" + p) if buf else p
+    if buf:
+        chunks.append(buf)
+    return chunks
+
+
+def _embed(texts):
+    """Ollama でテキスト群を埋め込み、正規化済みの float32 行列を返す。"""
+    if hasattr(ollama, "embed"):
+        res = ollama.embed(model=OLLAMA_EMBED_MODEL, input=texts)
+        vecs = res.get("embeddings") if isinstance(res, dict) else getattr(res, "embeddings", None)
+    else:
+        vecs = [ollama.embeddings(model=OLLAMA_EMBED_MODEL, prompt=t)["embedding"] for t in texts]
+    mat = np.asarray(vecs, dtype=np.float32)
+    if mat.ndim != 2 or mat.shape[0] != len(texts):
+        raise ValueError("埋め込みの形が不正です")
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
+
+
+class KnowledgeIndex:
+    """knowledge フォルダのチャンクとベクトルの索引。meta.json（チャンク情報）と vectors.npy（行列）で保存する。"""
+
+    def __init__(self, source_dir, store_dir):
+        self._source_dir = source_dir
+        self._store_dir = store_dir
+        self._meta_path = os.path.join(store_dir, "meta.json")
+        self._vec_path = os.path.join(store_dir, "vectors.npy")
+        self._lock = threading.Lock()
+        self._files = {}  # ファイル名 -> sig
+        self._chunks = []  # [{"source", "text"}]（行列の行と同じ順）
+        self._vectors = None
+        self._model = OLLAMA_EMBED_MODEL
+        self._disabled_until = 0.0
+        self._loaded = False
+
+    def available(self):
+        return RAG_ENABLED and HAS_NUMPY and HAS_OLLAMA and time.time() >= self._disabled_until
+
+    def _load(self):
+        self._loaded = True
+        try:
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            vectors = np.load(self._vec_path)
+        except (OSError, ValueError):
+            return
+        if meta.get("model") != self._model or len(meta.get("chunks") or []) != len(vectors):
+            return  # モデルが変わった・壊れている → 作り直す
+        self._files = meta.get("files") or {}
+        self._chunks = meta["chunks"]
+        self._vectors = vectors
+
+    def _save(self):
+        os.makedirs(self._store_dir, exist_ok=True)
+        tmp_vec = self._vec_path + ".tmp.npy"
+        tmp_meta = self._meta_path + ".tmp"
+        vectors = self._vectors if self._vectors is not None else np.zeros((0, 0), dtype=np.float32)
+        np.save(tmp_vec, vectors)
+        with open(tmp_meta, "w", encoding="utf-8") as f:
+            json.dump({"model": self._model, "files": self._files, "chunks": self._chunks}, f, ensure_ascii=False)
+        os.replace(tmp_vec, self._vec_path)
+        os.replace(tmp_meta, self._meta_path)
+
+    def refresh(self):
+        """変わったファイルだけ埋め込み直す。戻り値: 埋め込んだチャンク数。"""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            current = {}
+            if os.path.isdir(self._source_dir):
+                for fname in sorted(os.listdir(self._source_dir)):
+                    path = os.path.join(self._source_dir, fname)
+                    if fname.endswith(".md") and os.path.isfile(path):
+                        current[fname] = _file_sig(path)
+            changed = [f for f, sig in current.items() if self._files.get(f) != sig]
+            removed = [f for f in self._files if f not in current]
+            if not changed and not removed:
+                return 0
+            drop = set(changed) | set(removed)
+            keep_rows = [i for i, c in enumerate(self._chunks) if c["source"] not in drop]
+            chunks = [self._chunks[i] for i in keep_rows]
+            vectors = self._vectors[keep_rows] if self._vectors is not None and keep_rows else None
+            new_chunks = []
+            for fname in changed:
+                try:
+                    with open(os.path.join(self._source_dir, fname), "r", encoding="utf-8") as f:
+                        text = f.read()
+                except OSError:
+                    continue
+                for piece in _chunk_markdown(text):
+                    new_chunks.append({"source": fname, "text": piece})
+            if new_chunks:
+                new_vecs = _embed([f"{c['source'][:-3]}\n{c['text']}" for c in new_chunks])
+                vectors = new_vecs if vectors is None else np.vstack([vectors, new_vecs])
+                chunks.extend(new_chunks)
+            self._chunks = chunks
+            self._vectors = vectors
+            self._files = {f: current[f] for f in current}
+            self._save()
+            return len(new_chunks)
+
+    def search(self, query, top_k=RAG_TOP_K, min_score=RAG_MIN_SCORE):
+        """[(score, source, text), ...] を類似度の高い順に返す。"""
+        self.refresh()
+        with self._lock:
+            if self._vectors is None or not self._chunks:
+                return []
+            q = _embed([query])[0]
+            scores = self._vectors @ q
+            order = np.argsort(-scores)[:max(1, top_k)]
+            return [
+                (float(scores[i]), self._chunks[i]["source"], self._chunks[i]["text"])
+                for i in order
+                if scores[i] >= min_score
+            ]
+
+    def context_for(self, query, top_k=RAG_TOP_K):
+        """プロンプトに入れる関連チャンクのテキスト。使えない・該当なしなら None（呼び出し側は従来どおり全文を使う）。"""
+        if not self.available() or not (query or "").strip():
+            return None
+        try:
+            hits = self.search(query, top_k=top_k)
+        except Exception as e:
+            self._disabled_until = time.time() + RAG_RETRY_SEC
+            sys.stderr.write(f"[RAG] 埋め込みに失敗したため {RAG_RETRY_SEC // 60} 分間は無効にします ({OLLAMA_EMBED_MODEL}): {e}\n")
+            sys.stderr.flush()
+            return None
+        if not hits:
+            return None
+        return "\n\n".join(f"[{source}]\n{text}" for _, source, text in hits)
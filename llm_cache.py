@@ -0,0 +1,140 @@
+# LLM 応答のディスクキャッシュ（完全一致）。キーは (モデル, options, messages, tools) の SHA-256。
+# 同じ入力に同じ応答を返してよい呼び出しだけに使う: temperature 0 の呼び出しと、呼び出し側が明示した呼び出し
+# （最初のステップの思考など）。LLM_CACHE=all ならすべての呼び出しを記録・再生する（ベンチマーク用の固定データ）。
+# 1応答1ファイルで保存し、件数・合計サイズの上限を超えたら最後に使ったのが古いものから消す（ファイルの mtime で LRU）。
+
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+LLM_CACHE = os.environ.get("LLM_CACHE", "off").strip().lower()  # off / on（決定的・明示した呼び出しのみ）/ all（すべて記録・再生）
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "500"))
+LLM_CACHE_MAX_MB = int(os.environ.get("LLM_CACHE_MAX_MB", "50"))
+
+
+def _to_plain(response):
+    """ollama の応答（pydantic のモデルか dict）を JSON にできる dict にする。"""
+    if isinstance(response, dict):
+        return response
+    if hasattr(response, "model_dump"):
+        return response.model_dump()
+    return dict(response)
+
+
+def _normalize(response):
+    """ツール呼び出しのない応答は message.tool_calls が None なので [] にそろえる（呼び出し側がそのまま反復できるように）。"""
+    message = response.get("message") if isinstance(response, dict) else None
+    if isinstance(message, dict) and message.get("tool_calls") is None:
+        message["tool_calls"] = []
+    return response
+
+
+class ResponseCache:
+    """directory に <キー>.json で応答を置く。get / put はスレッドから呼んでよい。"""
+
+    def __init__(self, directory, mode=LLM_CACHE, max_entries=LLM_CACHE_MAX_ENTRIES, max_bytes=LLM_CACHE_MAX_MB * 1024 * 1024):
+        self._dir = directory
+        self.mode = mode if mode in ("on", "all") else "off"
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = None  # キー -> バイト数（古い順）。初回アクセスでディレクトリから作る
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def use_for(self, marked, options=None):
+        """この呼び出しにキャッシュを使うか。marked は呼び出し側が決定的とみなしてよいと明示したもの。"""
+        if self.mode == "all":
+            return True
+        if self.mode != "on":
+            return False
+        return bool(marked) or (options or {}).get("temperature") == 0
+
+    @staticmethod
+    def key(model, options, messages, tools=None):
+        payload = json.dumps(
+            {"model": model, "options": options or {}, "messages": messages, "tools": tools or []},
+            ensure_ascii=False, sort_keys=True, default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._dir, key + ".json")
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        entries = []
+        if os.path.isdir(self._dir):
+            for fname in os.listdir(self._dir):
+                if not fname.endswith(".json"):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self._dir, fname))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, fname[:-5], st.st_size))
+        entries.sort()
+        self._index = OrderedDict((key, size) for _, key, size in entries)
+        self._bytes = sum(self._index.values())
+
+    def get(self, key):
+        """キャッシュ済みの応答（dict）を返す。なければ None。"""
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                self.misses += 1
+                return None
+            path = self._path(key)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    response = json.load(f)
+                os.utime(path)  # 使った順（LRU）は mtime で残す
+            except (OSError, ValueError):
+                self._bytes -= self._index.pop(key, 0)
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+            return _normalize(response)
+
+    def put(self, key, response):
+        try:
+            data = json.dumps(_normalize(_to_plain(response)), ensure_ascii=False, default=str)
+        except Exception:
+            return
+        with self._lock:
+            self._load_index()
+            try:
+                os.makedirs(self._dir, exist_ok=True)
+                tmp = self._path(key) + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(tmp, self._path(key))
+            except OSError as e:
+                sys.stderr.write(f"[LLM キャッシュ] 保存できません: {e}\n")
+                return
+            size = len(data.encode("utf-8"))
+            self._bytes += size - self._index.pop(key, 0)
+            self._index[key] = size
+            while self._index and (len(self._index) > self._max_entries or self._bytes > self._max_bytes):
+                old, old_size = self._index.popitem(last=False)
+                self._bytes -= old_size
+                try:
+                    os.remove(self._path(old))
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "entries": len(self._index) if self._index is not None else None,
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,158 @@
+# LLM 呼び出しの入口（ゲートウェイ）。同時に Ollama へ送る数を slots 個に抑え、待ちはフローごとの重み付き公平キューで順番を決める。
+# フローは「呼び出し元の種類:チャンネル」（例: interactive:123・autonomous:456）。種類ごとの重みで枠を分け合い、
+# 1つのチャンネルや自律実行が連続して呼んでも、他のフローの待ちが後回しにされ続けないようにする（開始時刻公平キュー）。
+# 待ち時間は種類ごとに記録し、stats() で件数・平均・p50/p90・最大を返す。
+
+import asyncio
+import heapq
+import math
+import os
+import time
+from collections import deque
+
+# 種類ごとの重み（大きいほど多く枠を取る）。対話は自律実行より先に通るよう重くしておく
+LLM_FLOW_WEIGHTS = os.environ.get("LLM_FLOW_WEIGHTS", "interactive=8,autonomous=1,proactive=1")
+WAIT_STATS_WINDOW = 200  # p50/p90 を出す直近の件数
+
+
+def parse_weights(value=LLM_FLOW_WEIGHTS):
+    """"interactive=8,autonomous=1" を {種類: 重み} にする。"""
+    weights = {}
+    for part in (value or "").split(","):
+        name, _, w = part.partition("=")
+        try:
+            weight = float(w)
+        except ValueError:
+            continue
+        if name.strip() and weight > 0:
+            weights[name.strip()] = weight
+    return weights
+
+
+def _percentile(ordered, q):
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+class LLMGateway:
+    """slots 個まで同時に通し、空きが出たら仮想開始時刻の最も早い待ちに枠を渡す。
+    フローの次の開始時刻は「前回の開始 + 1/重み」なので、重み8のフローは重み1のフローの8倍の頻度で通る。"""
+
+    def __init__(self, slots=1, weights=None):
+        self.slots = max(1, slots)
+        self._weights = parse_weights() if weights is None else dict(weights)
+        self._active = 0
+        self._vtime = 0.0  # 仮想時刻（最後に通した呼び出しの開始タグ）
+        self._finish = {}  # フロー -> 次に使える仮想時刻
+        self._heap = []  # (開始タグ, 連番, Future, 種類)
+        self._seq = 0
+        self._waits = {}  # 種類 -> deque（待ち秒）
+        self._totals = {}  # 種類 -> [件数, 合計秒, 最大秒]
+
+    def _weight(self, kind):
+        return self._weights.get(kind, 1.0)
+
+    def _tag(self, kind, flow):
+        start = max(self._vtime, self._finish.get(flow, 0.0))
+        self._finish[flow] = start + 1.0 / self._weight(kind)
+        return start
+
+    def _note_wait(self, kind, sec):
+        self._waits.setdefault(kind, deque(maxlen=WAIT_STATS_WINDOW)).append(sec)
+        total = self._totals.setdefault(kind, [0, 0.0, 0.0])
+        total[0] += 1
+        total[1] += sec
+        total[2] = max(total[2], sec)
+
+    async def acquire(self, kind, flow):
+        """kind（interactive / autonomous / proactive など）・flow（チャンネルなど）で枠を待つ。戻り値: 待った秒数。"""
+        started = time.perf_counter()
+        flow_key = f"{kind}:{flow}"
+        start = self._tag(kind, flow_key)
+        if self._active < self.slots:  # 待ちがあるときは枠が埋まっている（空きは release で待ちに直接渡す）
+            self._active += 1
+            self._vtime = max(self._vtime, start)
+            self._note_wait(kind, 0.0)
+            return 0.0
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._heap, (start, self._seq, fut, kind))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # 枠を受け取った直後にキャンセルされたら返す
+            else:
+                fut.cancel()  # ヒープからは release で取り出すときに捨てる
+            raise
+        waited = time.perf_counter() - started
+        self._note_wait(kind, waited)
+        return waited
+
+    def release(self):
+        while self._heap:
+            start, _, fut, _ = heapq.heappop(self._heap)
+            if not fut.done():
+                self._vtime = max(self._vtime, start)
+                fut.set_result(None)  # 枠をそのまま次の待ちに渡す
+                return
+        self._active = max(0, self._active - 1)
+        # 待ちがなくなったら、もう先の仮想時刻を持たないフローの記録を捨てる
+        self._finish = {k: v for k, v in self._finish.items() if v > self._vtime}
+
+    def slot(self, kind, flow):
+        """async with gateway.slot(kind, flow): の形で使う。"""
+        return _Slot(self, kind, flow)
+
+    async def run_in_thread(self, kind, flow, func, *args):
+        """枠を待ってから func(*args) をスレッドで実行する。戻り値: (func の戻り値, 待った秒数)。
+        呼び出し側がキャンセル（タイムアウト）されてもスレッドの処理（Ollama への要求）は止まらないので、
+        枠はスレッドが終わったときに返す（キャンセルのたびに実際の同時実行数が slots を超えないように）。"""
+        waited = await self.acquire(kind, flow)
+        try:
+            fut = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        except BaseException:
+            self.release()
+            raise
+
+        def done(f):
+            self.release()
+            if not f.cancelled():
+                f.exception()  # 呼び出し側が先にキャンセルされていても例外を取り出しておく（未取得の警告を出さない）
+
+        fut.add_done_callback(done)
+        return await asyncio.shield(fut), waited
+
+    def stats(self):
+        sources = {}
+        for kind, waits in self._waits.items():
+            ordered = sorted(waits)
+            count, total, longest = self._totals[kind]
+            sources[kind] = {
+                "count": count,
+                "mean_wait_sec": round(total / count, 3),
+                "p50_wait_sec": round(_percentile(ordered, 0.5), 3),
+                "p90_wait_sec": round(_percentile(ordered, 0.9), 3),
+                "max_wait_sec": round(longest, 3),
+            }
+        return {
+            "slots": self.slots,
+            "active": self._active,
+            "queued": sum(1 for _, _, fut, _ in self._heap if not fut.done()),
+            "sources": sources,
+        }
+
+
+class _Slot:
+    def __init__(self, gateway, kind, flow):
+        self._gateway = gateway
+        self._kind = kind
+        self._flow = flow
+        self.waited = 0.0
+
+    async def __aenter__(self):
+        self.waited = await self._gateway.acquire(self._kind, self._flow)
+        return self
+
+    async def __aexit__(self, *exc):
+        self._gateway.release()
+        return False
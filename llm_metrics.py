@@ -0,0 +1,163 @@
+# Ollama の応答に付いてくる評価の統計（プロンプト評価・生成のトークン数と時間、モデルの読み込み時間）の記録。
+# 呼び出しごとに取り出してステップに付け、実行（run_agent 1回）ごと・タスクごと（中断・再開をまたいで同じ ID）に集計する。
+# 実行が終わるたびに1行の JSON を project/llm_metrics.jsonl に追記する（上限を超えたら .1 に回して作り直す）。
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from model_residency import _field
+
+LLM_METRICS_MAX_MB = int(os.environ.get("LLM_METRICS_MAX_MB", "5"))  # メトリクスファイルの上限（超えたら1世代だけ残して作り直す）
+LLM_METRICS_MAX_TASKS = 200  # 合計をメモリに持つタスクの数（再開されないまま残った中断タスクは古いものから捨てる）
+_NS_FIELDS = ("total_duration", "load_duration", "prompt_eval_duration", "eval_duration")
+_TOTAL_KEYS = ("calls", "cached", "prompt_tokens", "prompt_sec", "gen_tokens", "gen_sec", "load_sec", "total_sec", "timeouts")
+
+
+def eval_stats(response, model, label):
+    """応答から評価の統計を取り出す（時間は秒）。"""
+    stats = {"label": label, "model": model}
+    for key in _NS_FIELDS:
+        try:
+            stats[key.replace("duration", "sec")] = round(float(_field(response, key) or 0) / 1e9, 3)
+        except (TypeError, ValueError):
+            stats[key.replace("duration", "sec")] = 0.0
+    for key in ("prompt_eval_count", "eval_count"):
+        try:
+            stats[key] = int(_field(response, key) or 0)
+        except (TypeError, ValueError):
+            stats[key] = 0
+    return stats
+
+
+def cached_stats(model, label):
+    """キャッシュから返した呼び出しの記録（Ollama は呼んでいないので時間は 0）。"""
+    return {"label": label, "model": model, "cached": True}
+
+
+def _rate(tokens, sec):
+    return round(tokens / sec, 1) if sec > 0 else None
+
+
+def _empty_totals():
+    return {k: 0 for k in _TOTAL_KEYS}
+
+
+def _add(totals, call):
+    totals["calls"] += 1
+    if call.get("cached"):
+        totals["cached"] += 1
+        return
+    totals["prompt_tokens"] += call.get("prompt_eval_count", 0)
+    totals["prompt_sec"] = round(totals["prompt_sec"] + call.get("prompt_eval_sec", 0.0), 3)
+    totals["gen_tokens"] += call.get("eval_count", 0)
+    totals["gen_sec"] = round(totals["gen_sec"] + call.get("eval_sec", 0.0), 3)
+    totals["load_sec"] = round(totals["load_sec"] + call.get("load_sec", 0.0), 3)
+    totals["total_sec"] = round(totals["total_sec"] + call.get("total_sec", 0.0), 3)
+
+
+def with_rates(totals):
+    """合計に tokens/sec を足したもの。"""
+    out = dict(totals)
+    out["prompt_tps"] = _rate(totals["prompt_tokens"], totals["prompt_sec"])
+    out["gen_tps"] = _rate(totals["gen_tokens"], totals["gen_sec"])
+    return out
+
+
+def format_totals(totals):
+    """1行の要約（ターミナル Webhook 用）。"""
+    t = with_rates(totals)
+    text = (
+        f"呼び出し {t['calls']} 回"
+        f"・プロンプト {t['prompt_tokens']} トークン {t['prompt_sec']:.1f} 秒"
+        + (f"（{t['prompt_tps']} tok/s）" if t["prompt_tps"] else "")
+        + f"・生成 {t['gen_tokens']} トークン {t['gen_sec']:.1f} 秒"
+        + (f"（{t['gen_tps']} tok/s）" if t["gen_tps"] else "")
+        + f"・読み込み {t['load_sec']:.1f} 秒・合計 {t['total_sec']:.1f} 秒"
+    )
+    if t["cached"]:
+        text += f"・キャッシュ {t['cached']} 回"
+    if t["timeouts"]:
+        text += f"・タイムアウト {t['timeouts']} 回"
+    return text
+
+
+class RunMetrics:
+    """1回の実行のステップごとの呼び出し記録と合計。"""
+
+    def __init__(self, task_id, channel_id, source, instruction):
+        self.task_id = task_id
+        self.channel_id = channel_id
+        self.source = source
+        self.instruction = (instruction or "")[:200]
+        self.started_at = time.time()
+        self.steps = []  # {"step", "calls": [...]}（応答待ちがタイムアウトしたステップは "timeout": True）
+        self.totals = _empty_totals()
+
+    def add_step(self, step, calls, timeout=False):
+        """timeout=True は LLM_RESPONSE_TIMEOUT_SEC で打ち切ったステップ（calls はそれまでに終わった呼び出しの分）。"""
+        calls = list(calls or [])
+        entry = {"step": step, "calls": calls}
+        if timeout:
+            entry["timeout"] = True
+            self.totals["timeouts"] += 1
+        self.steps.append(entry)
+        for call in calls:
+            _add(self.totals, call)
+
+
+class MetricsLog:
+    """実行ごとの集計を JSONL に追記し、タスクごとの合計をメモリに持つ。"""
+
+    def __init__(self, path, max_bytes=LLM_METRICS_MAX_MB * 1024 * 1024, max_tasks=LLM_METRICS_MAX_TASKS):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._max_tasks = max_tasks
+        self._lock = threading.Lock()
+        self._tasks = OrderedDict()  # タスク ID -> 合計（中断・再開をまたいで足す）。最後に更新したものが末尾
+
+    def task_totals(self, task_id):
+        with self._lock:
+            return dict(self._tasks.get(task_id) or _empty_totals())
+
+    def finish(self, run, outcome=""):
+        """run を集計して書き出す。戻り値: このタスクのこれまでの合計。"""
+        with self._lock:
+            task = self._tasks.setdefault(run.task_id, _empty_totals())
+            self._tasks.move_to_end(run.task_id)
+            while len(self._tasks) > self._max_tasks:
+                self._tasks.popitem(last=False)
+            for step in run.steps:
+                for call in step["calls"]:
+                    _add(task, call)
+                if step.get("timeout"):
+                    task["timeouts"] += 1
+            task = dict(task)
+            record = {
+                "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "task_id": run.task_id,
+                "channel_id": run.channel_id,
+                "source": run.source,
+                "instruction": run.instruction,
+                "outcome": outcome,
+                "wall_sec": round(time.time() - run.started_at, 3),
+                "run": with_rates(run.totals),
+                "task": with_rates(task),
+                "steps": run.steps,
+            }
+            try:
+                os.makedirs(os.path.dirname(self._path), exist_ok=True)
+                if os.path.exists(self._path) and os.path.getsize(self._path) > self._max_bytes:
+                    os.replace(self._path, self._path + ".1")
+                with open(self._path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except OSError:
+                pass
+        return task
+
+    def forget_task(self, task_id):
+        """完了したタスクの合計を捨てる（メモリに溜めない）。"""
+        with self._lock:
+            self._tasks.pop(task_id, None)
@@ -3,13 +3,17 @@
 # ツール一覧を取得して Ollama 用の function 形式に変換し、Bot 稼働中はセッションを保持して call_tool で実行する。
 
 import asyncio
+import hashlib
 import json
 import os
+import shutil
 import sys
 
 # project フォルダのパス（agent_bot.py と同じ並びで mcp_client.py がある前提）
 _PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "project")
 _MCP_SERVERS_JSON = os.path.join(_PROJECT_DIR, "mcp_servers.json")
+# サーバーごとのツール一覧のキャッシュ。起動直後（接続前）からツールを見せるために使い、接続後に最新の一覧で上書きする
+_MCP_TOOLS_CACHE_JSON = os.path.join(_PROJECT_DIR, "mcp_tools_cache.json")
 
 # mcp が未インストールの場合は MCP 機能はスキップする（Python 3.10+ と pip install mcp が必要）
 try:
@@ -22,14 +26,23 @@ except ImportError:
     stdio_client = None
     StdioServerParameters = None
 
-# ツール名 → セッション（複数 MCP 対応でどのサーバーに聞くか）
-_mcp_tool_to_session = {}
-# MCP ツール名の集合。実行ディスパッチ用。
+MCP_CALL_TIMEOUT_SEC = float(os.environ.get("MCP_CALL_TIMEOUT_SEC", "60"))  # 1回の call_tool の上限（再接続待ちを含む）
+MCP_MAX_CONCURRENT_CALLS = int(os.environ.get("MCP_MAX_CONCURRENT_CALLS", "4"))  # サーバー1つに同時に投げる call_tool の数
+MCP_RECONNECT_MAX_SEC = float(os.environ.get("MCP_RECONNECT_MAX_SEC", "300"))  # 再接続の待ち時間の上限（1, 2, 4, ... 秒と伸ばす）
+MCP_HEALTHCHECK_SEC = float(os.environ.get("MCP_HEALTHCHECK_SEC", "30"))  # 接続中はこの間隔で ping して切断を検知する
+MCP_IDLE_TIMEOUT_SEC = float(os.environ.get("MCP_IDLE_TIMEOUT_SEC", "300"))  # オンデマンド（"lazy": true）のサーバーを使われないまま残しておく時間
+
+# ツール名 → サーバー（複数 MCP 対応でどのサーバーに聞くか）
+_mcp_tool_to_server = {}
+# MCP ツール名の集合。実行ディスパッチ用。切断中も消さない（再接続を待って実行する）
 MCP_TOOL_NAMES = set()
+# 起動済みのサーバー（on_ready は再接続のたびに来るので、2回目以降は起動しない）
+_mcp_servers = []
 
 
 def _load_mcp_server_config():
-    """project/mcp_servers.json を読んで [(command, args), ...] を返す。無ければ []。"""
+    """project/mcp_servers.json を読んで [(command, args, options), ...] を返す。無ければ []。
+    options はエントリごとの設定: "lazy"（初回の呼び出しで起動し、使われなくなったら止める）, "idle_timeout_sec"。"""
     if not os.path.isfile(_MCP_SERVERS_JSON):
         return []
     try:
@@ -51,7 +64,11 @@ def _load_mcp_server_config():
             args = []
         if not isinstance(args, list):
             args = [str(args)]
-        out.append((str(cmd).strip(), [str(a) for a in args]))
+        options = {
+            "lazy": bool(item.get("lazy", False)),
+            "idle_timeout_sec": float(item.get("idle_timeout_sec") or MCP_IDLE_TIMEOUT_SEC),
+        }
+        out.append((str(cmd).strip(), [str(a) for a in args], options))
     return out
 
 
@@ -96,99 +113,300 @@ def _tool_to_ollama_schema(tool):
     }
 
 
-async def _hold_mcp_connection(bot, server_params, tools_list_ref):
-    """バックグラウンドで MCP に接続し、ツールを tools_list_ref に追加してセッションを保持する。"""
-    global _mcp_tool_to_session, MCP_TOOL_NAMES
-    names = set()
-    if not HAS_MCP or stdio_client is None or ClientSession is None:
-        return
+def _list_tools_result(tools_result):
+    # ListToolsResult.tools またはリストそのまま
+    tools = getattr(tools_result, "tools", None) if tools_result is not None else None
+    if tools is None and isinstance(tools_result, list):
+        tools = tools_result
+    return tools or []
+
+
+def _call_result_text(result):
+    # 戻り値は CallToolResult など。content がリストのことがある
+    content = getattr(result, "content", None) or result
+    if isinstance(content, list):
+        texts = []
+        for part in content:
+            if hasattr(part, "text"):
+                texts.append(part.text)
+            elif isinstance(part, dict) and "text" in part:
+                texts.append(part["text"])
+            elif isinstance(part, str):
+                texts.append(part)
+        return "\n".join(texts) if texts else str(content)
+    if hasattr(content, "text"):
+        return content.text
+    if isinstance(content, str):
+        return content
+    return str(content)
+
+
+def _server_cache_key(command, args):
+    """command + args と、実行ファイル・引数に出てくるファイルの mtime・サイズから作るキー。
+    サーバーを更新（npm update・スクリプト編集など）するとキーが変わり、古いキャッシュは使われない。"""
+    parts = [command] + list(args)
+    fingerprint = []
+    for p in [shutil.which(command) or command] + list(args):
+        try:
+            st = os.stat(p)
+            fingerprint.append(f"{p}:{st.st_mtime_ns}:{st.st_size}")
+        except (OSError, ValueError):
+            continue
+    raw = json.dumps([parts, fingerprint], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def _load_tools_cache():
+    try:
+        with open(_MCP_TOOLS_CACHE_JSON, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_tools_cache(key, label, schemas):
+    """key のツール一覧を書き込む（他のキーは残す）。一時ファイルに書いてから置き換える。"""
+    data = _load_tools_cache()
+    data[key] = {"server": label, "tools": schemas}
+    tmp = _MCP_TOOLS_CACHE_JSON + ".tmp"
     try:
-        async with stdio_client(server_params, errlog=sys.stderr) as (read_stream, write_stream):
-            async with ClientSession(read_stream, write_stream) as session:
-                await session.initialize()
-                tools_result = await session.list_tools()
-                # ListToolsResult.tools またはリストそのまま
-                tools = getattr(tools_result, "tools", None) if tools_result is not None else None
-                if tools is None and isinstance(tools_result, list):
-                    tools = tools_result
-                tools = tools or []
-                schemas = []
-                for t in tools:
-                    try:
-                        schema = _tool_to_ollama_schema(t)
-                        schemas.append(schema)
-                        names.add(schema["function"]["name"])
-                    except Exception:
-                        continue
-                if schemas:
-                    tools_list_ref.extend(schemas)
-                    MCP_TOOL_NAMES.update(names)
-                    for n in names:
-                        _mcp_tool_to_session[n] = session
-                # Bot が終了するまでこのコンテキストを維持
-                if bot:
-                    await bot.wait_until_closed()
-                else:
-                    await asyncio.Future()
-    except Exception as e:
-        sys.stderr.write(f"[MCP] 接続エラー: {e}\n")
+        os.makedirs(os.path.dirname(_MCP_TOOLS_CACHE_JSON), exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, _MCP_TOOLS_CACHE_JSON)
+    except OSError as e:
+        sys.stderr.write(f"[MCP] ツール一覧のキャッシュを保存できません: {e}\n")
         sys.stderr.flush()
-    finally:
-        for n in names:
-            _mcp_tool_to_session.pop(n, None)
-        MCP_TOOL_NAMES.difference_update(names)
+
+
+class _MCPServer:
+    """MCP サーバー1つ分の接続を管理する。切断されたら待ち時間を伸ばしながら再接続し、
+    call_tool はサーバーごとのセマフォで同時実行数を絞る。ツールの schema は内容が変わったときだけ差し替える。
+    lazy のサーバーは呼び出しがあったときだけ起動し、idle_timeout 秒使われなければプロセスを止める。"""
+
+    def __init__(self, command, args, tools_list_ref, lazy=False, idle_timeout=MCP_IDLE_TIMEOUT_SEC):
+        self.command = command
+        self.args = args
+        self.lazy = lazy
+        self.idle_timeout = idle_timeout
+        self.label = " ".join([command] + list(args))
+        self._tools_list_ref = tools_list_ref
+        self._schemas = {}  # ツール名 -> TOOLS に入れている schema（同じ内容なら同じオブジェクトを使い続ける）
+        self._session = None
+        self._connected = asyncio.Event()
+        self._probe = asyncio.Event()  # 呼び出しが失敗したら立てて、すぐに ping で生死を確認させる
+        self._calls = asyncio.Semaphore(max(1, MCP_MAX_CONCURRENT_CALLS))
+        self._inflight = set()
+        self._dropped = set()  # 切断のために打ち切った呼び出し
+        self._task = None
+        self.reconnects = 0
+        self.cache_key = _server_cache_key(command, args)
+        self._cache_saved = False  # キャッシュの中身が最新の一覧と同じと分かっているか
+        self._wanted = asyncio.Event()  # lazy のとき、起動が必要になったら立つ
+        self._active = 0  # 実行中・接続待ちの呼び出し数
+        self._last_used = None  # 最後に呼び出しが終わった時刻（loop.time()）。None は未使用
+
+    def start(self, bot, cached=None):
+        """接続タスクを開始する。cached（前回のツール一覧）があれば、接続を待たずに先に TOOLS へ載せる。"""
+        if cached:
+            self._apply_schemas(cached)
+            self._cache_saved = True
+        elif self.lazy:
+            self._wanted.set()  # ツール一覧が分からないので、一度だけ起動して一覧を取ってから止める
+        self._task = asyncio.create_task(self._run(bot))
+        return self._task
+
+    def _apply_schemas(self, schemas):
+        """ツール一覧を TOOLS・MCP_TOOL_NAMES に反映する。内容が同じ schema はそのまま残す。戻り値: 変わったか。"""
+        new = {}
+        for schema in schemas:
+            try:
+                name = schema["function"]["name"]
+            except (KeyError, TypeError):
+                continue
+            old = self._schemas.get(name)
+            new[name] = old if old == schema else schema
+        removed = [s for n, s in self._schemas.items() if new.get(n) is not s]
+        added = [s for n, s in new.items() if self._schemas.get(n) is not s]
+        if removed:
+            self._tools_list_ref[:] = [t for t in self._tools_list_ref if not any(t is r for r in removed)]
+        if added:
+            self._tools_list_ref.extend(added)
+        for name in self._schemas:
+            if name not in new and _mcp_tool_to_server.get(name) is self:
+                _mcp_tool_to_server.pop(name, None)
+                MCP_TOOL_NAMES.discard(name)
+        for name in new:
+            _mcp_tool_to_server[name] = self
+        MCP_TOOL_NAMES.update(new)
+        self._schemas = new
+        return bool(removed or added)
+
+    async def _run(self, bot):
+        """接続 → 保持 → 切断検知 → 待って再接続、を Bot が閉じるまで繰り返す。"""
+        attempt = 0
+        while not (bot and bot.is_closed()):
+            if self.lazy and not self._wanted.is_set():
+                await self._wanted.wait()
+            idle = False
+            try:
+                async with stdio_client(StdioServerParameters(command=self.command, args=self.args), errlog=sys.stderr) as (read_stream, write_stream):
+                    async with ClientSession(read_stream, write_stream) as session:
+                        await session.initialize()
+                        schemas = []
+                        for t in _list_tools_result(await session.list_tools()):
+                            try:
+                                schemas.append(_tool_to_ollama_schema(t))
+                            except Exception:
+                                continue
+                        changed = self._apply_schemas(schemas)
+                        if changed or not self._cache_saved:
+                            _save_tools_cache(self.cache_key, self.label, schemas)
+                            self._cache_saved = True
+                        if attempt or self.reconnects:
+                            sys.stderr.write(f"[MCP] 再接続しました: {self.label}" + ("（ツール一覧が変わりました）" if changed else "") + "\n")
+                            sys.stderr.flush()
+                        elif self.lazy and self._active:
+                            sys.stderr.write(f"[MCP] 呼び出しがあったため起動しました: {self.label}\n")
+                            sys.stderr.flush()
+                        attempt = 0
+                        self._session = session
+                        self._connected.set()
+                        idle = await self._hold(bot, session)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                sys.stderr.write(f"[MCP] 接続エラー ({self.label}): {e}\n")
+                sys.stderr.flush()
+            finally:
+                self._session = None
+                self._connected.clear()
+                for task in list(self._inflight):
+                    self._dropped.add(task)
+                    task.cancel()  # 切れたセッションへの呼び出しは待たずに打ち切る（呼び出し側は再接続後にやり直せる）
+            if bot and bot.is_closed():
+                break
+            if self.lazy and not self._active and (idle or self._schemas):
+                # 使われていない（アイドル停止・起動失敗）なら、次の呼び出しが来るまで起動しない。一覧が未取得なら取れるまで再試行する
+                self._wanted.clear()
+                if idle:
+                    continue
+            delay = min(MCP_RECONNECT_MAX_SEC, 2 ** attempt)
+            attempt += 1
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+
+    def _is_idle(self):
+        if not self.lazy or self._active:
+            return False
+        if self._last_used is None:
+            return True  # 一覧を取るためだけに起動した
+        return asyncio.get_running_loop().time() - self._last_used >= self.idle_timeout
+
+    async def _hold(self, bot, session):
+        """セッションを保持する。定期的な ping か、呼び出し失敗時の ping に応答がなければ False で戻る（＝再接続）。
+        lazy のサーバーが idle_timeout 秒使われていなければ True で戻る（＝停止）。"""
+        check_sec = min(MCP_HEALTHCHECK_SEC, self.idle_timeout) if self.lazy else MCP_HEALTHCHECK_SEC
+        while not (bot and bot.is_closed()):
+            if self._is_idle():
+                sys.stderr.write(f"[MCP] 使われていないため停止します: {self.label}\n")
+                sys.stderr.flush()
+                return True
+            try:
+                await asyncio.wait_for(self._probe.wait(), timeout=check_sec)
+            except asyncio.TimeoutError:
+                pass
+            self._probe.clear()
+            if self._is_idle():
+                continue
+            try:
+                await asyncio.wait_for(session.send_ping(), timeout=min(MCP_CALL_TIMEOUT_SEC, 10))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                sys.stderr.write(f"[MCP] 応答がないため再接続します ({self.label}): {e}\n")
+                sys.stderr.flush()
+                return False
+        return False
+
+    async def call(self, name, args, timeout=MCP_CALL_TIMEOUT_SEC):
+        loop = asyncio.get_running_loop()
+        self._active += 1
+        self._wanted.set()
+        try:
+            return await self._call(name, args, timeout)
+        finally:
+            self._active -= 1
+            self._last_used = loop.time()
+
+    async def _call(self, name, args, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        async with self._calls:
+            remaining = deadline - loop.time()
+            if not self._connected.is_set():
+                try:
+                    await asyncio.wait_for(self._connected.wait(), timeout=max(0.0, remaining))
+                except asyncio.TimeoutError:
+                    return "MCP ツール実行エラー: MCP サーバーに再接続中です。しばらくしてから再度お試しください。"
+                remaining = deadline - loop.time()
+            session = self._session
+            if session is None:  # 待っている間に切断された（再接続で設定し直される）
+                return "MCP ツール実行エラー: MCP サーバーに再接続中です。しばらくしてから再度お試しください。"
+            task = asyncio.ensure_future(session.call_tool(name, args or {}))
+            self._inflight.add(task)
+            try:
+                result = await asyncio.wait_for(task, timeout=max(0.0, remaining))
+            except asyncio.TimeoutError:
+                self._probe.set()
+                return f"MCP ツール実行エラー: タイムアウトしました（{timeout:g}秒）"
+            except asyncio.CancelledError:
+                if task in self._dropped:
+                    return "MCP ツール実行エラー: MCP サーバーとの接続が切れました。"
+                raise
+            except Exception as e:
+                self._probe.set()
+                return f"MCPツール実行エラー: {e}"
+            finally:
+                self._inflight.discard(task)
+                self._dropped.discard(task)
+        return _call_result_text(result)
 
 
 def start_mcp_background(bot, tools_list_ref):
-    """MCP サーバーに接続するバックグラウンドタスクを開始する。on_ready から呼ぶ。
+    """MCP サーバーに接続するバックグラウンドタスクを開始する。on_ready から呼ぶ（2回目以降は何もしない）。
     project/mcp_servers.json があれば複数サーバーを起動。無ければ MCP_SERVER_CMD の 1 件のみ。"""
-    if not HAS_MCP:
+    if not HAS_MCP or _mcp_servers:
         return None
     configs = _load_mcp_server_config()
     if not configs:
         cmd = os.environ.get("MCP_SERVER_CMD", "").strip()
         command, args = _parse_mcp_cmd(cmd)
         if command:
-            configs = [(command, args or [])]
+            configs = [(command, args or [], {})]
     if not configs:
         return None
+    cache = _load_tools_cache()
     tasks = []
-    for command, args in configs:
-        try:
-            server_params = StdioServerParameters(command=command, args=args)
-            t = asyncio.create_task(_hold_mcp_connection(bot, server_params, tools_list_ref))
-            tasks.append(t)
-        except Exception as e:
-            sys.stderr.write(f"[MCP] パラメータエラー ({command}): {e}\n")
-            sys.stderr.flush()
+    # 各サーバーは別タスクで並行に接続する。前回のツール一覧があれば先に載せ、呼び出しは接続完了を待って実行する
+    for command, args, options in configs:
+        server = _MCPServer(
+            command, args, tools_list_ref,
+            lazy=options.get("lazy", False),
+            idle_timeout=options.get("idle_timeout_sec", MCP_IDLE_TIMEOUT_SEC),
+        )
+        cached = (cache.get(server.cache_key) or {}).get("tools")
+        _mcp_servers.append(server)
+        tasks.append(server.start(bot, cached=cached))
     return tasks
 
 
 async def mcp_call_tool(name, args):
-    """MCP ツールを実行する。戻り値は文字列。"""
+    """MCP ツールを実行する。戻り値は文字列。切断中なら再接続を待ち、MCP_CALL_TIMEOUT_SEC で打ち切る。"""
     if name not in MCP_TOOL_NAMES:
         return f"MCP ツール実行エラー: 不明なツール '{name}' です。"
-    session = _mcp_tool_to_session.get(name)
-    if session is None:
+    server = _mcp_tool_to_server.get(name)
+    if server is None:
         return "MCP ツール実行エラー: そのツールの MCP セッションが接続されていません。"
-    try:
-        result = await session.call_tool(name, args or {})
-        # 戻り値は CallToolResult など。content がリストのことがある
-        content = getattr(result, "content", None) or result
-        if isinstance(content, list):
-            texts = []
-            for part in content:
-                if hasattr(part, "text"):
-                    texts.append(part.text)
-                elif isinstance(part, dict) and "text" in part:
-                    texts.append(part["text"])
-                elif isinstance(part, str):
-                    texts.append(part)
-            return "\n".join(texts) if texts else str(content)
-        if hasattr(content, "text"):
-            return content.text
-        if isinstance(content, str):
-            return content
-        return str(content)
-    except Exception as e:
-        return f"MCPツール実行エラー: {e}"
+    return await server.call(name, args)
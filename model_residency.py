@@ -0,0 +1,177 @@
+# Ollama のモデル常駐管理。起動時にモデルを読み込んでおき（ウォームアップ）、リクエストには keep_alive を付けて
+# アンロードされにくくする。応答の load_duration を見て、モデルの読み込み（コールドロード）が起きたら記録・ログ出力する。
+# 同じホストで思考用→解答用→思考用と交互に使ったときの読み込みは「入れ替え（スワップ）」として数え、
+# /api/ps で複数モデルが同時に載るかも確認できる。
+
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+try:
+    import ollama
+    HAS_OLLAMA = True
+except ImportError:
+    ollama = None
+    HAS_OLLAMA = False
+
+# モデルを読み込んだままにしておく時間（Ollama の keep_alive。"30m"・"2h"・秒数、-1 で無期限）
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m").strip() or "30m"
+COLD_LOAD_LOG_SEC = 1.0  # load_duration がこれ以上なら読み込みが発生したとみなしてログに出す
+SWAP_WINDOW_SEC = 10 * 60  # この時間内に使ったモデルの読み込み直しだけを入れ替えとみなし、入れ替えの回数もこの時間内で数える
+SWAP_ROLES = ("thinking", "output")  # 入れ替えを数える役割（小さいモデル・ウォームアップは数えない）
+
+
+def keep_alive_value(value=OLLAMA_KEEP_ALIVE):
+    """keep_alive の値を Ollama に渡す形にする（"-1"・"600" のような数字は int）。"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _model_key(name):
+    """タグなしのモデル名は :latest として比べる。"""
+    name = (name or "").strip()
+    return name if ":" in name else name + ":latest"
+
+
+def _field(response, key):
+    if isinstance(response, dict):
+        return response.get(key)
+    value = getattr(response, key, None)
+    if value is None and hasattr(response, "get"):
+        try:
+            value = response.get(key)
+        except Exception:
+            value = None
+    return value
+
+
+class ModelResidency:
+    """モデルごとの読み込み状況（最後の load_duration・コールドロード回数）を持つ。"""
+
+    def __init__(self, keep_alive=OLLAMA_KEEP_ALIVE, client=None):
+        self.keep_alive = keep_alive_value(keep_alive)
+        self._client = client or ollama  # generate / ps を持つもの（ollama モジュールか OllamaPool）
+        self._lock = threading.Lock()
+        self._stats = {}  # モデル名 -> {"requests", "cold_loads", "last_load_sec", "total_load_sec", "last_used"}
+        self._last_role = {}  # ホスト -> (役割, モデル)。直前の思考・解答の呼び出し
+        self._used = {}  # (ホスト, モデル) -> 最後に使った時刻
+        self._swap_times = deque()  # 入れ替えが起きた時刻（SWAP_WINDOW_SEC より古いものは捨てる）
+        self.swaps = 0  # 入れ替えの累計（メモリに両方載らず、交互に読み込み直している）
+        self.swap_load_sec = 0.0  # 入れ替えにかかった読み込み時間の合計
+
+    def note_response(self, model, response, label="", host=None, role=None):
+        """応答の load_duration（ナノ秒）を記録する。読み込みが発生していればログに出す。戻り値: 読み込み秒数。
+        role（thinking / output）の呼び出しで、同じ host の直前の呼び出しがもう一方の役割の別モデルで、
+        このモデルを SWAP_WINDOW_SEC 以内に同じ host で使っていたのに読み込み直したときだけ入れ替えとして数える。
+        keep_alive 切れの読み込み直し・別ホストでの初回の読み込み・小さいモデルやウォームアップ（role なし）は数えない。"""
+        load_ns = _field(response, "load_duration") or 0
+        try:
+            load_sec = float(load_ns) / 1e9
+        except (TypeError, ValueError):
+            load_sec = 0.0
+        now = time.time()
+        with self._lock:
+            st = self._stats.setdefault(model, {"requests": 0, "cold_loads": 0, "last_load_sec": 0.0, "total_load_sec": 0.0, "last_used": None})
+            st["requests"] += 1
+            st["last_used"] = now
+            swapped = False
+            if load_sec >= COLD_LOAD_LOG_SEC:
+                st["cold_loads"] += 1
+                st["last_load_sec"] = round(load_sec, 3)
+                st["total_load_sec"] = round(st["total_load_sec"] + load_sec, 3)
+                prev = self._last_role.get(host)
+                used = self._used.get((host, model))
+                if (
+                    role in SWAP_ROLES and prev is not None and prev[0] != role and prev[1] != model
+                    and used is not None and now - used < SWAP_WINDOW_SEC
+                ):
+                    swapped = True
+                    self.swaps += 1
+                    self.swap_load_sec = round(self.swap_load_sec + load_sec, 3)
+                    self._swap_times.append(now)
+            self._used[(host, model)] = now
+            if role in SWAP_ROLES:
+                self._last_role[host] = (role, model)
+            else:
+                self._last_role.pop(host, None)  # 小さいモデル・ウォームアップのあとの読み込みは交互の入れ替えではない
+        if swapped:
+            label = (label + "・" if label else "") + "モデルの入れ替え"
+        if load_sec >= COLD_LOAD_LOG_SEC:
+            try:
+                sys.stderr.write(f"[Ollama] {model} を読み込みました（load_duration {load_sec:.1f} 秒{'・' + label if label else ''}）\n")
+                sys.stderr.flush()
+            except Exception:
+                pass
+        return load_sec
+
+    def warm(self, model, label="ウォームアップ", client=None):
+        """model を読み込んで keep_alive の間常駐させる（プロンプトなしの generate）。ブロックするのでスレッドで呼ぶ。
+        すでに読み込まれていればすぐ返る。client（1台のホストに固定したもの）を渡すとそのホストに読み込む。
+        戻り値: 読み込み秒数（失敗時は None）。"""
+        if not HAS_OLLAMA or not model:
+            return None
+        client = client or self._client
+        host = getattr(client, "url", None)
+        try:
+            response = client.generate(model=model, prompt="", keep_alive=self.keep_alive)
+        except Exception as e:
+            try:
+                sys.stderr.write(f"[Ollama] {model} の読み込みに失敗しました{'（' + host + '）' if host else ''}: {e}\n")
+                sys.stderr.flush()
+            except Exception:
+                pass
+            return None
+        return self.note_response(model, response, label=f"{label}・{host}" if host else label, host=host)
+
+    def warm_all(self, models, label="ウォームアップ", client=None):
+        """重複を除いて順に読み込む（同時に読み込むとメモリを奪い合うので1つずつ）。"""
+        seen = []
+        for m in models:
+            if m and m not in seen:
+                seen.append(m)
+                self.warm(m, label=label, client=client)
+        return seen
+
+    def resident_models(self, client=None):
+        """Ollama の /api/ps で今読み込まれているモデル名の集合。取得できなければ None。"""
+        client = client or self._client
+        if not HAS_OLLAMA or not hasattr(client, "ps"):
+            return None
+        try:
+            response = client.ps()
+        except Exception:
+            return None
+        names = set()
+        for m in _field(response, "models") or []:
+            name = _field(m, "model") or _field(m, "name")
+            if name:
+                names.add(_model_key(name))
+        return names
+
+    def check_coresidency(self, models, client=None):
+        """models を順に読み込んだあと、全部が同時にメモリに載っているか。判定できなければ None。
+        後から読み込んだモデルが先のモデルを追い出していれば False（呼び出しのたびに入れ替えが起きる）。
+        client（1台のホストに固定したもの）を渡すと、読み込みも /api/ps もそのホストで行う。"""
+        loaded = self.warm_all(models, client=client)
+        if len(loaded) < 2:
+            return True
+        resident = self.resident_models(client=client)
+        if resident is None:
+            return None
+        return all(_model_key(m) in resident for m in loaded)
+
+    def recent_swaps(self, window_sec=SWAP_WINDOW_SEC):
+        """直近 window_sec 秒の入れ替えの回数（古いものは捨てるので、しばらく起きなければ 0 に戻る）。"""
+        cutoff = time.time() - window_sec
+        with self._lock:
+            while self._swap_times and self._swap_times[0] < cutoff:
+                self._swap_times.popleft()
+            return len(self._swap_times)
+
+    def stats(self):
+        with self._lock:
+            return {m: dict(st) for m, st in self._stats.items()}
@@ -0,0 +1,251 @@
+# 複数の Ollama ホストに LLM の呼び出しを振り分けるバックエンドプール。
+# ホストごとに /api/tags でヘルスチェックし（持っているモデルの一覧も取る）、実行中のリクエスト数を数える。
+# 呼び出しはそのモデルを持つ正常なホストのうち、直近にそのモデルを使ったホスト（読み込み済みのはず）を優先し、
+# 実行中の数が少ないところへ送る。接続エラー・5xx は別のホストでやり直し（フェイルオーバー）、そのホストは次のチェックまで外す。
+
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+try:
+    import ollama
+    HAS_OLLAMA = True
+except ImportError:
+    ollama = None
+    HAS_OLLAMA = False
+
+from model_residency import _model_key
+
+# Ollama のベース URL（カンマ区切り）。空なら OLLAMA_HOST（未設定なら http://127.0.0.1:11434）の1台
+OLLAMA_HOSTS = os.environ.get("OLLAMA_HOSTS", "")
+OLLAMA_HEALTHCHECK_SEC = int(os.environ.get("OLLAMA_HEALTHCHECK_SEC", "30"))  # ヘルスチェックの間隔（秒）
+HEALTHCHECK_TIMEOUT_SEC = 3
+AFFINITY_WINDOW_SEC = 30 * 60  # この時間内にモデルを使ったホストは、そのモデルが読み込み済みとみなす
+
+
+def parse_hosts(value=OLLAMA_HOSTS):
+    """"http://a:11434,b:11434"（または URL のリスト）を URL のリストにする。空なら OLLAMA_HOST か既定の1台。"""
+    hosts = []
+    parts = value.split(",") if isinstance(value, str) else list(value or [])
+    for part in parts:
+        url = part.strip().rstrip("/")
+        if not url:
+            continue
+        if "://" not in url:
+            url = "http://" + url
+        if url not in hosts:
+            hosts.append(url)
+    if not hosts:
+        default = (os.environ.get("OLLAMA_HOST") or "http://127.0.0.1:11434").strip().rstrip("/")
+        hosts.append(default if "://" in default else "http://" + default)
+    return hosts
+
+
+class OllamaPoolError(Exception):
+    """使える Ollama ホストがない（全台がダウン・モデルがない）。"""
+
+
+class _Host:
+    def __init__(self, url, client):
+        self.url = url
+        self.client = client
+        self.healthy = True  # 最初のチェックまでは使えるものとして扱う
+        self.models = None  # /api/tags のモデル名（_model_key 済み）。未取得なら None
+        self.active = 0
+        self.requests = 0
+        self.failures = 0
+        self.last_error = ""
+        self.checked_at = 0.0
+        self.recent = {}  # モデル名 -> 最後に使った時刻（アフィニティ用）
+
+    def has_model(self, model):
+        return self.models is None or _model_key(model) in self.models
+
+    def affine(self, model, now):
+        used = self.recent.get(_model_key(model))
+        return used is not None and now - used < AFFINITY_WINDOW_SEC
+
+
+class OllamaPool:
+    """ollama モジュールと同じ chat / generate / ps を持ち、呼び出しごとにホストを選ぶ。スレッドから呼んでよい。"""
+
+    def __init__(self, hosts=None, client_factory=None, healthcheck_sec=OLLAMA_HEALTHCHECK_SEC):
+        factory = client_factory or (lambda url: ollama.Client(host=url))
+        self._hosts = [_Host(url, factory(url)) for url in parse_hosts(OLLAMA_HOSTS if hosts is None else hosts)]
+        self._healthcheck_sec = healthcheck_sec
+        self._lock = threading.Lock()
+        self._local = threading.local()  # スレッドごとの、最後に応答したホスト
+
+    @property
+    def hosts(self):
+        return [h.url for h in self._hosts]
+
+    # --- ヘルスチェック ---
+
+    def check(self, host):
+        """host の /api/tags を取得し、正常か・持っているモデルを更新する。戻り値: 正常か。"""
+        try:
+            with urllib.request.urlopen(host.url + "/api/tags", timeout=HEALTHCHECK_TIMEOUT_SEC) as res:
+                data = json.loads(res.read().decode("utf-8"))
+            models = {_model_key(m.get("name") or m.get("model")) for m in data.get("models") or [] if m.get("name") or m.get("model")}
+        except Exception as e:
+            with self._lock:
+                was = host.healthy
+                host.healthy = False
+                host.last_error = f"{type(e).__name__}: {e}"
+                host.checked_at = time.time()
+            if was:
+                self._log(f"{host.url} に接続できません（{host.last_error}）。復旧するまで振り分けません")
+            return False
+        with self._lock:
+            was = host.healthy
+            host.healthy = True
+            host.models = models
+            host.checked_at = time.time()
+        if not was:
+            self._log(f"{host.url} が復旧しました")
+        return True
+
+    def check_all(self):
+        for host in self._hosts:
+            self.check(host)
+        return sum(1 for h in self._hosts if h.healthy)
+
+    async def run(self, interval_sec=None):
+        """interval_sec ごとに全ホストをチェックし続ける（最初のチェックは起動時に check_all を呼んでおく）。"""
+        interval = interval_sec or self._healthcheck_sec
+        while True:
+            try:
+                await asyncio.sleep(interval)
+            except asyncio.CancelledError:
+                break
+            try:
+                await asyncio.to_thread(self.check_all)
+            except Exception:
+                pass
+
+    # --- 振り分け ---
+
+    def _candidates(self, model):
+        """試す順のホスト。正常でモデルを持つホストを、アフィニティのあるもの優先・実行中の少ない順に並べる。"""
+        now = time.time()
+        with self._lock:
+            live = [h for h in self._hosts if h.healthy]
+            if not live:
+                # 全台ダウン扱いでも、チェック間隔を過ぎたホストは試す（チェックより先に復旧していることがある）
+                live = [h for h in self._hosts if now - h.checked_at >= self._healthcheck_sec] or list(self._hosts)
+            if model:
+                with_model = [h for h in live if h.has_model(model)]
+                live = with_model or live  # どこにもなければ一覧が古い可能性があるので全部試す
+            order = {id(h): i for i, h in enumerate(self._hosts)}
+            # 読み込み済み（アフィニティ）のホストは実行中が1件多くても選ぶ（別ホストでの読み込み待ちより早い）
+            return sorted(live, key=lambda h: (h.active - (1 if model and h.affine(model, now) else 0), order[id(h)]))
+
+    def _call_host(self, host, method, model, kwargs):
+        """host だけに送る。失敗は記録して例外をそのまま送出する。"""
+        with self._lock:
+            host.active += 1
+            host.requests += 1
+        try:
+            result = getattr(host.client, method)(**kwargs)
+        except Exception as e:
+            status = getattr(e, "status_code", None)
+            with self._lock:
+                host.failures += 1
+                host.last_error = f"{type(e).__name__}: {e}"
+                if status is None or status >= 500:
+                    host.healthy = False  # 接続エラー・サーバーエラーは次のチェックまで外す
+                    host.checked_at = time.time()
+            raise
+        finally:
+            with self._lock:
+                host.active -= 1
+        if model:
+            with self._lock:
+                host.recent[_model_key(model)] = time.time()
+        self._local.url = host.url
+        return result
+
+    def last_host(self):
+        """このスレッドで最後に応答したホストの URL（モデルの入れ替えをホストごとに数えるため）。"""
+        return getattr(self._local, "url", None)
+
+    def _call(self, method, model, kwargs):
+        last_error = None
+        for host in self._candidates(model):
+            try:
+                return self._call_host(host, method, model, kwargs)
+            except Exception as e:
+                status = getattr(e, "status_code", None)
+                if status is not None and status < 500 and status != 404:
+                    raise  # 要求そのものの誤りはどのホストでも同じなのでやり直さない
+                if len(self._hosts) > 1:
+                    self._log(f"{host.url} で {method} に失敗しました（{host.last_error}）。別のホストで再試行します")
+                last_error = e
+        if last_error is not None:
+            raise last_error
+        raise OllamaPoolError("使える Ollama ホストがありません")
+
+    def chat(self, **kwargs):
+        return self._call("chat", kwargs.get("model"), kwargs)
+
+    def generate(self, **kwargs):
+        return self._call("generate", kwargs.get("model"), kwargs)
+
+    def ps(self):
+        """振り分け先の1台の /api/ps（ホストごとに確認するときは host_clients を使う）。"""
+        return self._call("ps", None, {})
+
+    def host_clients(self, model=None):
+        """正常なホスト（model を渡せばそれを持つもの）ごとの、そのホストだけに送るクライアント。
+        ウォームアップと /api/ps の常駐確認はホストごとに行う（振り分けでは1台にしか届かない）。"""
+        with self._lock:
+            return [_HostClient(self, h) for h in self._hosts if h.healthy and (not model or h.has_model(model))]
+
+    def stats(self):
+        with self._lock:
+            return [
+                {
+                    "url": h.url,
+                    "healthy": h.healthy,
+                    "active": h.active,
+                    "requests": h.requests,
+                    "failures": h.failures,
+                    "models": len(h.models) if h.models is not None else None,
+                    "last_error": h.last_error,
+                }
+                for h in self._hosts
+            ]
+
+    @staticmethod
+    def _log(text):
+        try:
+            sys.stderr.write(f"[Ollama] {text}\n")
+            sys.stderr.flush()
+        except Exception:
+            pass
+
+
+class _HostClient:
+    """1台のホストに固定した chat / generate / ps（OllamaPool.host_clients で作る）。実行中の数・アフィニティはプールと共有する。"""
+
+    def __init__(self, pool, host):
+        self._pool = pool
+        self._host = host
+        self.url = host.url
+
+    def has_model(self, model):
+        return self._host.has_model(model)
+
+    def chat(self, **kwargs):
+        return self._pool._call_host(self._host, "chat", kwargs.get("model"), kwargs)
+
+    def generate(self, **kwargs):
+        return self._pool._call_host(self._host, "generate", kwargs.get("model"), kwargs)
+
+    def ps(self):
+        return self._pool._call_host(self._host, "ps", None, {})
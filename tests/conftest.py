@@ -0,0 +1,97 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# agent_bot は import 時にトークンを確認する。テストではトレースを書かない
+os.environ.setdefault("DISCORD_BOT_TOKEN", "test-token")
+os.environ.setdefault("TRACE_ENABLED", "0")
+
+
+@pytest.fixture(scope="session")
+def agent_bot():
+    """Bot 本体のモジュール（discord.py・ollama が入っていなければスキップ）。"""
+    pytest.importorskip("discord")
+    pytest.importorskip("ollama")
+    import agent_bot
+    return agent_bot
+
+
+class StubOllama:
+    """Ollama の HTTP API（/api/tags・/api/ps・/api/chat・/api/generate）を真似る最小のサーバー。
+    fail=True の間は 503/500 を返し、gate を閉じると chat・generate は開くまで待つ。"""
+
+    def __init__(self, name, models):
+        self.name = name
+        self.models = list(models)
+        self.fail = False
+        self.gate = threading.Event()
+        self.gate.set()
+        self.requests = []  # (パス, モデル)
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, code, obj):
+                body = json.dumps(obj).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if stub.fail:
+                    return self._send(503, {"error": "unavailable"})
+                if self.path in ("/api/tags", "/api/ps"):
+                    return self._send(200, {"models": [{"name": m, "model": m} for m in stub.models]})
+                self._send(404, {"error": "not found"})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                model = body.get("model", "")
+                stub.requests.append((self.path, model))
+                if stub.fail:
+                    return self._send(500, {"error": "server error"})
+                if model not in stub.models:
+                    return self._send(404, {"error": f"model '{model}' not found"})
+                stub.gate.wait(5)
+                if self.path == "/api/chat":
+                    return self._send(200, {"model": model, "message": {"role": "assistant", "content": f"from {stub.name}"}, "done": True})
+                self._send(200, {"model": model, "response": "", "done": True, "load_duration": 0})
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def chats(self):
+        return sum(1 for path, _ in self.requests if path == "/api/chat")
+
+    def stop(self):
+        """接続できない状態にする（プロセスが落ちたホスト）。"""
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def ollama_stub():
+    """ollama_stub(name, models) でスタブの Ollama サーバーを起動する。テストの終わりに止める。"""
+    started = []
+
+    def start(name, models=("qwen3-swallow:8b",)):
+        stub = StubOllama(name, models)
+        started.append(stub)
+        return stub
+
+    yield start
+    for stub in started:
+        try:
+            stub.stop()
+        except Exception:
+            pass
@@ -0,0 +1,17 @@
+def test_channel_modes_read_once_and_unset_not_cached(agent_bot, monkeypatch, tmp_path):
+    monkeypatch.setattr(agent_bot, "CHANNEL_MODES_PATH", str(tmp_path / "channel_modes.json"))
+    monkeypatch.setattr(agent_bot, "_channel_modes", {"1": False})
+    lru = agent_bot._ChannelStateLRU(agent_bot._load_channel_mode, 8, 1024, cache_missing=False)
+    monkeypatch.setattr(agent_bot, "_channel_use_autonomous_loop", lru)
+
+    def no_read():
+        raise AssertionError("channel_modes.json を読み直した")
+
+    monkeypatch.setattr(agent_bot, "_load_channel_modes", no_read)
+    assert lru.get(1) is False
+    assert lru.get(2) is None
+    assert 2 not in lru and len(lru) == 1  # 未設定はキャッシュしない
+
+    _, use_loop = agent_bot._parse_instruction_mode(2, "これからは簡単に答えて")
+    assert use_loop is False and lru.get(2) is False
+    assert (tmp_path / "channel_modes.json").read_text(encoding="utf-8") == '{"1": false, "2": false}'
@@ -0,0 +1,78 @@
+import json
+import os
+
+from llm_cache import ResponseCache
+
+
+class _FakeOllama:
+    def __init__(self, content):
+        self.content = content
+        self.calls = 0
+
+    def chat(self, **kwargs):
+        self.calls += 1
+        return {"message": {"role": "assistant", "content": self.content, "tool_calls": None}, "load_duration": 0}
+
+    def last_host(self):
+        return None
+
+
+def test_text_only_response_is_stored_with_empty_tool_calls(tmp_path):
+    cache = ResponseCache(str(tmp_path), mode="all")
+    cache.put("k", {"message": {"role": "assistant", "content": "こんにちは", "tool_calls": None}})
+
+    with open(tmp_path / "k.json", encoding="utf-8") as f:
+        assert json.load(f)["message"]["tool_calls"] == []
+    assert cache.get("k")["message"]["tool_calls"] == []
+
+
+def test_call_output_replays_cached_text_only_response(agent_bot, tmp_path, monkeypatch):
+    fake = _FakeOllama("キャッシュの答え")
+    monkeypatch.setattr(agent_bot, "_ollama", fake)
+    monkeypatch.setattr(agent_bot, "_llm_cache", ResponseCache(str(tmp_path), mode="all"))
+    messages = [{"role": "user", "content": "こんにちは"}]
+
+    first = agent_bot._call_output(messages)
+    # 以前の形式（tool_calls が null のまま）で保存されたエントリも再生できること
+    (name,) = [f for f in os.listdir(tmp_path) if f.endswith(".json")]
+    with open(tmp_path / name, "w", encoding="utf-8") as f:
+        json.dump(fake.chat(), f)
+    fake.calls = 1
+    calls = []
+    replayed = agent_bot._call_output(messages, calls=calls)
+
+    assert fake.calls == 1  # 2回目は Ollama を呼ばずにキャッシュから返す
+    assert calls[0]["cached"] is True
+    assert replayed == first == {"role": "assistant", "content": "キャッシュの答え"}
+
+
+def test_on_mode_skips_sampled_calls_unless_marked(tmp_path):
+    cache = ResponseCache(str(tmp_path), mode="on")
+    assert cache.use_for(False, {"temperature": 0.2}) is False
+    assert cache.use_for(False, {"temperature": 0}) is True
+    assert cache.use_for(True, {"temperature": 0.2}) is True  # 最初のステップの思考はサンプリングした答えを再生する
+
+
+def _response(text):
+    return {"message": {"role": "assistant", "content": text, "tool_calls": []}}
+
+
+def test_eviction_by_count_deletes_oldest_file(tmp_path):
+    cache = ResponseCache(str(tmp_path), mode="all", max_entries=2)
+    cache.put("a", _response("1"))
+    cache.put("b", _response("2"))
+    cache.get("a")  # a を使ったので、いちばん古いのは b
+    cache.put("c", _response("3"))
+
+    assert sorted(os.listdir(tmp_path)) == ["a.json", "c.json"]
+    assert cache.get("b") is None
+
+
+def test_eviction_by_size_deletes_oldest_file(tmp_path):
+    size = len(json.dumps(_response("x" * 100), ensure_ascii=False))
+    cache = ResponseCache(str(tmp_path), mode="all", max_bytes=size * 2 + size // 2)
+    for key in ("a", "b", "c"):
+        cache.put(key, _response("x" * 100))
+
+    assert sorted(os.listdir(tmp_path)) == ["b.json", "c.json"]
+    assert cache.get("a") is None
@@ -0,0 +1,50 @@
+import asyncio
+import threading
+
+import pytest
+
+from llm_gateway import LLMGateway
+
+
+def test_timed_out_call_keeps_its_slot_until_the_thread_finishes():
+    gateway = LLMGateway(slots=1, weights={"interactive": 8, "autonomous": 1})
+    ollama_busy = threading.Event()
+    finish = threading.Event()
+
+    def slow_call():
+        ollama_busy.set()
+        finish.wait(5)
+        return "late"
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(gateway.run_in_thread("autonomous", 1, slow_call), timeout=0.1)
+        assert ollama_busy.is_set()
+        assert gateway.stats()["active"] == 1  # スレッドはまだ Ollama を待っているので枠を持ったまま
+
+        second = asyncio.ensure_future(gateway.run_in_thread("interactive", 2, lambda: "next"))
+        await asyncio.sleep(0.1)
+        assert not second.done()
+        assert gateway.stats()["queued"] == 1
+
+        finish.set()
+        result, waited = await asyncio.wait_for(second, timeout=5)
+        assert result == "next"
+        assert waited > 0
+        assert gateway.stats()["active"] == 0
+
+    asyncio.run(main())
+
+
+def test_run_in_thread_releases_the_slot_on_error():
+    gateway = LLMGateway(slots=1)
+
+    def fail():
+        raise RuntimeError("Ollama エラー")
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await gateway.run_in_thread("interactive", 1, fail)
+        assert gateway.stats()["active"] == 0
+
+    asyncio.run(main())
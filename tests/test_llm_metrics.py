@@ -0,0 +1,35 @@
+import json
+
+from llm_metrics import MetricsLog, RunMetrics, format_totals
+
+
+def _call(label, prompt=100, gen=20):
+    return {"label": label, "model": "qwen3-swallow:8b", "prompt_eval_count": prompt, "prompt_eval_sec": 1.0,
+            "eval_count": gen, "eval_sec": 2.0, "load_sec": 0.0, "total_sec": 3.0}
+
+
+def test_timed_out_step_is_written(tmp_path):
+    log = MetricsLog(str(tmp_path / "llm_metrics.jsonl"))
+    run = RunMetrics("task-1", 1, "autonomous", "長いタスク")
+    run.add_step(0, [_call("思考"), _call("解答")])
+    run.add_step(1, [_call("思考")], timeout=True)  # 解答の呼び出しはまだ終わっていない
+
+    task = log.finish(run, "error")
+
+    with open(tmp_path / "llm_metrics.jsonl", encoding="utf-8") as f:
+        record = json.loads(f.readline())
+    assert record["steps"][1] == {"step": 1, "calls": [_call("思考")], "timeout": True}
+    assert record["run"]["timeouts"] == 1 and record["run"]["calls"] == 3
+    assert task["timeouts"] == 1
+    assert "タイムアウト 1 回" in format_totals(run.totals)
+
+
+def test_task_totals_are_bounded(tmp_path):
+    log = MetricsLog(str(tmp_path / "llm_metrics.jsonl"), max_tasks=2)
+    for task_id in ("a", "b", "c"):
+        run = RunMetrics(task_id, 1, "autonomous", "中断したタスク")
+        run.add_step(0, [_call("解答")])
+        log.finish(run, "suspended")
+
+    assert log.task_totals("a")["calls"] == 0  # 古いものから捨てる
+    assert log.task_totals("c")["calls"] == 1
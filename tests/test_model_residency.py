@@ -0,0 +1,63 @@
+import model_residency
+from model_residency import ModelResidency
+
+COLD = {"load_duration": 3_000_000_000}
+WARM = {"load_duration": 0}
+HOST = "http://a:11434"
+
+
+def _alternate(models, host=HOST, rounds=3):
+    for _ in range(rounds):
+        models.note_response("think:8b", COLD, host=host, role="thinking")
+        models.note_response("answer:8b", COLD, host=host, role="output")
+
+
+def test_thinking_output_alternation_is_counted():
+    models = ModelResidency("30m", client=object())
+    _alternate(models)
+    # 最初の思考・解答はただの読み込み。その後の4回が交互の読み込み直し
+    assert models.swaps == 4
+    assert models.recent_swaps() == 4
+
+
+def test_same_model_reload_and_small_route_are_not_swaps():
+    models = ModelResidency("30m", client=object())
+    for _ in range(3):
+        models.note_response("answer:8b", COLD, host=HOST, role="output")  # keep_alive 切れの読み込み直し
+    for _ in range(3):
+        # 小さいモデルに追い出されたあとの読み込み直しは、思考・解答の交互の入れ替えではない
+        models.note_response("think:8b", COLD, host=HOST, role="thinking")
+        models.note_response("small:1b", COLD, host=HOST)
+        models.note_response("answer:8b", COLD, host=HOST, role="output")
+        models.note_response("small:1b", COLD, host=HOST)
+    assert models.swaps == 0
+
+
+def test_loads_on_different_hosts_are_not_swaps():
+    models = ModelResidency("30m", client=object())
+    models.note_response("think:8b", WARM, host="http://a:11434", role="thinking")
+    models.note_response("answer:8b", COLD, host="http://b:11434", role="output")
+    models.note_response("think:8b", COLD, host="http://b:11434", role="thinking")
+    assert models.swaps == 0
+
+
+def test_reload_after_the_window_is_not_a_swap(monkeypatch):
+    models = ModelResidency("30m", client=object())
+    now = [1000.0]
+    monkeypatch.setattr(model_residency.time, "time", lambda: now[0])
+    models.note_response("think:8b", COLD, host=HOST, role="thinking")
+    models.note_response("answer:8b", COLD, host=HOST, role="output")
+    now[0] += model_residency.SWAP_WINDOW_SEC + 1
+    models.note_response("think:8b", COLD, host=HOST, role="thinking")
+    assert models.swaps == 0
+
+
+def test_recent_swaps_decay(monkeypatch):
+    models = ModelResidency("30m", client=object())
+    now = [1000.0]
+    monkeypatch.setattr(model_residency.time, "time", lambda: now[0])
+    _alternate(models)
+    assert models.recent_swaps() == 4
+    now[0] += model_residency.SWAP_WINDOW_SEC + 1
+    assert models.recent_swaps() == 0
+    assert models.swaps == 4  # 累計は表示用に残す
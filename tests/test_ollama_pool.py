@@ -0,0 +1,131 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from model_residency import ModelResidency
+from ollama_pool import OllamaPool
+
+
+class _FakeClient:
+    def __init__(self, url, loaded=()):
+        self.url = url
+        self.loaded = list(loaded)
+        self.generated = []
+
+    def generate(self, model, prompt="", keep_alive=None):
+        self.generated.append(model)
+        cold = model not in self.loaded
+        if cold:
+            self.loaded.append(model)
+        return {"load_duration": 2_000_000_000 if cold else 0}
+
+    def ps(self):
+        return {"models": [{"model": m} for m in self.loaded]}
+
+
+def _pool(*urls):
+    clients = {}
+
+    def factory(url):
+        clients[url] = _FakeClient(url)
+        return clients[url]
+
+    return OllamaPool(hosts=",".join(urls), client_factory=factory), clients
+
+
+def test_warm_up_reaches_every_host():
+    pool, clients = _pool("http://a:11434", "http://b:11434")
+    models = ModelResidency("30m", client=pool)
+
+    for client in pool.host_clients():
+        assert models.check_coresidency(["think:8b", "answer:8b"], client=client) is True
+
+    assert clients["http://a:11434"].generated == ["think:8b", "answer:8b"]
+    assert clients["http://b:11434"].generated == ["think:8b", "answer:8b"]
+    assert models.swaps == 0  # ウォームアップの読み込みは入れ替えに数えない
+
+
+def test_host_clients_skip_unhealthy_hosts_and_missing_models():
+    pool, _ = _pool("http://a:11434", "http://b:11434", "http://c:11434")
+    a, b, c = pool._hosts
+    a.models = {"think:8b"}
+    b.models = {"answer:8b"}
+    c.healthy = False
+
+    assert [h.url for h in pool.host_clients("answer:8b")] == ["http://b:11434"]
+    assert [h.url for h in pool.host_clients()] == ["http://a:11434", "http://b:11434"]
+
+
+def _stub_pool(*stubs):
+    pytest.importorskip("ollama")
+    return OllamaPool(hosts=[s.url for s in stubs], healthcheck_sec=30)
+
+
+def _chat(pool, model="qwen3-swallow:8b"):
+    response = pool.chat(model=model, messages=[{"role": "user", "content": "こんにちは"}])
+    return response["message"]["content"]
+
+
+def test_health_check_marks_down_hosts_and_recovers(ollama_stub):
+    a, b = ollama_stub("a"), ollama_stub("b")
+    pool = _stub_pool(a, b)
+    b.fail = True
+
+    assert pool.check_all() == 1
+    assert [h["healthy"] for h in pool.stats()] == [True, False]
+    assert [_chat(pool) for _ in range(3)] == ["from a"] * 3
+    assert b.chats() == 0
+
+    b.fail = False
+    assert pool.check_all() == 2
+    assert pool.stats()[1]["models"] == 1
+
+
+def test_failover_on_server_error_and_connection_error(ollama_stub):
+    a, b, c = ollama_stub("a"), ollama_stub("b"), ollama_stub("c")
+    pool = _stub_pool(a, b, c)
+    assert pool.check_all() == 3
+
+    a.fail = True  # ヘルスチェックの前に 500 を返し始めた
+    assert _chat(pool) == "from b"
+    assert a.chats() == 1
+    assert not pool.stats()[0]["healthy"]
+
+    b.stop()  # 接続できなくなった
+    assert _chat(pool) == "from c"
+    stats = pool.stats()
+    assert not stats[1]["healthy"] and stats[1]["failures"] == 1
+
+
+def test_routes_to_the_host_with_the_model(ollama_stub):
+    a, b = ollama_stub("a", ["qwen3-swallow:8b"]), ollama_stub("b", ["qwen3:1.7b"])
+    pool = _stub_pool(a, b)
+    pool.check_all()
+
+    assert _chat(pool, "qwen3:1.7b") == "from b"
+    assert _chat(pool, "qwen3-swallow:8b") == "from a"
+
+
+def test_least_loaded_host_gets_the_next_call(ollama_stub):
+    a, b = ollama_stub("a"), ollama_stub("b")
+    pool = _stub_pool(a, b)
+    pool.check_all()
+    a.gate.clear()
+    b.gate.clear()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(_chat, pool)
+        while sum(h["active"] for h in pool.stats()) < 1 or a.chats() + b.chats() < 1:
+            time.sleep(0.01)
+        busy = "a" if a.chats() else "b"
+        second = executor.submit(_chat, pool)
+        while a.chats() + b.chats() < 2:
+            time.sleep(0.01)
+        a.gate.set()
+        b.gate.set()
+        results = [first.result(timeout=5), second.result(timeout=5)]
+
+    assert results[0] == f"from {busy}"
+    assert results[1] != results[0]  # 1件目が実行中のホストは避ける
+    assert a.chats() == b.chats() == 1
@@ -0,0 +1,53 @@
+import asyncio
+import os
+
+
+def _use_tmp_queue(agent_bot, tmp_path, monkeypatch):
+    monkeypatch.setattr(agent_bot, "AUTONOMOUS_TASKS_PATH", str(tmp_path / "autonomous_tasks.json"))
+    monkeypatch.setattr(agent_bot, "RUN_CHECKPOINT_DIR", str(tmp_path / "run_checkpoints"))
+    monkeypatch.setattr(agent_bot, "_agent_lock_path", str(tmp_path / "agent_bot.lock"))
+    os.makedirs(agent_bot.RUN_CHECKPOINT_DIR)
+
+
+def _running_task_with_checkpoint(agent_bot):
+    agent_bot.queue_add("長いタスク")
+    task = agent_bot.queue_get_next()  # running になり、リースは RUN_LEASE_SEC 先まで残る
+    agent_bot._save_run_checkpoint(task["id"], {"instruction": "長いタスク", "messages": [], "step": 3})
+    return task
+
+
+def test_reclaim_keeps_running_task_within_lease(agent_bot, tmp_path, monkeypatch):
+    _use_tmp_queue(agent_bot, tmp_path, monkeypatch)
+    _running_task_with_checkpoint(agent_bot)
+
+    assert agent_bot.queue_reclaim_stale() == 0
+    assert agent_bot._load_queue()[0]["status"] == "running"
+
+
+def test_restart_within_lease_window_resumes_immediately(agent_bot, tmp_path, monkeypatch):
+    _use_tmp_queue(agent_bot, tmp_path, monkeypatch)
+    task = _running_task_with_checkpoint(agent_bot)
+    started = {}
+
+    async def autonomous_loop(bot, initial_delay=None):
+        started["initial_delay"] = initial_delay
+
+    async def idle(bot):
+        pass
+
+    monkeypatch.setattr(agent_bot, "autonomous_loop", autonomous_loop)
+    monkeypatch.setattr(agent_bot, "proactive_channel_loop", idle)
+    monkeypatch.setattr(agent_bot, "channel_scheduler_loop", idle)
+
+    async def main():
+        await agent_bot._start_queue_and_loops()
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+
+    tasks = agent_bot._load_queue()
+    assert [t["id"] for t in tasks] == [task["id"]]
+    assert tasks[0]["status"] == "pending"
+    assert "lease_until" not in tasks[0]
+    assert agent_bot._load_run_checkpoint(task["id"])["step"] == 3  # 途中経過から再開できる
+    assert started["initial_delay"] == 0
@@ -0,0 +1,71 @@
+import asyncio
+import io
+import os
+import time
+
+import trace_view
+from tracing import Tracer
+
+
+def _traced_run(tracer):
+    def call_llm():
+        with tracer.span("llm.output", model="qwen3-swallow:8b"):
+            time.sleep(0.02)
+
+    async def run():
+        with tracer.span("run", source="interactive", instruction="こんにちは"):
+            with tracer.span("step", step=0):
+                with tracer.span("llm", route="main"):
+                    await asyncio.to_thread(call_llm)
+                with tracer.span("tool", tool="web_search"):
+                    await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    tracer.flush()
+
+
+def test_nested_spans_across_threads_render(tmp_path):
+    path = str(tmp_path / "traces" / "trace.jsonl")
+    tracer = Tracer(path, enabled=True)
+    _traced_run(tracer)
+
+    runs = trace_view.run_traces(trace_view.load_spans(path))
+    assert len(runs) == 1
+    trace_id, root, spans = runs[0]
+    by_name = {s["name"]: s for s in spans}
+    assert root is by_name["run"] and root["attrs"]["instruction"] == "こんにちは"
+    # asyncio.to_thread で動いた LLM 呼び出しも llm スパンの子になる
+    assert by_name["llm.output"]["parent_id"] == by_name["llm"]["span_id"]
+    assert by_name["llm"]["parent_id"] == by_name["step"]["span_id"]
+    assert by_name["tool"]["parent_id"] == by_name["step"]["span_id"]
+    assert {s["trace_id"] for s in spans} == {trace_id}
+
+    out = io.StringIO()
+    trace_view.flame_summary(spans, out=out)
+    rows = {line.split()[0]: line.split()[1:] for line in out.getvalue().splitlines()[2:]}
+    assert set(rows) == {"run", "step", "llm", "llm.output", "tool:web_search"}
+    assert all(count == "1" for count, _, _ in rows.values())
+    assert float(rows["llm.output"][2]) >= 0.02  # 子のないスパンは self 時間 = 合計
+
+    timeline = io.StringIO()
+    trace_view.render_timeline(root, spans, out=timeline)
+    assert "      llm.output" in timeline.getvalue()
+
+
+def test_rotation_keeps_backups(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    tracer = Tracer(path, enabled=True, max_bytes=2000, backups=1)
+    for _ in range(5):
+        _traced_run(tracer)
+    assert os.path.exists(path + ".1")
+    assert not os.path.exists(path + ".2")
+    assert os.path.getsize(path) <= 2000
+
+
+def test_no_backups_truncates(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    tracer = Tracer(path, enabled=True, max_bytes=2000, backups=0)
+    for _ in range(5):
+        _traced_run(tracer)
+    assert os.listdir(tmp_path) == ["trace.jsonl"]
+    assert os.path.getsize(path) <= 2000
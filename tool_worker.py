@@ -0,0 +1,308 @@
+# カスタムツールを Bot 本体とは別の常駐プロセスで実行するワーカープール。
+# 親（Bot）と子（このファイルを python tool_worker.py で起動）は stdin/stdout で
+# 「4バイト長 + JSON」のメッセージをやり取りする。1つのワーカーが複数の呼び出しを同時に受け、
+# async def run はワーカーのイベントループでそのまま await、同期の run はワーカー内のスレッドプールで動かす。
+# 呼び出しごとにタイムアウトがあり、クラッシュ・ハングしたワーカーは作り直す。子はメモリ上限（RLIMIT_AS）付きで動く。
+
+import asyncio
+import importlib.util
+import inspect
+import json
+import os
+import struct
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_HEADER = struct.Struct(">I")
+
+
+def _encode(obj):
+    body = json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+    return _HEADER.pack(len(body)) + body
+
+
+# --- 子プロセス側 ---
+
+def _load_run(modules, path, sig):
+    """path のモジュールの run を返す。sig（mtime・サイズ）が変わっていれば読み直す。"""
+    cached = modules.get(path)
+    if cached is None or cached[0] != sig:
+        spec = importlib.util.spec_from_file_location(f"custom_tool_{os.path.basename(path)[:-3]}", path)
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        cached = (sig, getattr(mod, "run", None))
+        modules[path] = cached
+    if not callable(cached[1]):
+        raise RuntimeError("run(args) がありません")
+    return cached[1]
+
+
+async def _serve(ipc_in, ipc_out, concurrency):
+    loop = asyncio.get_running_loop()
+    requests = asyncio.Queue()
+
+    def _read_requests():
+        # stdin の読み取りはブロックするので専用スレッドで行い、ループへ渡す
+        while True:
+            header = ipc_in.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                loop.call_soon_threadsafe(requests.put_nowait, None)
+                return
+            (size,) = _HEADER.unpack(header)
+            req = json.loads(ipc_in.read(size).decode("utf-8"))
+            loop.call_soon_threadsafe(requests.put_nowait, req)
+
+    threading.Thread(target=_read_requests, daemon=True).start()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    modules = {}  # path -> (sig, run 関数)
+    running = {}  # 呼び出し id -> Task
+
+    def _send(reply):
+        ipc_out.write(_encode(reply))
+        ipc_out.flush()
+
+    async def _handle(req):
+        req_id = req.get("id")
+        reply = {"id": req_id}
+        try:
+            run_fn = _load_run(modules, req["path"], tuple(req.get("sig") or ()))
+            args = req.get("args") or {}
+            if inspect.iscoroutinefunction(run_fn):
+                result = await run_fn(args)
+            else:
+                result = await loop.run_in_executor(executor, run_fn, args)
+                if inspect.isawaitable(result):
+                    result = await result
+            reply["ok"] = True
+            reply["result"] = result if isinstance(result, str) else str(result)
+        except asyncio.CancelledError:
+            reply["ok"] = False
+            reply["error"] = "キャンセルされました"
+        except MemoryError:
+            reply["ok"] = False
+            reply["error"] = "メモリ上限を超えました"
+        except Exception as e:
+            reply["ok"] = False
+            reply["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            running.pop(req_id, None)
+        _send(reply)
+
+    while True:
+        req = await requests.get()
+        if req is None:
+            break
+        if "cancel" in req:
+            task = running.get(req["cancel"])
+            if task is not None:
+                task.cancel()
+            continue
+        running[req.get("id")] = asyncio.create_task(_handle(req))
+
+
+def _worker_main():
+    """ワーカーのエントリポイント。ツールの print が通信を壊さないよう、stdout は stderr に付け替えてから使う。"""
+    memory_mb = int(os.environ.get("TOOL_WORKER_MEMORY_MB", "0") or 0)
+    if memory_mb > 0:
+        try:
+            import resource
+            limit = memory_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError):
+            pass  # 未対応の OS では上限なしで動かす
+    concurrency = max(1, int(os.environ.get("TOOL_WORKER_CONCURRENCY", "8") or 8))
+    ipc_in = sys.stdin.buffer
+    ipc_out = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    asyncio.run(_serve(ipc_in, ipc_out, concurrency))
+    os._exit(0)  # 止まらない同期ツールのスレッドが残っていても終了する
+
+
+# --- 親（Bot）側 ---
+
+class ToolWorkerError(Exception):
+    """ワーカーでの実行に失敗した（タイムアウト・クラッシュ・ツール内の例外）。"""
+
+
+class _Worker:
+    def __init__(self, proc):
+        self.proc = proc
+        self.pending = {}  # 呼び出し id -> Future
+        self.calls = 0
+        self.retired = False  # True なら新しい呼び出しを割り当てない（実行中の分が終わったら止める）
+        self.reader = None
+
+    @property
+    def alive(self):
+        return self.proc.returncode is None
+
+
+class ToolWorkerPool:
+    """常駐ワーカープロセスのプール。start() で先に起動しておき、call() は実行中の呼び出しが少ないワーカーに投げる。"""
+
+    def __init__(self, size=2, timeout_sec=60, memory_mb=1024, concurrency=8, max_calls=200):
+        self._size = max(1, size)
+        self._timeout = timeout_sec
+        self._memory_mb = memory_mb
+        self._concurrency = max(1, concurrency)  # ワーカー1つが同時に受ける呼び出し数
+        self._max_calls = max_calls  # この回数を使ったワーカーは入れ替える（ツール側のリーク対策）
+        self._workers = []
+        self._slots = None
+        self._start_lock = None
+        self._started = False
+        self._closing = False
+        self._seq = 0
+        self.restarts = 0
+
+    async def _spawn(self):
+        env = dict(os.environ)
+        env["TOOL_WORKER_MEMORY_MB"] = str(self._memory_mb)
+        env["TOOL_WORKER_CONCURRENCY"] = str(self._concurrency)
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env=env,
+        )
+        worker = _Worker(proc)
+        worker.reader = asyncio.create_task(self._read_replies(worker))
+        return worker
+
+    async def start(self):
+        """ワーカーを size 個起動しておく（初回呼び出しでプロセス起動を待たないように）。"""
+        if self._started:
+            return
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._started:
+                return
+            self._slots = asyncio.Semaphore(self._size * self._concurrency)
+            for _ in range(self._size):
+                self._workers.append(await self._spawn())
+            self._started = True
+
+    async def _read_replies(self, worker):
+        """ワーカーの返事を id で呼び出し元に振り分ける。ワーカーが落ちたら実行中の呼び出しをエラーにして作り直す。"""
+        try:
+            while True:
+                header = await worker.proc.stdout.readexactly(_HEADER.size)
+                (size,) = _HEADER.unpack(header)
+                reply = json.loads((await worker.proc.stdout.readexactly(size)).decode("utf-8"))
+                fut = worker.pending.pop(reply.get("id"), None)
+                if fut is not None and not fut.done():
+                    fut.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            return
+        for fut in worker.pending.values():
+            if not fut.done():
+                fut.set_exception(ToolWorkerError("ワーカーが異常終了しました（メモリ上限超過やクラッシュの可能性）"))
+        worker.pending.clear()
+        if worker in self._workers and not self._closing:
+            self._workers.remove(worker)
+            self.restarts += 1
+            try:
+                self._workers.append(await self._spawn())
+            except Exception as e:
+                sys.stderr.write(f"[カスタムツール] ワーカーを起動できません: {e}\n")
+
+    async def _retire(self, worker):
+        """worker に新しい呼び出しを割り当てないようにし、代わりを起動する。実行中の分を待ってから止める。"""
+        if worker.retired:
+            return
+        worker.retired = True
+        if worker in self._workers:
+            self._workers.remove(worker)
+            self.restarts += 1
+            try:
+                self._workers.append(await self._spawn())
+            except Exception as e:
+                sys.stderr.write(f"[カスタムツール] ワーカーを起動できません: {e}\n")
+        asyncio.create_task(self._stop_when_idle(worker))
+
+    async def _stop_when_idle(self, worker):
+        if worker.pending:
+            await asyncio.wait(list(worker.pending.values()), timeout=self._timeout)
+        if worker.reader is not None:
+            worker.reader.cancel()
+        await self._kill(worker)
+
+    async def _kill(self, worker):
+        if worker.alive:
+            try:
+                worker.proc.kill()
+            except ProcessLookupError:
+                pass
+        try:
+            await worker.proc.wait()
+        except Exception:
+            pass
+
+    async def _pick(self):
+        live = [w for w in self._workers if w.alive and not w.retired]
+        if not live:
+            worker = await self._spawn()
+            self._workers.append(worker)
+            return worker
+        return min(live, key=lambda w: len(w.pending))
+
+    async def call(self, path, sig, args, is_async=False, timeout_sec=None):
+        """path のツールの run(args) をワーカーで実行し、結果の文字列を返す。失敗時は ToolWorkerError。
+        is_async のツールはタイムアウト時にワーカーへキャンセルを送る。同期ツールのスレッドは止められないので、ワーカーごと入れ替える。"""
+        await self.start()
+        timeout = self._timeout if timeout_sec is None else timeout_sec
+        async with self._slots:
+            worker = await self._pick()
+            self._seq += 1
+            req_id = self._seq
+            fut = asyncio.get_running_loop().create_future()
+            worker.pending[req_id] = fut
+            worker.calls += 1
+            try:
+                try:
+                    worker.proc.stdin.write(_encode({"id": req_id, "path": path, "sig": list(sig or ()), "args": args}))
+                    await worker.proc.stdin.drain()
+                except (BrokenPipeError, ConnectionError):
+                    raise ToolWorkerError("ワーカーとの通信に失敗しました")
+                try:
+                    reply = await asyncio.wait_for(asyncio.shield(fut), timeout=timeout)
+                except asyncio.TimeoutError:
+                    await self._abandon(worker, req_id, is_async)
+                    raise ToolWorkerError(f"タイムアウトしました（{timeout}秒）")
+                except asyncio.CancelledError:
+                    await self._abandon(worker, req_id, is_async)
+                    raise
+            finally:
+                worker.pending.pop(req_id, None)
+                if worker.calls >= self._max_calls:
+                    await self._retire(worker)
+        if not reply.get("ok"):
+            raise ToolWorkerError(reply.get("error") or "不明なエラー")
+        return reply.get("result") or ""
+
+    async def _abandon(self, worker, req_id, is_async):
+        worker.pending.pop(req_id, None)
+        if is_async and worker.alive:
+            try:
+                worker.proc.stdin.write(_encode({"cancel": req_id}))
+                await worker.proc.stdin.drain()
+                return
+            except (BrokenPipeError, ConnectionError):
+                pass
+        await self._retire(worker)
+
+    async def close(self):
+        self._closing = True
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            if worker.reader is not None:
+                worker.reader.cancel()
+            await self._kill(worker)
+
+
+if __name__ == "__main__":
+    _worker_main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# トレース（project/traces/trace.jsonl）を実行ごとのタイムラインで表示するスクリプト。
+# 用法: python trace_view.py                 … 最新の実行のタイムラインと、スパン名ごとの時間の集計
+#       python trace_view.py --list          … 最近の実行の一覧（trace_id・開始時刻・所要時間・指示）
+#       python trace_view.py --trace <id>    … 指定した実行（trace_id の先頭数文字でよい）
+#       python trace_view.py --last 3        … 最新から3件
+# - タイムラインは親子の入れ子で、実行開始からの経過時間・所要時間・バーを表示する。
+# - 集計（flame summary）はスパン名ごとの合計時間と、子スパンを除いた自分だけの時間（self）を出す。
+
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+_TRACE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "project", "traces", "trace.jsonl")
+_BAR_WIDTH = 40
+_ATTR_KEYS = ("tool", "route", "model", "step", "wait_sec", "prompt_tokens", "gen_tokens", "load_sec", "cached", "channel", "chars", "error")
+
+
+def load_spans(path):
+    """path と回した古いファイル（.1, .2 …）からスパンを読み、trace_id ごとにまとめる。"""
+    files = [path]
+    i = 1
+    while os.path.exists(f"{path}.{i}"):
+        files.append(f"{path}.{i}")
+        i += 1
+    traces = {}
+    for fname in reversed(files):
+        if not os.path.exists(fname):
+            continue
+        with open(fname, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+                traces.setdefault(span.get("trace_id"), []).append(span)
+    return traces
+
+
+def _root(spans):
+    ids = {s["span_id"] for s in spans}
+    roots = [s for s in spans if s.get("parent_id") not in ids]
+    return min(roots, key=lambda s: s["start"]) if roots else None
+
+
+def run_traces(traces):
+    """run スパンを持つトレースを開始時刻順に返す: [(trace_id, run スパン, スパン一覧)]"""
+    out = []
+    for trace_id, spans in traces.items():
+        root = _root(spans)
+        if root is not None and root["name"] == "run":
+            out.append((trace_id, root, spans))
+    return sorted(out, key=lambda t: t[1]["start"])
+
+
+def _attrs_text(span):
+    attrs = span.get("attrs") or {}
+    parts = [f"{k}={attrs[k]}" for k in _ATTR_KEYS if attrs.get(k) is not None and attrs[k] != "" and attrs[k] is not False]
+    if span.get("status") not in (None, "ok"):
+        parts.append(f"status={span['status']}")
+    return " ".join(parts)
+
+
+def render_timeline(root, spans, out=sys.stdout):
+    children = {}
+    for s in spans:
+        children.setdefault(s.get("parent_id"), []).append(s)
+    for kids in children.values():
+        kids.sort(key=lambda s: s["start"])
+    t0 = root["start"]
+    total = max(root["end"] - t0, 1e-6)
+    attrs = root.get("attrs") or {}
+    out.write(
+        f"# {root['trace_id']}  {datetime.fromtimestamp(t0).strftime('%Y-%m-%d %H:%M:%S')}  "
+        f"{total:.2f}s  [{attrs.get('source', '')}] {attrs.get('instruction', '')[:60]}\n"
+    )
+
+    def walk(span, depth):
+        offset = span["start"] - t0
+        dur = span["end"] - span["start"]
+        left = int(offset / total * _BAR_WIDTH)
+        width = max(1, int(round(dur / total * _BAR_WIDTH)))
+        bar = " " * left + "█" * min(width, _BAR_WIDTH - left)
+        label = "  " * depth + span["name"]
+        out.write(f"{offset:8.2f}s {dur:8.2f}s |{bar:<{_BAR_WIDTH}}| {label}  {_attrs_text(span)}\n")
+        for child in children.get(span["span_id"], []):
+            walk(child, depth + 1)
+
+    walk(root, 0)
+
+
+def flame_summary(spans, out=sys.stdout):
+    """スパン名ごとの回数・合計時間・self 時間（子スパンの分を引いたもの）。"""
+    child_time = {}
+    for s in spans:
+        if s.get("parent_id"):
+            child_time[s["parent_id"]] = child_time.get(s["parent_id"], 0.0) + (s["end"] - s["start"])
+    by_name = {}
+    for s in spans:
+        dur = s["end"] - s["start"]
+        key = s["name"]
+        if s["name"] == "tool":
+            key = f"tool:{(s.get('attrs') or {}).get('tool', '?')}"
+        row = by_name.setdefault(key, [0, 0.0, 0.0])
+        row[0] += 1
+        row[1] += dur
+        row[2] += max(0.0, dur - child_time.get(s["span_id"], 0.0))
+    out.write(f"\n{'スパン':<28}{'回数':>6}{'合計(s)':>10}{'self(s)':>10}\n")
+    for key, (count, total, self_time) in sorted(by_name.items(), key=lambda kv: -kv[1][2]):
+        out.write(f"{key:<28}{count:>6}{total:>10.2f}{self_time:>10.2f}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="トレースを実行ごとのタイムラインで表示する")
+    parser.add_argument("--file", default=_TRACE_PATH, help="トレースファイル（既定: project/traces/trace.jsonl）")
+    parser.add_argument("--list", action="store_true", help="最近の実行の一覧を表示")
+    parser.add_argument("--trace", help="表示する trace_id（先頭数文字でよい）")
+    parser.add_argument("--last", type=int, default=1, help="最新から何件表示するか")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file):
+        print(f"トレースファイルがありません: {args.file}")
+        return 1
+    runs = run_traces(load_spans(args.file))
+    if not runs:
+        print("実行（run）のトレースがありません。")
+        return 1
+    if args.list:
+        for trace_id, root, spans in runs[-20:]:
+            attrs = root.get("attrs") or {}
+            started = datetime.fromtimestamp(root["start"]).strftime("%m-%d %H:%M:%S")
+            print(f"{trace_id}  {started}  {root['end'] - root['start']:8.2f}s  {len(spans):4d} spans  [{attrs.get('source', '')}] {attrs.get('instruction', '')[:50]}")
+        return 0
+    if args.trace:
+        selected = [r for r in runs if r[0].startswith(args.trace)]
+        if not selected:
+            print(f"trace_id {args.trace} が見つかりません。--list で一覧を確認してください。")
+            return 1
+    else:
+        selected = runs[-max(1, args.last):]
+    for trace_id, root, spans in selected:
+        render_timeline(root, spans)
+        flame_summary(spans)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
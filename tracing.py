@@ -0,0 +1,181 @@
+# 実行のトレース（スパン）を JSONL に書き出す。スパンは名前・開始/終了時刻・属性・親スパンを持ち、
+# run_agent 1回を1つのトレース（trace_id）として、ステップ・LLM 呼び出し・ツール実行・Discord への送信・Webhook 投稿を子スパンにする。
+# 親子関係は contextvars で引き継ぐので、asyncio のタスクや asyncio.to_thread で動く処理も呼び出し元の子になる。
+# 書き込みはスパンの終了時には行の組み立てだけをして、バックグラウンドのスレッドがまとめてファイルに書く（イベントループを止めない）。
+# ファイルは TRACE_MAX_MB を超えたら trace.jsonl.1, .2 … に回す（TRACE_BACKUPS=0 なら空にして書き直す）。
+# python trace_view.py で実行ごとのタイムラインを表示できる。
+
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "1").strip().lower() in ("1", "true", "yes")
+TRACE_MAX_MB = int(os.environ.get("TRACE_MAX_MB", "10"))  # 1ファイルの上限
+TRACE_BACKUPS = int(os.environ.get("TRACE_BACKUPS", "3"))  # 残す古いファイルの数（0 なら上限を超えたら空にする）
+TRACE_FLUSH_SEC = 1.0  # 溜めた行を書き出す間隔
+TRACE_FLUSH_LINES = 200  # これだけ溜まったら間隔を待たずに書き出す
+
+_current = contextvars.ContextVar("trace_span", default=None)
+
+
+class Span:
+    """1つの処理区間。end() で閉じると1行書き出す。with でも使える。"""
+
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent", "start", "attrs", "status", "_ended")
+
+    def __init__(self, tracer, name, parent, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.span_id = uuid.uuid4().hex[:16]
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.start = time.time()
+        self.attrs = attrs
+        self.status = "ok"
+        self._ended = False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return self
+
+    def end(self, status=None):
+        if self._ended:
+            return
+        self._ended = True
+        if status:
+            self.status = status
+        if _current.get() is self:
+            _current.set(self.parent)
+        self.tracer._write(self, time.time())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.status == "ok":
+            self.status = "error"
+            self.attrs.setdefault("error", f"{exc_type.__name__}: {exc}"[:300])
+        self.end()
+        return False
+
+
+class _NullSpan:
+    """トレース無効時のスパン（何もしない）。"""
+
+    trace_id = span_id = None
+
+    def set(self, **attrs):
+        return self
+
+    def end(self, status=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    def __init__(self, path, enabled=TRACE_ENABLED, max_bytes=TRACE_MAX_MB * 1024 * 1024, backups=TRACE_BACKUPS, flush_sec=TRACE_FLUSH_SEC):
+        self.path = path
+        self.enabled = enabled
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._flush_sec = flush_sec
+        self._cond = threading.Condition()  # _pending と書き出しスレッドの起床
+        self._pending = []  # まだ書いていない行
+        self._thread = None
+        self._io_lock = threading.Lock()  # ファイル（_file・_size）
+        self._file = None
+        self._size = 0
+
+    def start(self, name, **attrs):
+        """スパンを開始し、以降（同じコンテキスト）で開始するスパンの親にする。with で使うか、end() で閉じる。"""
+        if not self.enabled:
+            return _NULL_SPAN
+        span = Span(self, name, _current.get(), attrs)
+        _current.set(span)
+        return span
+
+    span = start  # with tracer.span("name", key=value): の形で使う
+
+    def _write(self, span, end):
+        record = {
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+            "parent_id": span.parent.span_id if span.parent is not None else None,
+            "name": span.name,
+            "start": round(span.start, 6),
+            "end": round(end, 6),
+            "dur_ms": round((end - span.start) * 1000, 3),
+            "status": span.status,
+            "attrs": span.attrs,
+        }
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._cond:
+            self._pending.append(line)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run_writer, name="trace-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+            elif len(self._pending) >= TRACE_FLUSH_LINES:
+                self._cond.notify()
+
+    def _run_writer(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self._flush_sec)
+            self.flush()
+
+    def flush(self):
+        """溜まっている行をファイルに書く。"""
+        with self._cond:
+            lines, self._pending = self._pending, []
+        if not lines:
+            return
+        with self._io_lock:
+            try:
+                for line in lines:
+                    data = line.encode("utf-8")
+                    if self._file is None:
+                        self._open()
+                    if self._size > 0 and self._size + len(data) > self._max_bytes:
+                        self._rotate()
+                    self._file.write(data)
+                    self._size += len(data)
+                self._file.flush()
+            except OSError:
+                self._close()
+
+    def _open(self, mode="ab"):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, mode)
+        self._size = self._file.seek(0, os.SEEK_END)
+
+    def _close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+        self._file = None
+
+    def _rotate(self):
+        self._close()
+        if self._backups <= 0:
+            self._open("wb")  # 古いファイルを残さない設定なので空にして書き直す
+            return
+        for i in range(self._backups, 0, -1):
+            src = self.path if i == 1 else f"{self.path}.{i - 1}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i}")
+        self._open()